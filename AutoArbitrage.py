@@ -1,39 +1,105 @@
+import sys
 import os  # Miscellaneous operating system interfaces, Lib/os.py  ## import random # Generate pseudo-random numbers, Lib/random.py
 import time
 import datetime  # Basic date and time types, Lib/datetime.py
-import schedule # Python job scheduling for humans. Run Python functions (or any other callable) periodically using a friendly syntax. https://github.com/dbader/schedule
 import webbrowser  # Convenient web-browser controller, Lib/webbrowser.py
 import xlwings  # xlwings - Make Excel Fly! https://docs.xlwings.org/en/stable/index.html
 import pandas
-import numpy as np
 import requests  # HTTP for Humans, https://requests.readthedocs.io/en/latest/
 import pysnowball  # snowball's Python API, https://github.com/uname-yang/pysnowball
-import browser_cookie3  # Loads cookies used by your web browser into a cookiejar object, https://github.com/borisbabic/browser_cookie3
-from scipy.stats import norm
-from chinese_calendar import is_workday # determine workdays in China from 2004 to 2024, https://github.com/LKI/chinese-calendar
+from credentials import TokenManager, token_cache_path  # xq_a_token persisted with its expiry, renewed on 400016
+from quotes import QuoteCache, QuoteFetcher, SnowballTransport  # concurrent quote fetching over a pooled keep-alive session, with a TTL cache
+from kmv import KMVCalibrator  # DtD calibrated KMV style, warm-started from the last run
+from volatility import VolatilityEngine, get_kline_fetcher, fill_realized_volatility  # realized volatility from cached daily k-line history
+from bondfloor import BondFloorEngine, fill_straight_bond_value, bond_floor_fields  # straight bond values from coupon schedules and yield curves
+from streaming import StreamingRefresher, get_realtime_fetcher, streaming_interval  # intraday polling, only the changed rows are re-computed
+from alerts import AlertEngine, get_alert_sinks  # rules evaluated on every streaming update, see alerts.alert_rules
+from scheduler import TradingCalendar, RefreshScheduler, close_time, get_exchange_time  # SSE/SZSE trading days and sessions, holidays from chinese_calendar cached per year
+from snapshots import SnapshotStore  # typed, timestamped snapshots of every refresh, partitioned by day
+from strategies import strategy_specs, get_ranking_blocks  # declarative CB ranking strategies, and the rows of a ranking that moved
+from metrics import metrics  # stage timers, request latencies and solver counters, off unless AUTOARBITRAGE_METRICS=1
+from pipeline import (convertible_bond_columns, underlying_columns, parameter_range, StageTimer, get_bond_symbol,
+                      get_parameter_cells, build_convertible_bond_table, select_underlyings,
+                      overlay_underlyings, build_underlying_table, rank_strategy, rank_strategies, get_typed_table,
+                      get_display_table)  # refresh, pricing & ranking on in-memory DataFrames
 from requests.packages.urllib3.exceptions import InsecureRequestWarning # urllib3, HTTP library with thread-safe connection pooling, file post, and more, https://github.com/urllib3/urllib3
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning) # Disable any phantom warnings via the PYTHONWARINGS environment variable
 
 
 source_range_convertible_bond = 'B8:T'   # Get the excel range in real time data sheet
 source_range_underlyings = 'B8:X'   # Get the excel range in underlyings sheet
+source_ranges = {'RealTimeData_ConvertibleBond': source_range_convertible_bond, 'Underlying_Values': source_range_underlyings}
+source_columns = {'RealTimeData_ConvertibleBond': convertible_bond_columns, 'Underlying_Values': underlying_columns}
+quote_max_workers = 8   # number of quote requests in flight at the same time
+quote_rate_limit = 20   # max quote requests per second sent to the data source
+quote_timeout = 10   # timeout of each quote request, in seconds
+quote_retries = 3   # replays of a failed quote request, with exponential backoff
+token_manager = TokenManager(token_cache_path)   # xq_a_token kept with its expiry between runs
+snowball_transport = None   # session shared by all refreshes, built on the first one, see get_quote_fetcher
+quote_cache = QuoteCache(max_entries=5000)   # quotes shared by all refresh buttons, only stale symbols go to the network
+history_dir = 'history'   # local cache of the daily k-line history of the underlyings
+realized_volatility_window = 250   # trading days of the realized volatility, i.e., the last 12 months
+volatility_engine = VolatilityEngine(history_dir)   # rolling windows updated with the new bars only
+convertible_bond_model = 'bs'   # 'lattice' to value the CBs on a lattice with their soft call, put and conversion, see pipeline.price_underlying_table
+kmv_calibrator = KMVCalibrator(os.path.join(history_dir, 'kmv.json'))   # asset values and volatilities of the issuers, first iterates of the next DtD calibration
+yield_curve_path = 'yield_curve.csv'   # yield curves of the bond floors, see yield_curve.example.csv. The sheet values are used without it
+bond_terms_path = 'bond_terms.csv'   # coupon terms of the CBs, see bond_terms.example.csv
+bond_floor_engine = None   # built on the first refresh, see get_bond_floor_engine
+snapshot_store = SnapshotStore('snapshots')   # history of the CB and stock tables, one snapshot per refresh
+metrics_dir = 'metrics'   # Prometheus text file and JSON summary of the last run, written when the metrics are enabled
+metrics_port = int(os.environ.get('AUTOARBITRAGE_METRICS_PORT', 0))   # serve /metrics and /summary on this port, 0 for no server
+alert_sinks = [{'type': 'stdout'}, {'type': 'file', 'path': 'alerts.jsonl'}]   # notifications of the alert rules while streaming, see alerts.py
+alert_webhook = os.environ.get('AUTOARBITRAGE_ALERT_WEBHOOK')   # also POST the alerts to this address, e.g. http://127.0.0.1:8080/alerts
+trading_calendar = TradingCalendar()   # exchange holidays, computed once per year into ~/.autoarbitrage/trading_calendar.json
+latest_tables = {}   # last CB and stock tables and rankings by sheet or strategy name, served warm by server.py
 
 
 @xlwings.func
-# Get xq_a_token from data source xueqiu.com
+# Get xq_a_token from data source xueqiu.com: from the token file on warm runs, the browser cookies are read only
+# when it is missing or expired, see credentials.TokenManager
 def get_xq_a_token():
-    str_xq_a_token = ';'
-    while True:
-        cj = browser_cookie3.load()
-        for item in cj:
-            if item.name == "xq_a_token":
-                print('get token, %s = %s' % (item.name, item.value))
-                str_xq_a_token = 'xq_a_token=' + item.value + ';'
-                return str_xq_a_token
-        if str_xq_a_token == ";":
-            print('get token, retrying ......')
-            webbrowser.open("https://xueqiu.com/")
-            time.sleep(60)  # Sleep after 60s retries
+    return token_manager.cookie()
+
+
+# Build the concurrent quote fetcher over the session shared by all refreshes: one keep-alive connection pool,
+# the token is renewed and the requests replayed when the data source rejects it (400016)
+def get_quote_fetcher(token=None):
+    """
+    token: cookie string of a one-off session, None for the shared session
+    """
+    global snowball_transport
+    if token is not None:
+        return QuoteFetcher(SnowballTransport(token, pool_size=quote_max_workers), max_workers=quote_max_workers,
+                            rate_limit=quote_rate_limit, timeout=quote_timeout)
+    if snowball_transport is None:
+        snowball_transport = SnowballTransport(token_manager, pool_size=quote_max_workers, retries=quote_retries)
+    return QuoteFetcher(snowball_transport, max_workers=quote_max_workers, rate_limit=quote_rate_limit,
+                        timeout=quote_timeout, close_transport=False)
+
+
+# Get the bond floor engine, None without a yield curve file: 'Straight Bond Value' and 'Interest Rate' stay hand-maintained
+def get_bond_floor_engine():
+    global bond_floor_engine
+    if bond_floor_engine is None and os.path.isfile(yield_curve_path):
+        bond_floor_engine = BondFloorEngine(yield_curve_path, bond_terms_path if os.path.isfile(bond_terms_path) else None)
+    return bond_floor_engine
+
+
+# Refresh the straight bond values of the stock table, the CB quotes come from the cache when the CBs were just refreshed
+def refresh_straight_bond_value(data_stock, quote_fetcher):
+    engine = get_bond_floor_engine()
+    if engine is None:
+        return data_stock
+    bond_details = quote_cache.get_many([get_bond_symbol(fund_code) for fund_code in data_stock['Quote']], bond_floor_fields, quote_fetcher)
+    return fill_straight_bond_value(data_stock, engine, bond_details)
+
+
+# Read a source table from its sheet, see pipeline.convertible_bond_columns and pipeline.underlying_columns
+def read_source_table(sheet):
+    source_range = source_ranges[sheet.name] + str(sheet.used_range.last_cell.row)  # Returns the bottom right cell of the specified range. Read-only.
+    print('Data Sheet Range：' + source_range)
+    data = pandas.DataFrame(sheet.range(source_range).value, columns=source_columns[sheet.name])
+    return get_typed_table(data, source_columns[sheet.name])  # '停牌' cells -> NaN and the Suspended mask
 
 
 @xlwings.func
@@ -42,163 +108,41 @@ def get_xq_a_token():
 def refresh_convertible_bond():
 
     print("------------ Refresh Convertible Bond Data ------------")
+    metrics.start_run('refresh_convertible_bond')
     xlwings.Book("AutoArbitrage.xlsm").set_mock_caller()
     wb = xlwings.Book.caller()
     pandas.options.display.max_columns = None
     pandas.options.display.max_rows = None
-    pysnowball.set_token(get_xq_a_token())
+    with metrics.timer('token'):
+        token = get_xq_a_token()
+        pysnowball.set_token(token)
+        quote_fetcher = get_quote_fetcher()
 
     source_sheets = 'RealTimeData_ConvertibleBond'
     sheet_fund = wb.sheets[source_sheets]
-    source_range = source_range_convertible_bond + str(sheet_fund.used_range.last_cell.row)  # Returns the bottom right cell of the specified range. Read-only.
-    print('Data Sheet Range：' + source_range)
-    data_fund = pandas.DataFrame(sheet_fund.range(source_range).value,
-                                 columns=['Quote', 'Name', 'Current', 'Change', 'Conversion Price', 'Conversion Value', 'Premium Rate', 'Double Low',        # columns=['转债代码', '转债名称', '当前价', '涨跌幅', '转股价', '转股价值', '溢价率', '双低值',
-                                          'Issue Date', 'Maturity Date', 'Remain Year', 'Outstanding Amount (m)', 'Amount (k)', 'Turnover Rate',    # '发行时间', '到期时间', '剩余年限', '剩余规模', '成交金额', '换手率', '税前收益', '最高价', '最低价',
-                                          'Benefit Before Tax', 'Day High', 'Day Low', 'Amplitude', 'Stock Quote']  # '振幅', '正股代码']
-                                 )  # Build up the CB table, with CBs in raws and their data in columns.
-    refresh_time = str(time.strftime("%Y%m%d-%H.%M.%S", time.localtime()))  # set the formate of refresh time
+    data_fund = read_source_table(sheet_fund)  # Build up the CB table, with CBs in raws and their data in columns.
+    snapshot_time = time.time()
+    refresh_time = str(time.strftime("%Y%m%d-%H.%M.%S", time.localtime(snapshot_time)))  # set the formate of refresh time
     sheet_fund.range('S4').value = 'T_refresh:' + refresh_time  # mark the refresh time in excel
-    log_file = open('log_' + source_sheets + '_' + refresh_time +
-                    '.txt', 'a+', encoding='utf-8')  # Create a log file "log_RealTimeData_ConvertibleBond_"
-
-    for i, fund_code in enumerate(data_fund['Quote']):
-        if str(fund_code).startswith('11') or str(fund_code).startswith('13'):
-            fund_code_str = ('SH' + str(fund_code))[0:8]  # SH
-        elif str(fund_code).startswith('12'):
-            fund_code_str = ('SZ' + str(fund_code))[0:8]  # SZ
-        detail = pandas.DataFrame(pysnowball.quote_detail(fund_code_str))  # Get all available data of the bond from the data source
-        row1 = detail.loc["quote"][0]
-        data_fund.loc[i, 'Name'] = row1["name"] # write the data into data_fund
-        data_fund.loc[i, 'Current'] = row1["current"]
-        data_fund.loc[i, 'Change'] = row1["percent"] / 100 if row1["percent"] != None else '停牌'  # ‘suspended’
-        data_fund.loc[i, 'Conversion Price'] = row1["conversion_price"]
-        data_fund.loc[i, 'Conversion Value'] = row1["conversion_value"]
-        data_fund.loc[i, 'Premium Rate'] = row1["premium_rate"] if row1["premium_rate"] != None else '停牌' # ‘suspended’
-        data_fund.loc[i, 'Double Low'] = row1["current"] + row1["premium_rate"]  
-        data_fund.loc[i, 'Issue Date'] = str(time.strftime("%Y-%m-%d", time.localtime(row1["issue_date"]/1000)))
-        data_fund.loc[i, 'Maturity Date'] = str(time.strftime("%Y-%m-%d", time.localtime(row1["maturity_date"]/1000)))
-        data_fund.loc[i, 'Remain Year'] = row1["remain_year"]
-        data_fund.loc[i, 'Outstanding Amount (m)'] = row1["outstanding_amt"] / 1000000 if row1["outstanding_amt"] != None else 1
-        data_fund.loc[i, 'Amount (k)'] = row1["amount"] / 1000 if row1["amount"] != None else 0
-        data_fund.loc[i, 'Turnover Rate'] = (data_fund.loc[i, 'Amount (k)'] / 1000 / row1["current"]) / (data_fund.loc[i, 'Outstanding Amount (m)'] / 100)
-        data_fund.loc[i, 'Benefit Before Tax'] = row1["benefit_before_tax"] / 100 if row1["benefit_before_tax"] != None else '停牌'
-        data_fund.loc[i, 'Day High'] = row1["high"]
-        data_fund.loc[i, 'Day Low'] = row1["low"]
-        if row1["high"] and row1["low"]:
-            data_fund.loc[i, 'Amplitude'] = (row1["high"] - row1["low"]) / row1["low"]
-        else:
-            data_fund.loc[i, 'Amplitude'] = '停牌'
-        log_str = format(str(i+1), "<5") + format(str(fund_code_str), "<10") \
-                  + format(data_fund.loc[i, 'Name'], "<10") \
-                  + 'Current: ' + format(str(row1["current"]), "<10") \
-                  + 'Daily Trend(%): ' + format(str(row1["percent"]), "<10") \
-                  + 'Premium Rate(%): ' + format(str(row1["premium_rate"]), "<10")
-        data_fund.loc[i, 'Stock Quote'] = row1["underlying_symbol"]  # get the underlying stock quote
-        print(log_str)   # display the key data in the console: name, current, Premium rate, daily trend
-        print(log_str, file=log_file)  # save the log into txt
-
-    data_fund = data_fund.sort_values(by='Premium Rate')  # sort all bonds by Preimum rate, ascending
-    data_fund.reset_index(drop=True, inplace=True)
-    data_fund.index += 1
-    print(data_fund)
-    print(data_fund, file=log_file)
-
-    log_file.close()
-    sheet_fund.range('A7').value = data_fund     # update the Excel sheet
-    
-    data_stock_destination = data_fund[[
-        'Quote', 'Name', 'Current', 'Conversion Price', 'Conversion Value', 'Remain Year', 'Premium Rate', 'Stock Quote']]
-    data_stock_destination = data_stock_destination.sort_values(by='Quote')  # sort all bonds by Quote, ascending     
-    sheet_dest = wb.sheets['Underlying_Values'] # Save the above selected data into 'Underlying_Values' sheet
-    sheet_dest.range('A7').value = data_stock_destination[:30]
-    wb.save()    
 
+    fund_code_strs = [get_bond_symbol(fund_code) for fund_code in data_fund['Quote']]
+    with metrics.timer('fetch bonds'):
+        details = quote_cache.get_many(fund_code_strs, 'realtime', quote_fetcher)  # Get all available data of the bonds from the data source, concurrently
+    quote_fetcher.close()
+    print('Quote Cache：' + str(quote_cache.stats()))
 
-# Calculate Option value based on Black-Scholes model
-def bs_option(S, K, T, r, q, sigma, option='call'):
-    """
-    S: spot price of the underlying stock
-    K: strike price, i.e., the conversion price of Convertible Bonds
-    T: time to maturity, the remain year of the bonds
-    r: risk-free interest rate, here refer to the GCNY10, China 10-Year Government Bond Yield
-    q: rate of continuous dividend, of the underlying stock
-    sigma: standard deviation of price of underlying asset, based on the historical prices in the last 12 months
-    """
-    d1 = (np.log(S/K) + (r - q + 0.5*sigma**2)*T)/(sigma*np.sqrt(T))
-    d2 = (np.log(S/K) + (r - q - 0.5*sigma**2)*T)/(sigma*np.sqrt(T)) # d2 = d1 - sigma*np.sqrt(T)
-
-    if option == 'call':
-        p = (S*np.exp(-q*T)*norm.cdf(d1, 0.0, 1.0) - K*np.exp(-r*T)*norm.cdf(d2, 0.0, 1.0))       
-    elif option == 'put':
-        p = (K*np.exp(-r*T)*norm.cdf(-d2, 0.0, 1.0) - S*np.exp(-q*T)*norm.cdf(-d1, 0.0, 1.0))
-    else:
-        return None
-    return d1, d2, p
-
-# Calculate implied volatility based on Bisection method
-def implied_volatility(P, S, K, T, r, q, option='call'):
-    sigma_min = 0.00001
-    sigma_max = 1.000
-    sigma_mid = (sigma_min + sigma_max) / 2
+    with metrics.timer('build CB table'):
+        data_fund = build_convertible_bond_table(data_fund, details)  # display the key data in the console: name, current, Premium rate, daily trend
+    print(data_fund)
+    snapshot_store.append(source_sheets, data_fund, snapshot_time)  # save the table into the snapshot store
+    latest_tables[source_sheets] = data_fund
+    sheet_fund.range('A7').value = get_display_table(data_fund)     # update the Excel sheet, '停牌' for the suspended CBs
     
-    if option == 'call':
-        p_min = bs_option(S, K, T, r, q, sigma_min, option='call')[2]
-        p_max = bs_option(S, K, T, r, q, sigma_max, option='call')[2]
-        p_mid = bs_option(S, K, T, r, q, sigma_mid, option='call')[2]
-        diff = P - p_mid
-        
-        # if P < p_min or P > p_max:
-            # print('Attention, Option Price is beyond the limit, "American Option Case"')
-        
-        Count = 0
-        while abs(diff) > 1e-6:
-            if P > p_mid:
-                sigma_min = sigma_mid
-            else:
-                sigma_max = sigma_mid
-            sigma_mid = (sigma_min + sigma_max) / 2
-            p_mid = bs_option(S, K, T, r, q, sigma_mid, option='call')[2]
-            diff = P - p_mid
-            Count += 1
-            if Count > 100:  
-                sigma_mid = 0
-                return sigma_mid
-    else:
-        p_min = bs_option(S, K, T, r, q, sigma_min, option='put')[2]
-        p_max = bs_option(S, K, T, r, q, sigma_max, option='put')[2]
-        p_mid = bs_option(S, K, T, r, q, sigma_mid, option='put')[2]
-        diff = P - p_mid
-        
-        if P < p_min or P > p_max:
-            print('Attention, Option Price is beyond the limit, "American Option Case"')
-        
-        while abs(diff) > 1e-6:
-            if P > p_mid:
-                sigma_min = sigma_mid
-            else:
-                sigma_max = sigma_mid
-            sigma_mid = (sigma_min + sigma_max) / 2
-            p_mid = bs_option(S, K, T, r, q, sigma_mid, option='put')[2]
-            diff = P - p_mid
-            Count += 1
-            if Count > 100:  
-                sigma_mid = 1
-                return sigma_mid           
-    return sigma_mid
-
-# Calculate Distance to Default based on Merton Model
-def Merton_DtD(S,K,T,r,q,sigma):
-    """
-    S: spot conversion value of the Convertible Bonds
-    K: Pure bond value of the Convertible Bonds
-    T: time to maturity, the remain year of the bonds
-    r: risk-free interest rate, here refer to the GCNY10, China 10-Year Government Bond Yield
-    q: rate of continuous dividend, of the underlying stock
-    sigma: standard deviation of price of underlying asset, based on the historical prices in the last 12 months
-    """
-    DtD = (np.log(S/K) + (r - q - 0.5*sigma**2)*T)/(sigma*np.sqrt(T))
-    return DtD
+    sheet_dest = wb.sheets['Underlying_Values'] # Save the above selected data into 'Underlying_Values' sheet
+    sheet_dest.range('A7').value = get_display_table(select_underlyings(data_fund, rows=30))
+    with metrics.timer('save'):
+        wb.save()
+    metrics.write(metrics_dir, quote_cache=quote_cache.stats())
 
 
 @xlwings.func
@@ -207,378 +151,288 @@ def Merton_DtD(S,K,T,r,q,sigma):
 # Including stock price, dividend, volatility, Option value, Pure bond value, Putable price, Callable Price, bias, etc.
 def refresh_underlying_values():
     print("------------ Refresh Underlying Values ------------")
+    metrics.start_run('refresh_underlying_values')
     xlwings.Book("AutoArbitrage.xlsm").set_mock_caller()
     wb = xlwings.Book.caller()
     pandas.options.display.max_columns = None
     pandas.options.display.max_rows = None
-    pysnowball.set_token(get_xq_a_token())
+    with metrics.timer('token'):
+        token = get_xq_a_token()
+        pysnowball.set_token(token)
+        quote_fetcher = get_quote_fetcher()
 
     source_sheets = 'Underlying_Values'
     sheet_stock = wb.sheets[source_sheets]
-    source_range = source_range_underlyings + str(sheet_stock.used_range.last_cell.row)  # Returns the bottom right cell of the specified range. Read-only.
-    print('Data Sheet Range：' + source_range)
-    data_stock = pandas.DataFrame(sheet_stock.range(source_range).value,
-                                  columns=['Quote', 'Name', 'Current', 'Conversion Price', 'Conversion Value', 'Remain Year', 
-                                           'Premium Rate', 'Stock Quote', 'Stock Name', 'Stock Current', 'Dividend', 
-                                          'Interest Rate', 'Realized Volatility', 'Implied Volitality', 'Differential Volitality', 
-                                          'Putable Price', 'Callable Price', 'Straight Bond Value', 'Option Value', 'Option Price', 
-                                          'Theoretical Value', 'Bias', 'DtD']
-                                  )  # Build up the stock table, with stocks in raws and their data in columns.
-    # data_stock = data_stock.loc[:,['Quote', 'Name', 'Current', 'Stock Quote', 'Stock Name', 'Stock Current',
-    #           'Conversion Price', 'Conversion Value', 'Premium Rate', 'Remain Year',
-    #         'Dividend', 'Interest Rate', 'Volatility', 'Implied Volitality', 'Diff Volitality',
-    #         'Putable Price', 'Callable Price', 'Pure Bond Value', 'Option Value', 'Option Price',
-    #         'Theoretical Value', 'Bias', 'DtD']]
-    refresh_time = str(time.strftime("%Y%m%d-%H.%M.%S", time.localtime()))  # set the formate of refresh time
+    data_stock = read_source_table(sheet_stock)  # Build up the stock table, with stocks in raws and their data in columns.
+    snapshot_time = time.time()
+    refresh_time = str(time.strftime("%Y%m%d-%H.%M.%S", time.localtime(snapshot_time)))  # set the formate of refresh time
     sheet_stock.range('G4').value = 'T_refresh:' + refresh_time  # mark the refresh time in excel
-    for i, stock_code in enumerate(data_stock['Stock Quote']):
-        detail = pandas.DataFrame(pysnowball.quote_detail(stock_code))  # # Get all available data of the bond from the data source
-        row2 = detail.loc["quote"][0]
-        
-        data_stock.loc[i, 'Stock Name'] = row2["name"] # Write the data into data_stock
-        data_stock.loc[i, 'Stock Current'] = row2["current"]
-        data_stock.loc[i, 'Dividend'] = row2["dividend_yield"] 
-        data_stock.loc[i, 'Option Value'] = 100 / data_stock.loc[i, 'Conversion Price'] * bs_option(row2["current"], data_stock.loc[i, 'Conversion Price'], data_stock.loc[i, 'Remain Year'], data_stock.loc[i,'Interest Rate']/100, row2["dividend_yield"]/100, data_stock.loc[i, 'Realized Volatility']/100, option='call')[2]  # Calculate the BS option price
-        data_stock.loc[i, 'Option Price'] = (data_stock.loc[i, 'Current'] - data_stock.loc[i, 'Straight Bond Value']) 
-        data_stock.loc[i, 'Implied Volitality'] = 100*implied_volatility(data_stock.loc[i, 'Option Price'] * data_stock.loc[i, 'Conversion Price'] / 100, row2["current"], data_stock.loc[i, 'Conversion Price'], \
-                                                                     data_stock.loc[i, 'Remain Year'], data_stock.loc[i, 'Interest Rate'] / 100, \
-                                                                     row2["dividend_yield"] / 100, option='call')
-        data_stock.loc[i, 'Differential Volitality'] = (data_stock.loc[i, 'Implied Volitality'] - data_stock.loc[i, 'Realized Volatility']) / 100
-        data_stock.loc[i, 'DtD'] = Merton_DtD(data_stock.loc[i, 'Conversion Value'],data_stock.loc[i, 'Straight Bond Value'],  \
-                                              data_stock.loc[i, 'Remain Year'], data_stock.loc[i, 'Interest Rate'] / 100, \
-                                              row2["dividend_yield"] / 100, data_stock.loc[i, 'Realized Volatility'] / 100)
-        data_stock.loc[i, 'Theoretical Value'] = data_stock.loc[i, 'Straight Bond Value'] + data_stock.loc[i, 'Option Value']
-        data_stock.loc[i, 'Bias'] = data_stock.loc[i, 'Current'] / data_stock.loc[i, 'Theoretical Value'] - 1
-        log_str = format(str(i+1), "<5") + format(data_stock.loc[i, 'Name'], "<10") \
-              + 'Option Value: ' + format(data_stock.loc[i, 'Option Value'], '<10.2f') \
-              + 'Bond Value: ' + format(data_stock.loc[i, 'Straight Bond Value'], "<10.2f") \
-              + 'Diff Vol.: ' + format(data_stock.loc[i, 'Differential Volitality'], "<10.2f") \
-              + 'DtD: ' + format(data_stock.loc[i, "DtD"], "<10.2f") \
-              + 'Bias: ' + format(data_stock.loc[i, 'Bias'], "<10.2%")  # display the key data in the console: Quote, CB current, Stock current, Option value
-        print(log_str)        
-
-    data_stock = data_stock.sort_values(by='Quote')  # sort bt Quote, ascending
-
-    data_stock.reset_index(drop=True, inplace=True)
-    data_stock.index += 1
-    
-    sheet_stock.range('A7').value = data_stock
-    wb.save()    
-
-
-@xlwings.func
-# Refresh CB ranking based on [Low Premium Rate] Strategy
-def refresh_premium_rate():
-    print("------------ Refresh Ranking: [Low Premium Rate] Strategy ------------")
+    with metrics.timer('fetch stocks'):
+        details = quote_cache.get_many(data_stock['Stock Quote'], 'realtime', quote_fetcher)  # Get all available data of the stocks from the data source, concurrently, each stock once
+    with metrics.timer('realized volatility'):
+        data_stock = fill_realized_volatility(data_stock, volatility_engine, get_kline_fetcher(quote_fetcher), realized_volatility_window)
+    with metrics.timer('straight bond value'):
+        data_stock = refresh_straight_bond_value(data_stock, quote_fetcher)  # bond floors of all CBs in one discount, see bondfloor.py
+    quote_fetcher.close()
+    print('Quote Cache：' + str(quote_cache.stats()))
+
+    with metrics.timer('pricing'):
+        data_stock = build_underlying_table(data_stock, details, model=convertible_bond_model, calibrator=kmv_calibrator)  # Calculate Option value, implied volatility, DtD and bias, see pipeline.py
+    kmv_calibrator.prune(data_stock['Quote'])
+    kmv_calibrator.save()
+    snapshot_store.append(source_sheets, data_stock, snapshot_time)
+    latest_tables[source_sheets] = data_stock
+    sheet_stock.range('A7').value = get_display_table(data_stock)
+    with metrics.timer('save'):
+        wb.save()
+    metrics.write(metrics_dir, quote_cache=quote_cache.stats())
+
+
+# Refresh the CB ranking of one strategy in the excel, see strategies.strategy_specs
+def refresh_strategy(name):
+    spec = strategy_specs[name]
+    print("------------ Refresh Ranking: " + spec['title'] + " ------------")
     xlwings.Book("AutoArbitrage.xlsm").set_mock_caller()
     wb = xlwings.Book.caller()
     pandas.options.display.max_columns = None
     pandas.options.display.max_rows = None
 
-    sheet_src = wb.sheets['RealTimeData_ConvertibleBond']
-    source_range = source_range_convertible_bond + str(sheet_src.used_range.last_cell.row)
-    data_fund_source = pandas.DataFrame(sheet_src.range(source_range).value,
-                                       columns=['Quote', 'Name', 'Current', 'Change', 'Conversion Price', 'Conversion Value', 'Premium Rate', 'Double Low',        # columns=['转债代码', '转债名称', '当前价', '涨跌幅', '转股价', '转股价值', '溢价率', '双低值',
-                                                'Issue Date', 'Maturity Date', 'Remain Year', 'Outstanding Amount (m)', 'Amount (k)', 'Turnover Rate',    # '发行时间', '到期时间', '剩余年限', '剩余规模', '成交金额', '换手率', '税前收益', '最高价', '最低价',
-                                                'Benefit Before Tax', 'Day High', 'Day Low', 'Amplitude', 'Stock Quote'])
-    data_fund_destination = data_fund_source[['Quote','Name','Current','Premium Rate','Outstanding Amount (m)']]
-    data_fund_destination = data_fund_destination[(data_fund_destination['Current'] < sheet_src.range('D2').value) &
-                                                  (data_fund_destination['Premium Rate'] < sheet_src.range('H2').value) &
-                                                  (data_fund_destination['Outstanding Amount (m)'] < sheet_src.range('M2').value)]
-    data_fund_destination = data_fund_destination.sort_values(by='Premium Rate')
-    data_fund_destination.reset_index(drop=True, inplace=True)
-    data_fund_destination.index += 1
+    sheet_src = wb.sheets[spec['source']]
+    data_fund_source = read_source_table(sheet_src)
+    data_fund_destination = rank_strategy(name, data_fund_source, get_parameter_cells(sheet_src.range(parameter_range).value))  # get the threhold and weight parameters
     print(data_fund_destination)
+    latest_tables[name] = data_fund_destination
 
-    sheet_dest = wb.sheets['Singlefactor Strategies']     # Update Excel sheet: 'Singlefactor Strategies'
-    sheet_dest.range('J2').value = data_fund_destination[:20]
+    sheet_dest = wb.sheets[spec['destination'][0]]     # Update Excel sheet: 'Singlefactor Strategies' or 'Multifactor Strategies'
+    sheet_dest.range(spec['destination'][1]).value = data_fund_destination
     wb.save()
 
+
+# Write all output blocks in one batched update: screen updating and recalculation are paused until the end
+def write_blocks(wb, blocks):
+    """
+    blocks: list of (sheet name, top left cell, value)
+    """
+    app = wb.app
+    screen_updating, calculation = app.screen_updating, app.calculation
+    app.screen_updating = False
+    app.calculation = 'manual'
+    try:
+        for sheet_name, cell, value in blocks:
+            wb.sheets[sheet_name].range(cell).value = value
+    finally:
+        app.calculation = calculation
+        app.screen_updating = screen_updating
+
+
 @xlwings.func
-# Refresh CB ranking based on [Low Current Price + Low Premium Rate * 100] Strategy
-def refresh_DoubleLow():
-    print("------------ Refresh Ranking: [Double Low] Strategy ------------")
-    xlwings.Book("AutoArbitrage.xlsm").set_mock_caller()
-    wb = xlwings.Book.caller()
+# Refresh everything in a single pass: read every source table and all parameter cells once, refresh the CBs and
+# the underlyings, rank all strategies from that snapshot, then write all output blocks and save once
+def refresh_all(refresh_quotes=True, names=None):
+    """
+    refresh_quotes: fetch new quotes and re-price the underlyings, otherwise rank the tables as they are in the sheets
+    names: strategies to rank, see strategies.strategy_specs, None for all
+    """
+    print("------------ Refresh All ------------")
+    metrics.start_run('refresh_all')
+    if metrics.enabled and metrics_port:
+        metrics.serve(metrics_port)
+    timer = StageTimer()   # every stage is also recorded in the metrics, see pipeline.StageTimer
+    with timer.stage('open workbook'):
+        xlwings.Book("AutoArbitrage.xlsm").set_mock_caller()
+        wb = xlwings.Book.caller()
     pandas.options.display.max_columns = None
     pandas.options.display.max_rows = None
 
-    sheet_src = wb.sheets['RealTimeData_ConvertibleBond']
-    source_range = source_range_convertible_bond + str(sheet_src.used_range.last_cell.row)
-    data_fund_source = pandas.DataFrame(sheet_src.range(source_range).value,
-                                       columns=['Quote', 'Name', 'Current', 'Change', 'Conversion Price', 'Conversion Value', 'Premium Rate', 'Double Low',        # columns=['转债代码', '转债名称', '当前价', '涨跌幅', '转股价', '转股价值', '溢价率', '双低值',
-                                                'Issue Date', 'Maturity Date', 'Remain Year', 'Outstanding Amount (m)', 'Amount (k)', 'Turnover Rate',    # '发行时间', '到期时间', '剩余年限', '剩余规模', '成交金额', '换手率', '税前收益', '最高价', '最低价',
-                                                'Benefit Before Tax', 'Day High', 'Day Low', 'Amplitude', 'Stock Quote'])
-    data_fund_destination = data_fund_source[['Quote','Name','Current','Premium Rate','Double Low','Outstanding Amount (m)']]
-    data_fund_destination = data_fund_destination[(data_fund_destination['Current'] < sheet_src.range('D3').value) &
-                                                  (data_fund_destination['Premium Rate'] < sheet_src.range('H3').value) &
-                                                  (data_fund_destination['Outstanding Amount (m)'] < sheet_src.range('M3').value)]
-    data_fund_destination = data_fund_destination[['Quote','Name','Current','Double Low','Outstanding Amount (m)']]
-    data_fund_destination = data_fund_destination.sort_values(by='Double Low')
-    data_fund_destination.reset_index(drop=True, inplace=True)
-    data_fund_destination.index +=1
-    print(data_fund_destination)
+    with timer.stage('read sheets'):
+        sheet_fund = wb.sheets['RealTimeData_ConvertibleBond']
+        sheet_stock = wb.sheets['Underlying_Values']
+        data_fund = read_source_table(sheet_fund)
+        data_stock = read_source_table(sheet_stock)
+        parameters = {sheet.name: get_parameter_cells(sheet.range(parameter_range).value, parameter_range.split(':')[0])
+                      for sheet in (sheet_fund, sheet_stock)}
+    blocks = []
+
+    if refresh_quotes:
+        with timer.stage('token'):
+            token = get_xq_a_token()
+            pysnowball.set_token(token)
+            quote_fetcher = get_quote_fetcher()
+        snapshot_time = time.time()
+        refresh_time = str(time.strftime("%Y%m%d-%H.%M.%S", time.localtime(snapshot_time)))  # set the formate of refresh time
+
+        print("------------ Refresh Convertible Bond Data ------------")
+        with timer.stage('fetch bonds'):
+            details = quote_cache.get_many([get_bond_symbol(fund_code) for fund_code in data_fund['Quote']], 'realtime', quote_fetcher)
+        with timer.stage('build CB table'):
+            data_fund = build_convertible_bond_table(data_fund, details)
+
+        print("------------ Refresh Underlying Values ------------")
+        data_stock = overlay_underlyings(data_stock, select_underlyings(data_fund, rows=30))
+        with timer.stage('fetch stocks'):
+            details = quote_cache.get_many(data_stock['Stock Quote'], 'realtime', quote_fetcher)
+        with timer.stage('realized volatility'):
+            data_stock = fill_realized_volatility(data_stock, volatility_engine, get_kline_fetcher(quote_fetcher), realized_volatility_window)
+        with timer.stage('straight bond value'):
+            data_stock = refresh_straight_bond_value(data_stock, quote_fetcher)
+        quote_fetcher.close()
+        print('Quote Cache：' + str(quote_cache.stats()))
+        with timer.stage('pricing'):
+            data_stock = build_underlying_table(data_stock, details, model=convertible_bond_model, calibrator=kmv_calibrator)
+            kmv_calibrator.prune(data_stock['Quote'])
+            kmv_calibrator.save()
+        with timer.stage('snapshot'):
+            snapshot_store.append(sheet_fund.name, data_fund, snapshot_time)
+            snapshot_store.append(sheet_stock.name, data_stock, snapshot_time)
+        blocks += [(sheet_fund.name, 'S4', 'T_refresh:' + refresh_time), (sheet_fund.name, 'A7', get_display_table(data_fund)),
+                   (sheet_stock.name, 'G4', 'T_refresh:' + refresh_time), (sheet_stock.name, 'A7', get_display_table(data_stock))]
+
+    rankings = rank_strategies(data_fund, data_stock, parameters, names=names, timer=timer)
+    blocks += [(*strategy_specs[name]['destination'], table) for name, table in rankings.items()]
+    latest_tables.update({sheet_fund.name: data_fund, sheet_stock.name: data_stock, **rankings})
+    with timer.stage('write'):
+        write_blocks(wb, blocks)
+    with timer.stage('save'):
+        wb.save()
+    print("------------ Refresh Time ------------")
+    print(timer.report())
+    metrics.write(metrics_dir, quote_cache=quote_cache.stats())
+    return timer
 
-    sheet_dest = wb.sheets['Singlefactor Strategies']     # Update Excel sheet: 'Singlefactor Strategies'
-    sheet_dest.range('R2').value = data_fund_destination[:20]
-    wb.save()
 
 @xlwings.func
-# Refresh CB ranking based on [Highest Differential Volatility] Strategy
-def refresh_diff_volatility():
-    print("------------ Refresh Ranking: [High Differential Volatility] Strategy ------------")
+# Keep the sheets fresh in trading hours: after a full refresh, poll the real-time quotes every few seconds and
+# re-compute only the CBs and underlyings whose prices changed, then write the tables and rankings that moved
+def refresh_streaming(interval=streaming_interval, until='15:00', full_refresh=True):
+    """
+    interval: seconds between two polls
+    until: local time 'HH:MM' to stop streaming, the workbook is saved then
+    full_refresh: run refresh_all first, otherwise stream from the tables as they are in the sheets
+    """
+    if full_refresh:
+        refresh_all()
+    print("------------ Streaming ------------")
     xlwings.Book("AutoArbitrage.xlsm").set_mock_caller()
     wb = xlwings.Book.caller()
-    pandas.options.display.max_columns = None
-    pandas.options.display.max_rows = None
+    tables = {}
+    for sheet in (wb.sheets['RealTimeData_ConvertibleBond'], wb.sheets['Underlying_Values']):
+        data = read_source_table(sheet)
+        data = data[data['Quote'].notna()].reset_index(drop=True)
+        data.index += 1
+        tables[sheet.name] = (data, get_parameter_cells(sheet.range(parameter_range).value, parameter_range.split(':')[0]))
+    quote_fetcher = get_quote_fetcher()
+    streamer = StreamingRefresher(tables['RealTimeData_ConvertibleBond'][0], tables['Underlying_Values'][0],
+                                  {name: table[1] for name, table in tables.items()}, get_realtime_fetcher(quote_fetcher),
+                                  calibrator=kmv_calibrator, model=convertible_bond_model)
+
+    alert_engine = AlertEngine(get_alert_sinks(alert_sinks + ([{'type': 'webhook', 'url': alert_webhook}] if alert_webhook else [])),
+                               {name: table[1] for name, table in tables.items()})
+    alert_engine.submit({'RealTimeData_ConvertibleBond': streamer.data_fund, 'Underlying_Values': streamer.data_stock, **streamer.rankings})
+
+    board_sizes = {name: len(table) for name, table in streamer.rankings.items()}   # rows of the rankings in the sheets
+
+    def on_update(updated):
+        alert_engine.submit(updated)   # evaluated on the alert thread while the sheets are written
+        latest_tables.update(updated)
+        blocks = []
+        for name, table in updated.items():
+            if name in source_ranges:
+                snapshot_store.append(name, table)
+                blocks.append((name, 'A7', get_display_table(table)))
+            else:   # only the ranks that moved, see strategies.RankingIndex
+                blocks += get_ranking_blocks(strategy_specs[name], table, streamer.ranking_deltas.get(name, []), board_sizes[name])
+                board_sizes[name] = len(table)
+        write_blocks(wb, blocks)
+    try:
+        streamer.run(on_update, interval, stop=lambda: get_exchange_time().strftime('%H:%M') >= until, calendar=trading_calendar)
+    finally:
+        alert_engine.stop()
+        quote_fetcher.close()
+        wb.save()
 
-    sheet_src = wb.sheets['Underlying_Values']
-    source_range = source_range_underlyings + str(sheet_src.used_range.last_cell.row)
-    data_fund_source = pandas.DataFrame(sheet_src.range(source_range).value,
-                                       columns=['Quote', 'Name', 'Current', 'Conversion Price', 'Conversion Value', 'Remain Year', 
-                                                'Premium Rate', 'Stock Quote', 'Stock Name', 'Stock Current', 'Dividend', 
-                                               'Interest Rate', 'Realized Volatility', 'Implied Volitality', 'Differential Volitality', 
-                                               'Putable Price', 'Callable Price', 'Straight Bond Value', 'Option Value', 'Option Price', 
-                                               'Theoretical Value', 'Bias', 'DtD'])
-    data_fund_destination = data_fund_source[['Quote','Name','Current','Realized Volatility','Implied Volitality','Differential Volitality']]
-    data_fund_destination = data_fund_destination[(data_fund_destination['Current'] < sheet_src.range('D2').value) &
-                                                  (data_fund_destination['Implied Volitality'] > 0) &
-                                                  (data_fund_destination['Differential Volitality'] < sheet_src.range('P2').value)]
-    data_fund_destination = data_fund_destination.sort_values(by='Differential Volitality',ascending=True)
-    data_fund_destination.reset_index(drop=True, inplace=True)
-    data_fund_destination.index +=1
-    print(data_fund_destination)
 
-    sheet_dest = wb.sheets['Singlefactor Strategies']     # Update Excel sheet: 'Singlefactor Strategies'
-    sheet_dest.range('A20').value = data_fund_destination[:20]
-    wb.save()
+@xlwings.func
+# Refresh CB ranking based on [Low Premium Rate] Strategy
+def refresh_premium_rate():
+    refresh_strategy('premium_rate')
 
 @xlwings.func
-# Refresh CB ranking based on [Lowest Current Price / Theortical Value - 1 ] Strategy
-def refresh_Bias():
-    print("------------ Refresh Ranking: [Low Price/Value Bias] Strategy ------------")
-    xlwings.Book("AutoArbitrage.xlsm").set_mock_caller()
-    wb = xlwings.Book.caller()
-    pandas.options.display.max_columns = None
-    pandas.options.display.max_rows = None
+# Refresh CB ranking based on [Low Current Price + Low Premium Rate * 100] Strategy
+def refresh_DoubleLow():
+    refresh_strategy('DoubleLow')
 
-    sheet_src = wb.sheets['Underlying_Values']
-    source_range = source_range_underlyings + str(sheet_src.used_range.last_cell.row)
-    data_fund_source = pandas.DataFrame(sheet_src.range(source_range).value,
-                                       columns=['Quote', 'Name', 'Current', 'Conversion Price', 'Conversion Value', 'Remain Year', 
-                                                'Premium Rate', 'Stock Quote', 'Stock Name', 'Stock Current', 'Dividend', 
-                                               'Interest Rate', 'Realized Volatility', 'Implied Volitality', 'Differential Volitality', 
-                                               'Putable Price', 'Callable Price', 'Straight Bond Value', 'Option Value', 'Option Price', 
-                                               'Theoretical Value', 'Bias', 'DtD'])
-    data_fund_destination = data_fund_source[['Quote','Name','Current','Theoretical Value','Bias']]
-    data_fund_destination = data_fund_destination[(data_fund_destination['Current'] < sheet_src.range('D3').value) &
-                                                  (data_fund_destination['Bias'] < sheet_src.range('W3').value)]
-    data_fund_destination = data_fund_destination.sort_values(by='Bias')
-    data_fund_destination.reset_index(drop=True, inplace=True)
-    data_fund_destination.index +=1
-    print(data_fund_destination)
+@xlwings.func
+# Refresh CB ranking based on [Highest Differential Volatility] Strategy
+def refresh_diff_volatility():
+    refresh_strategy('diff_volatility')
 
-    sheet_dest = wb.sheets['Singlefactor Strategies']     # Update Excel sheet: 'Singlefactor Strategies'
-    sheet_dest.range('J20').value = data_fund_destination[:20]
-    wb.save()
+@xlwings.func
+# Refresh CB ranking based on [Lowest Current Price / Theortical Value - 1 ] Strategy
+def refresh_Bias():
+    refresh_strategy('Bias')
 
 @xlwings.func
 # Refresh CB ranking based on [Highest Distace to Default DtD] Strategy
 def refresh_DtD():
-    print("------------ Refresh Ranking: [Hight Distace to Default DtD] Strategy ------------")
-    xlwings.Book("AutoArbitrage.xlsm").set_mock_caller()
-    wb = xlwings.Book.caller()
-    pandas.options.display.max_columns = None
-    pandas.options.display.max_rows = None
-
-    sheet_src = wb.sheets['Underlying_Values']
-    source_range = source_range_underlyings + str(sheet_src.used_range.last_cell.row)
-    data_fund_source = pandas.DataFrame(sheet_src.range(source_range).value,
-                                       columns=['Quote', 'Name', 'Current', 'Conversion Price', 'Conversion Value', 'Remain Year', 
-                                                'Premium Rate', 'Stock Quote', 'Stock Name', 'Stock Current', 'Dividend', 
-                                               'Interest Rate', 'Realized Volatility', 'Implied Volitality', 'Differential Volitality', 
-                                               'Putable Price', 'Callable Price', 'Straight Bond Value', 'Option Value', 'Option Price', 
-                                               'Theoretical Value', 'Bias', 'DtD'])
-    data_fund_destination = data_fund_source[['Quote','Name','Current','Straight Bond Value','DtD']]
-    data_fund_destination = data_fund_destination[(data_fund_destination['Current'] < sheet_src.range('D4').value) &
-                                                  (data_fund_destination['Straight Bond Value'] < sheet_src.range('S4').value) &
-                                                  (data_fund_destination['DtD'] > sheet_src.range('X4').value)]
-    data_fund_destination = data_fund_destination.sort_values(by='DtD',ascending=False)
-    data_fund_destination.reset_index(drop=True, inplace=True)
-    data_fund_destination.index +=1
-    print(data_fund_destination)
-
-    sheet_dest = wb.sheets['Singlefactor Strategies']     # Update Excel sheet: 'Singlefactor Strategies'
-    sheet_dest.range('R20').value = data_fund_destination[:20]
-    wb.save()
+    refresh_strategy('DtD')
 
 @xlwings.func
 # General Button to refresh all single factor strategies in the sheet
 def refresh_singlefactor_strategies():
     
-    refresh_premium_rate()
-    refresh_DoubleLow()
-    refresh_diff_volatility()
-    refresh_Bias()
-    refresh_DtD()
-
-# Get the upper limits and weights of the trading strategies from excel
-def get_convertible_bond_factor(factor: str):
-    factor = factor.split('&', -1)
-    return float(factor[0]), float(factor[1])
+    refresh_all(refresh_quotes=False, names=['premium_rate', 'DoubleLow', 'diff_volatility', 'Bias', 'DtD'])
 
 @xlwings.func
 # update the CB ranking based on the strategy "multifactor1"
 def refresh_multifactor1_convertible_bond():
-    print("------------ Refresh Ranking: [Multifactor Model 1] Strategy ------------")
-    xlwings.Book("AutoArbitrage.xlsm").set_mock_caller()
-    wb = xlwings.Book.caller()
-    pandas.options.display.max_columns = None
-    pandas.options.display.max_rows = None
-    
-    sheet_src = wb.sheets['RealTimeData_ConvertibleBond']
-    source_range = source_range_convertible_bond + str(sheet_src.used_range.last_cell.row)
-    data_fund_source = pandas.DataFrame(sheet_src.range(source_range).value,
-                                 columns=['Quote', 'Name', 'Current', 'Change', 'Conversion Price', 'Conversion Value', 'Premium Rate', 'Double Low',        # columns=['转债代码', '转债名称', '当前价', '涨跌幅', '转股价', '转股价值', '溢价率', '双低值',
-                                          'Issue Date', 'Maturity Date', 'Remain Year', 'Outstanding Amount (m)', 'Amount (k)', 'Turnover Rate',    # '发行时间', '到期时间', '剩余年限', '剩余规模', '成交金额', '换手率', '税前收益', '最高价', '最低价',
-                                          'Benefit Before Tax', 'Day High', 'Day Low', 'Amplitude', 'Stock Quote']  # '振幅', '正股代码']
-                                 )
-    threshold_current_price, weight_current_price = get_convertible_bond_factor(sheet_src.range('D5').value) # get the threhold and weight parameters
-    threshold_premium_rate, weight_premium_rate = get_convertible_bond_factor(sheet_src.range('H5').value)
-    threshold_outstanding_amt, weight_outstanding_amt = get_convertible_bond_factor(sheet_src.range('M5').value)
-
-    for i, fund_code in enumerate(data_fund_source['Quote']):
-        data_fund_source.loc[i, 'multifactor1'] = data_fund_source.loc[i, 'Current'] * weight_current_price
-        + data_fund_source.loc[i, 'Premium Rate'] * weight_premium_rate
-        + data_fund_source.loc[i, 'Outstanding Amount (m)'] * weight_outstanding_amt
-    data_fund_destination = data_fund_source[['Quote', 'Name', 'Current', 'Premium Rate', 'Outstanding Amount (m)', 'multifactor1']]
-    data_fund_destination = data_fund_destination[(data_fund_destination['Current'] < threshold_current_price) &
-                                                  (data_fund_destination['Premium Rate'] < threshold_premium_rate) &
-                                                  (data_fund_destination['Outstanding Amount (m)'] < threshold_outstanding_amt)]
-    data_fund_destination = data_fund_destination.sort_values(by='multifactor1')
-    data_fund_destination.reset_index(drop=True, inplace=True)
-    data_fund_destination.index += 1
-    print(data_fund_destination)
-    
-    sheet_dest = wb.sheets['Multifactor Strategies']     # update the 'LowPremium_CB_Rotation' excel sheet
-    sheet_dest.range('H2').value = data_fund_destination[:20]
-    wb.save()
+    refresh_strategy('multifactor1')
 
 @xlwings.func
 # update the CB ranking based on the strategy "multifactor2"
 def refresh_multifactor2_convertible_bond():
-    print("------------ Refresh Ranking: [Multifactor Model 2] Strategy ------------")
-    xlwings.Book("AutoArbitrage.xlsm").set_mock_caller()
-    wb = xlwings.Book.caller()
-    pandas.options.display.max_columns = None
-    pandas.options.display.max_rows = None
-    
-    sheet_src = wb.sheets['RealTimeData_ConvertibleBond']
-    source_range = source_range_convertible_bond + str(sheet_src.used_range.last_cell.row)
-    data_fund_source = pandas.DataFrame(sheet_src.range(source_range).value,
-                                 columns=['Quote', 'Name', 'Current', 'Change', 'Conversion Price', 'Conversion Value', 'Premium Rate', 'Double Low',        # columns=['转债代码', '转债名称', '当前价', '涨跌幅', '转股价', '转股价值', '溢价率', '双低值',
-                                          'Issue Date', 'Maturity Date', 'Remain Year', 'Outstanding Amount (m)', 'Amount (k)', 'Turnover Rate',    # '发行时间', '到期时间', '剩余年限', '剩余规模', '成交金额', '换手率', '税前收益', '最高价', '最低价',
-                                          'Benefit Before Tax', 'Day High', 'Day Low', 'Amplitude', 'Stock Quote']  # '振幅', '正股代码']
-                                 )
-    threshold_current_price, weight_current_price = get_convertible_bond_factor(sheet_src.range('D6').value) # get the threhold and weight parameters
-    threshold_premium_rate, weight_premium_rate = get_convertible_bond_factor(sheet_src.range('H6').value)
-    threshold_outstanding_amt, weight_outstanding_amt = get_convertible_bond_factor(sheet_src.range('M6').value)
-
-    for i, fund_code in enumerate(data_fund_source['Quote']):
-        data_fund_source.loc[i, 'multifactor2'] = data_fund_source.loc[i, 'Current'] * weight_current_price
-        + data_fund_source.loc[i, 'Premium Rate'] * weight_premium_rate
-        + data_fund_source.loc[i, 'Outstanding Amount (m)'] * weight_outstanding_amt
-    data_fund_destination = data_fund_source[['Quote', 'Name', 'Current', 'Premium Rate', 'Outstanding Amount (m)', 'multifactor2']]
-    data_fund_destination = data_fund_destination[(data_fund_destination['Current'] < threshold_current_price) &
-                                                  (data_fund_destination['Premium Rate'] < threshold_premium_rate) &
-                                                  (data_fund_destination['Outstanding Amount (m)'] < threshold_outstanding_amt)]
-    data_fund_destination = data_fund_destination.sort_values(by='multifactor2')
-    data_fund_destination.reset_index(drop=True, inplace=True)
-    data_fund_destination.index += 1
-    print(data_fund_destination)
-    
-    sheet_dest = wb.sheets['Multifactor Strategies']     # update the 'LowPremium_CB_Rotation' excel sheet
-    sheet_dest.range('Q2').value = data_fund_destination[:20]
-    wb.save()
+    refresh_strategy('multifactor2')
 
 @xlwings.func
 # update the CB ranking based on the strategy "multifactor3"
 def refresh_multifactor3_convertible_bond():
-    print("------------ Refresh Ranking: [Multifactor Model 3] Strategy ------------")
-    xlwings.Book("AutoArbitrage.xlsm").set_mock_caller()
-    wb = xlwings.Book.caller()
-    pandas.options.display.max_columns = None
-    pandas.options.display.max_rows = None
-    
-    sheet_src = wb.sheets['Underlying_Values']
-    source_range = source_range_underlyings + str(sheet_src.used_range.last_cell.row)
-    data_fund_source = pandas.DataFrame(sheet_src.range(source_range).value,
-                                 columns=['Quote', 'Name', 'Current', 'Conversion Price', 'Conversion Value', 'Remain Year', 
-                                          'Premium Rate', 'Stock Quote', 'Stock Name', 'Stock Current', 'Dividend', 
-                                         'Interest Rate', 'Realized Volatility', 'Implied Volitality', 'Differential Volitality', 
-                                         'Putable Price', 'Callable Price', 'Straight Bond Value', 'Option Value', 'Option Price', 
-                                         'Theoretical Value', 'Bias', 'DtD']
-                                 )
-    threshold_Differential_Volitality, weight_Differential_Volitality = get_convertible_bond_factor(sheet_src.range('P6').value) # get the threhold and weight parameters
-    threshold_Bias, weight_Bias = get_convertible_bond_factor(sheet_src.range('W6').value)
-    threshold_DtD, weight_DtD = get_convertible_bond_factor(sheet_src.range('X6').value)
-
-    for i, fund_code in enumerate(data_fund_source['Quote']):
-        data_fund_source.loc[i, 'multifactor3'] = data_fund_source.loc[i, 'Differential Volitality'] * weight_Differential_Volitality
-        + data_fund_source.loc[i, 'Bias'] * weight_Bias
-        - data_fund_source.loc[i, 'DtD'] * weight_DtD
-    data_fund_destination = data_fund_source[['Quote', 'Name', 'Differential Volitality', 'Bias', 'DtD', 'multifactor3']]
-    data_fund_destination = data_fund_destination[(data_fund_destination['Differential Volitality'] < threshold_Differential_Volitality) &
-                                                  (data_fund_destination['Bias'] < threshold_Bias) &
-                                                  (data_fund_destination['DtD'] > threshold_DtD)]
-    data_fund_destination = data_fund_destination.sort_values(by='multifactor3')
-    data_fund_destination.reset_index(drop=True, inplace=True)
-    data_fund_destination.index += 1
-    print(data_fund_destination)
-    
-    sheet_dest = wb.sheets['Multifactor Strategies']     # update the 'LowPremium_CB_Rotation' excel sheet
-    sheet_dest.range('Z2').value = data_fund_destination[:20]
-    wb.save()
+    refresh_strategy('multifactor3')
 
 @xlwings.func
 # General Button to refresh all multiple-factor strategies in the sheet
 def refresh_multifactor_strategies():
     
-    refresh_multifactor1_convertible_bond()
-    refresh_multifactor2_convertible_bond()   
-    refresh_multifactor3_convertible_bond()  
+    refresh_all(refresh_quotes=False, names=['multifactor1', 'multifactor2', 'multifactor3'])
 
 # main function
 def main_function():
 
-    # date = datetime.datetime.now().date()    # Holidays suspension
-    # if not is_workday(date):
-    #     return
-    webbrowser.open("https://xueqiu.com/")
+    if not trading_calendar.is_trading_day(get_exchange_time().date()):   # Holidays suspension
+        print('Not a trading day, the sheets keep the last refresh')
+        return
+    if not token_manager.is_valid():
+        webbrowser.open("https://xueqiu.com/")   # the browser gets a new cookie, a cached token skips it
     
-    for eachfile in os.listdir('./'):
-        filename = os.path.join('./', eachfile)
-        if os.path.isfile(filename) and filename.startswith("./log"):
-            os.remove(filename)     # Delete old log files in the filepath
+    for table in snapshot_store.tables():
+        snapshot_store.compact(table)     # merge the snapshots of the past days, one file per day
             
-    refresh_convertible_bond()
-    refresh_underlying_values()
-    
-    refresh_premium_rate()
-    refresh_DoubleLow()
-    refresh_diff_volatility()
-    refresh_Bias()
-    refresh_DtD()
-    refresh_multifactor1_convertible_bond()
-    refresh_multifactor2_convertible_bond()   
-    refresh_multifactor3_convertible_bond()  
+    refresh_all()   # refresh the CBs, the underlyings and all strategies, with one read and one save
     
+# Run every trading day: the full refresh when the pre-open starts (07:00), then streaming until the after-close ends.
+# Weekends and exchange holidays are skipped, a day started late still gets its refresh
+def run_scheduled():
+    def trading_day():
+        main_function()
+        refresh_streaming(until=close_time, full_refresh=False)
+    RefreshScheduler({}, calendar=trading_calendar, daily=trading_day).run()
+
 def main():
 
+    if '--schedule' in sys.argv[1:]:
+        run_scheduled()  # python AutoArbitrage.py --schedule: keep running, one refresh and one streaming session per trading day
+        return
     main_function()
-    # schedule.every().day.at("07:00").do(main_function)  # deploy the refresh tasks at 7：00 a.m. everyday
-    # while True:
-    #     schedule.run_pending()
+    if '--stream' in sys.argv[1:]:
+        refresh_streaming(full_refresh=False)  # python AutoArbitrage.py --stream: keep the sheets fresh until the close
 
 if __name__ == "__main__":
     main()
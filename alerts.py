@@ -0,0 +1,303 @@
+import sys
+import json
+import time
+import asyncio
+import threading
+import numpy as np
+import pandas
+import requests  # HTTP for Humans, https://requests.readthedocs.io/en/latest/
+from strategies import comparisons, get_parameter, strategy_specs
+from metrics import metrics
+
+
+# Alert registry: every alert is a rule evaluated on each update of the tables, new rules are added here or loaded from a JSON file
+#     title: text of the notifications
+#     type: 'threshold' for a column crossing a threshold, 'ranking' for the CBs entering or leaving the top of a strategy
+#     source: table of a 'threshold' rule, 'RealTimeData_ConvertibleBond' or 'Underlying_Values'
+#     column, op, threshold: condition of a 'threshold' rule, op is '<', '<=', '>' or '>=', the threshold a number or a
+#                            parameter cell of the source sheet, like the filters of strategies.strategy_specs
+#     hysteresis: a triggered condition is cleared only when the value is back this far on the other side of the threshold
+#     strategy: strategy of a 'ranking' rule, its ranking table holds the top CBs
+#     debounce: consecutive updates of the tables a condition (or its clearing) must hold before it is notified
+#     initial: notify the conditions already true on the first update, otherwise they are taken as known
+alert_rules = {
+    'bias_below_W3': {
+        'title': 'Bias under the W3 limit',
+        'type': 'threshold',
+        'source': 'Underlying_Values',
+        'column': 'Bias',
+        'op': '<',
+        'threshold': 'W3',
+        'hysteresis': 0.005,
+        'debounce': 2,
+    },
+    'premium_rate_below_H2': {
+        'title': 'Premium Rate under H2',
+        'type': 'threshold',
+        'source': 'RealTimeData_ConvertibleBond',
+        'column': 'Premium Rate',
+        'op': '<',
+        'threshold': 'H2',
+        'hysteresis': 0.5,
+        'debounce': 2,
+    },
+    'multifactor1_top': {
+        'title': '[Multifactor Model 1] top 20',
+        'type': 'ranking',
+        'strategy': 'multifactor1',
+        'debounce': 1,
+    },
+}
+
+# Opposite of every comparison, the clearing condition of a triggered threshold
+opposites = {'<': '>=', '<=': '>', '>': '<=', '>=': '<'}
+
+
+# Add an alert rule to the registry
+def register_alert_rule(name, rule):
+    alert_rules[name] = rule
+    return rule
+
+
+# Load alert rules from a JSON file {name: rule, ...} into the registry
+def load_alert_rules(path):
+    with open(path, encoding='utf-8') as rule_file:
+        rules = json.load(rule_file)
+    for name, rule in rules.items():
+        register_alert_rule(name, rule)
+    return rules
+
+
+# Debounced state of one rule: per CB, whether the condition is triggered and for how many updates it has held
+class RuleState:
+    def __init__(self):
+        self.active = pandas.Series(dtype=bool)   # Quote -> triggered
+        self.count_on = pandas.Series(dtype=np.int64)   # Quote -> consecutive updates with the condition true
+        self.count_off = pandas.Series(dtype=np.int64)   # Quote -> consecutive updates with the clearing condition true
+        self.initialized = False
+
+    # Advance the state with the conditions of an update, all CBs at once
+    def update(self, quotes, condition, clearing, debounce=1, initial=False):
+        """
+        quotes: Quote of every row
+        condition, clearing: bool arrays, NaN values are neither, i.e., keep their state
+        return: bool arrays of the rows triggered and cleared by this update
+        """
+        index = pandas.Index(quotes)
+        active = self.active.reindex(index, fill_value=False).to_numpy(dtype=bool)
+        count_on = np.where(condition, self.count_on.reindex(index, fill_value=0).to_numpy() + 1, 0)
+        count_off = np.where(clearing, self.count_off.reindex(index, fill_value=0).to_numpy() + 1, 0)
+        if not self.initialized and not initial:
+            triggered, cleared = np.zeros(index.size, dtype=bool), np.zeros(index.size, dtype=bool)
+            active = condition.copy()   # known conditions, not notified
+        else:
+            triggered = ~active & (count_on >= debounce)
+            cleared = active & (count_off >= debounce)
+            active = (active | triggered) & ~cleared
+        self.initialized = True
+        keep = active | (count_on > 0)   # the other CBs are in the default state
+        self.active = pandas.Series(active[keep], index=index[keep])
+        self.count_on = pandas.Series(count_on[keep], index=index[keep])
+        self.count_off = pandas.Series(count_off[keep], index=index[keep])
+        return triggered, cleared
+
+
+# Build the alerts of the triggered and cleared rows of a rule
+def get_alerts(name, rule, table, rows, event, value=None, threshold=None):
+    now = time.time()
+    names = table['Name'].to_numpy(dtype=object) if 'Name' in table else np.full(len(table), None, dtype=object)
+    quotes = table['Quote'].to_numpy(dtype=object)
+    return [{'time': now, 'rule': name, 'title': rule.get('title', name), 'event': event, 'quote': quotes[i], 'name': names[i],
+             'value': None if value is None or np.isnan(value[i]) else float(value[i]), 'threshold': threshold}
+            for i in np.flatnonzero(rows)]
+
+
+# Evaluate declarative alert rules on every update of the tables and deliver the alerts to the sinks, on an asyncio loop.
+# The rules run vectorized over all CBs, the sinks are called concurrently so a slow webhook never delays the others.
+class AlertEngine:
+    """
+    sinks: list of alert sinks, see StdoutAlertSink, FileAlertSink, WebhookAlertSink
+    parameters: dict of sheet name -> {cell: value}, the threshold cells, see pipeline.rank_strategies
+    rules: dict of name -> rule, None for alert_rules
+    """
+    def __init__(self, sinks, parameters, rules=None, log=print):
+        self.sinks = sinks
+        self.parameters = parameters
+        self.rules = dict(alert_rules if rules is None else rules)
+        self.log = log
+        self.tables = {}   # last version of every table
+        self.states = {name: RuleState() for name in self.rules}
+        self.loop = None
+        self.thread = None
+        self.queue = None
+
+    # Evaluate all rules on the last version of every table, return the alerts. Every update counts for the debounce
+    # of all rules, also of the rules whose table did not change
+    def evaluate(self, tables):
+        """
+        tables: dict of table name -> DataFrame, the changed tables only, e.g. the updates of streaming.StreamingRefresher
+        """
+        self.tables.update(tables)
+        alerts = []
+        for name, rule in self.rules.items():
+            source = rule['source'] if rule['type'] == 'threshold' else rule['strategy']
+            if source not in self.tables:
+                continue
+            table = self.tables[source]
+            if rule['type'] == 'threshold':
+                threshold = get_parameter(rule['threshold'], self.parameters.get(source, {}), 0)
+                hysteresis = rule.get('hysteresis', 0.0)
+                released = threshold + hysteresis if rule['op'] in ('<', '<=') else threshold - hysteresis
+                value = pandas.to_numeric(table[rule['column']], errors='coerce').to_numpy(dtype=float)
+                with np.errstate(invalid='ignore'):
+                    condition = comparisons[rule['op']](value, threshold)
+                    clearing = comparisons[opposites[rule['op']]](value, released)
+                events = ('trigger', 'clear')
+            else:
+                universe = self.tables.get(strategy_specs[rule['strategy']]['source'])
+                value, threshold = None, None
+                members = set(table['Quote'])
+                # the CBs that left the ranking are only in the previous state, they are kept in the update
+                quotes = list(dict.fromkeys(list(table['Quote']) + list(self.states[name].active.index)))
+                names = dict(zip(universe['Quote'], universe['Name'])) if universe is not None and 'Name' in universe else {}
+                if 'Name' in table:
+                    names.update(zip(table['Quote'], table['Name']))
+                table = pandas.DataFrame({'Quote': quotes, 'Name': [names.get(quote) for quote in quotes]})
+                condition = np.array([quote in members for quote in quotes], dtype=bool)
+                clearing = ~condition
+                events = ('enter', 'exit')
+            triggered, cleared = self.states[name].update(table['Quote'].to_numpy(dtype=object), condition, clearing,
+                                                          rule.get('debounce', 1), rule.get('initial', False))
+            alerts += get_alerts(name, rule, table, triggered, events[0], value, threshold)
+            alerts += get_alerts(name, rule, table, cleared, events[1], value, threshold)
+        for alert in alerts:
+            metrics.inc('alerts_total', description='Alerts notified', rule=alert['rule'], event=alert['event'])
+        return alerts
+
+    # Evaluate an update and deliver its alerts to all sinks concurrently
+    async def process(self, tables, received=None):
+        alerts = self.evaluate(tables)
+        if alerts:
+            results = await asyncio.gather(*(sink.send(alerts) for sink in self.sinks), return_exceptions=True)
+            for sink, result in zip(self.sinks, results):
+                if isinstance(result, Exception):
+                    self.log('alert sink ' + type(sink).__name__ + ' failed：' + str(result))
+            if received is not None:
+                metrics.observe('alert_latency_seconds', time.perf_counter() - received,
+                                description='Seconds from a table update to the delivery of its alerts')
+        return alerts
+
+    # Process the updates of the queue in order, the updates waiting together are merged into one
+    async def run(self):
+        stopping = False
+        while not stopping:
+            tables, received = await self.queue.get()   # received: time of the oldest update, for the latency
+            if tables is None:
+                return
+            while not self.queue.empty():   # a newer version of a table replaces the older one
+                newer, _ = self.queue.get_nowait()
+                if newer is None:
+                    stopping = True
+                    break
+                tables = {**tables, **newer}
+            try:
+                await self.process(tables, received)
+            except Exception as error:
+                self.log('alert engine failed：' + str(error))
+
+    # Run the engine on its own event loop thread, submit() then returns at once
+    def start(self):
+        if self.thread is not None:
+            return self
+        self.loop = asyncio.new_event_loop()
+        self.queue = asyncio.Queue()
+        ready = threading.Event()
+
+        def serve():
+            asyncio.set_event_loop(self.loop)
+            self.loop.call_soon(ready.set)
+            self.loop.run_until_complete(self.run())
+
+        self.thread = threading.Thread(target=serve, name='alerts', daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self
+
+    # Hand an update to the engine, thread-safe, e.g. from the streaming loop. The tables are copied, the caller may
+    # keep updating them in place
+    def submit(self, tables):
+        if self.thread is None:
+            self.start()
+        tables = {name: table.copy() for name, table in tables.items()}
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (tables, time.perf_counter()))
+
+    # Deliver the pending alerts and stop the loop
+    def stop(self, timeout=10):
+        if self.thread is None:
+            return
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (None, None))
+        self.thread.join(timeout)
+        self.loop.close()
+        self.thread, self.loop, self.queue = None, None, None
+
+
+# Format an alert as one line, e.g. '2024-05-20 10:31:05 [trigger] Bias under the W3 limit：110003 CB0003 -0.0612 (-0.05)'
+def format_alert(alert):
+    line = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(alert['time'])) + ' [' + alert['event'] + '] ' + alert['title'] \
+           + '：' + str(alert['quote']) + ' ' + str(alert['name'] or '')
+    if alert['value'] is not None:
+        line += ' ' + format(alert['value'], '.4g') + ' (' + format(alert['threshold'], '.4g') + ')'
+    return line
+
+
+# Print the alerts in the console
+class StdoutAlertSink:
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    async def send(self, alerts):
+        for alert in alerts:
+            print(format_alert(alert), file=self.stream or sys.stdout)
+
+
+# Append the alerts to a JSON lines file, written off the event loop
+class FileAlertSink:
+    def __init__(self, path='alerts.jsonl'):
+        self.path = path
+
+    async def send(self, alerts):
+        await asyncio.to_thread(self.write, alerts)
+
+    def write(self, alerts):
+        with open(self.path, 'a', encoding='utf-8') as alert_file:
+            for alert in alerts:
+                alert_file.write(json.dumps(alert, ensure_ascii=False, default=str) + '\n')
+
+
+# POST the alerts of an update as one JSON list to a webhook, e.g. a local notifier or a chat bot
+class WebhookAlertSink:
+    """
+    url: webhook address, e.g. 'http://127.0.0.1:8080/alerts'
+    timeout: seconds of every request, a slow webhook only delays its own alerts
+    """
+    def __init__(self, url, timeout=5, headers=None):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+
+    async def send(self, alerts):
+        response = await asyncio.to_thread(self.session.post, self.url, json=alerts, timeout=self.timeout)
+        response.raise_for_status()
+
+
+alert_sink_types = {'stdout': StdoutAlertSink, 'file': FileAlertSink, 'webhook': WebhookAlertSink}
+
+
+# Build the alert sinks of a config, e.g. [{"type": "webhook", "url": "http://127.0.0.1:8080/alerts"}, {"type": "stdout"}]
+def get_alert_sinks(configs):
+    sinks = []
+    for config in configs:
+        config = dict(config)
+        sinks.append(alert_sink_types[config.pop('type')](**config))
+    return sinks
@@ -0,0 +1,216 @@
+import json
+import argparse
+import itertools
+import numpy as np
+import pandas
+from strategies import strategy_specs, comparisons, get_parameter, load_strategy_specs, get_strategy_columns
+from snapshots import SnapshotStore
+
+
+trading_days = 250   # trading days per year, to annualize the returns
+
+
+# Daily history of a source table as (days x bonds) arrays, built from the snapshot store
+class BacktestPanel:
+    """
+    dates: trading days, shape (T,)
+    quotes: CB quotes, shape (N,)
+    arrays: dict of column -> float array (T, N), NaN where a bond has no snapshot that day
+    suspended: bool array (T, N), '停牌' in the snapshot of the day
+    """
+    def __init__(self, dates, quotes, arrays, suspended):
+        self.dates = dates
+        self.quotes = quotes
+        self.arrays = arrays
+        self.suspended = suspended
+
+    # Daily returns of the CB prices, the price of a day without snapshot is the last one seen
+    def get_returns(self):
+        prices = pandas.DataFrame(self.arrays['Current']).ffill().to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns = prices[1:] / prices[:-1] - 1
+        returns = np.vstack([np.zeros((1, prices.shape[1])), returns])
+        return np.where(np.isfinite(returns), returns, 0.0)
+
+
+# Load the daily panel of a source table from the snapshot store, the last snapshot of every day is used
+def load_panel(store, table, start=None, end=None, columns=None):
+    """
+    store: SnapshotStore, or the path of its root
+    table: 'RealTimeData_ConvertibleBond' or 'Underlying_Values'
+    columns: float columns to load, 'Current' is always loaded
+    """
+    store = SnapshotStore(store) if isinstance(store, str) else store
+    columns = list(dict.fromkeys(['Current'] + list(columns or [])))
+    data = store.read(table, start, end, columns=columns + ['Suspended'])
+    if data.empty:
+        raise Exception('No snapshot of ' + table + ' between ' + str(start) + ' and ' + str(end))
+    data['Date'] = data['Time'].dt.normalize()
+    data = data.dropna(subset=['Quote']).drop_duplicates(['Date', 'Quote'], keep='last')
+    dates = np.sort(data['Date'].unique())
+    quotes = np.sort(data['Quote'].unique())
+    rows = np.searchsorted(dates, data['Date'].to_numpy())
+    cols = np.searchsorted(quotes, data['Quote'].to_numpy())
+    arrays = {}
+    for column in columns:
+        arrays[column] = np.full((dates.size, quotes.size), np.nan)
+        arrays[column][rows, cols] = data[column].to_numpy(dtype=float)
+    suspended = np.zeros((dates.size, quotes.size), dtype=bool)
+    suspended[rows, cols] = data['Suspended'].to_numpy(dtype=bool)
+    return BacktestPanel(dates, quotes, arrays, suspended)
+
+
+# Build every combination of the swept cells, the other cells keep their value
+def get_sweep_cells(cells, sweep=None):
+    """
+    cells: dict of parameter cell -> value, e.g. {'D5': '250&5', 'H5': '50&2', ...}
+    sweep: dict of cell -> list of values, e.g. {'D5': ['250&5', '200&5'], 'H5': ['50&1', '50&2', '50&3']}
+    return: list of cells dicts, one per configuration
+    """
+    if not sweep:
+        return [dict(cells)]
+    names = list(sweep)
+    return [dict(cells, **dict(zip(names, values))) for values in itertools.product(*[sweep[name] for name in names])]
+
+
+# Get the thresholds (C, filters) and the weights (C, terms) of every configuration, see strategies.evaluate_strategy
+def get_strategy_parameters(spec, configurations):
+    thresholds = np.array([[get_parameter(threshold, cells, 0) for column, op, threshold in spec['filters']]
+                           for cells in configurations], dtype=float).reshape(len(configurations), -1)
+    if isinstance(spec['score'], dict):
+        weights = np.array([[sign * get_parameter(weight, cells, 1) for column, weight, sign in spec['score']['terms']]
+                            for cells in configurations], dtype=float).reshape(len(configurations), -1)
+    else:
+        weights = np.ones((len(configurations), 1))
+    return thresholds, weights
+
+
+# Select the top CBs of every configuration on one day, the batched version of strategies.evaluate_strategy
+def select_batch(spec, arrays, thresholds, weights, tradable):
+    """
+    arrays: dict of column -> float array (N,), the table of the day
+    thresholds, weights: see get_strategy_parameters, shape (C, filters) and (C, terms)
+    tradable: bool array (N,), priced and not suspended
+    return: bool array (C, N), the CBs held by every configuration
+    """
+    mask = np.broadcast_to(tradable, (thresholds.shape[0], tradable.size)).copy()
+    with np.errstate(invalid='ignore'):
+        for f, (column, op, threshold) in enumerate(spec['filters']):
+            mask &= comparisons[op](arrays[column][None, :], thresholds[:, f, None])  # NaN never passes a filter
+    if isinstance(spec['score'], dict):
+        score = np.zeros(mask.shape)
+        for k, (column, weight, sign) in enumerate(spec['score']['terms']):
+            score = score + weights[:, k, None] * arrays[column][None, :]
+    else:
+        score = np.broadcast_to(arrays[spec['score']], mask.shape)
+    key = score if spec.get('ascending', True) else -score
+    key = np.where(np.isnan(key), np.finfo(float).max, key)  # NaN scores go last, like sort_values
+    key = np.where(mask, key, np.inf)
+    top = spec.get('top', 20)
+    if key.shape[1] > top:
+        kth = np.partition(key, top - 1, axis=1)[:, top - 1, None]   # N-th key of every configuration
+        ahead, ties = key < kth, key == kth
+        # the ties at the cut go by position, like evaluate_strategy
+        selected = ahead | ties & (np.cumsum(ties, axis=1) <= top - ahead.sum(axis=1, keepdims=True))
+    else:
+        selected = np.ones(key.shape, dtype=bool)
+    return selected & (key < np.inf)
+
+
+# Replay the daily history through a strategy for many configurations at once: equal weights on the top CBs,
+# rebalanced every few days, with transaction costs. Suspended CBs can be neither bought nor sold.
+def backtest_strategy(spec, panel, configurations, rebalance_days=5, cost_rate=0.001):
+    """
+    spec: strategy spec, see strategies.strategy_specs
+    panel: BacktestPanel of the source table of the strategy, see load_panel
+    configurations: list of cells dicts, see get_sweep_cells
+    rebalance_days: trading days between two rebalances
+    cost_rate: cost of trading, as a fraction of the traded value (commission + slippage)
+    return: dict of 'nav' (C, T), 'turnover' (C, T), 'holdings' (C, T)
+    """
+    thresholds, weights = get_strategy_parameters(spec, configurations)
+    returns = panel.get_returns()
+    count, days = len(configurations), panel.dates.size
+    held = np.zeros((count, panel.quotes.size))   # weight of every CB, the rest is cash
+    nav = np.ones(count)
+    result = {'nav': np.zeros((count, days)), 'turnover': np.zeros((count, days)), 'holdings': np.zeros((count, days), dtype=np.int64)}
+    for t in range(days):
+        if t > 0:
+            gross = held @ returns[t]
+            nav *= 1 + gross
+            held = held * (1 + returns[t]) / (1 + gross)[:, None]   # weights drift with the prices
+        if t % rebalance_days == 0:
+            tradable = ~panel.suspended[t] & np.isfinite(panel.arrays['Current'][t])
+            frozen = (held > 0) & panel.suspended[t]   # suspended CBs stay in the portfolio
+            frozen_weight = np.where(frozen, held, 0.0)
+            selected = select_batch(spec, {column: values[t] for column, values in panel.arrays.items()},
+                                    thresholds, weights, tradable) & ~frozen
+            selected_count = selected.sum(axis=1)
+            free = 1 - frozen_weight.sum(axis=1)
+            target = frozen_weight + np.where(selected, (free / np.maximum(selected_count, 1))[:, None], 0.0)
+            turnover = np.abs(target - held).sum(axis=1)
+            nav *= 1 - turnover * cost_rate
+            held = target
+            result['turnover'][:, t] = turnover
+        result['nav'][:, t] = nav
+        result['holdings'][:, t] = (held > 0).sum(axis=1)
+    return result
+
+
+# Performance of every configuration: returns, volatility, Sharpe ratio, drawdown and turnover
+def get_backtest_stats(result, configurations, cells=None):
+    """
+    cells: swept cells shown in the table, e.g. ['D5', 'H5'], None for none
+    """
+    nav = result['nav']
+    daily = np.diff(np.hstack([np.ones((nav.shape[0], 1)), nav]), axis=1) / np.hstack([np.ones((nav.shape[0], 1)), nav[:, :-1]])
+    years = max(nav.shape[1], 1) / trading_days
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stats = pandas.DataFrame({
+            'Total Return': nav[:, -1] - 1,
+            'Annual Return': nav[:, -1] ** (1 / years) - 1,
+            'Annual Volatility': daily.std(axis=1) * np.sqrt(trading_days),
+            'Sharpe': daily.mean(axis=1) / daily.std(axis=1) * np.sqrt(trading_days),
+            'Max Drawdown': (nav / np.maximum.accumulate(nav, axis=1) - 1).min(axis=1),
+            'Turnover': result['turnover'].sum(axis=1) / years,
+            'Holdings': result['holdings'].mean(axis=1)})
+    for cell in reversed(cells or []):
+        stats.insert(0, cell, [configuration[cell] for configuration in configurations])
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Backtest a CB strategy on the snapshot store, with parameter sweeps')
+    parser.add_argument('strategy', help='name of the strategy, see strategies.strategy_specs')
+    parser.add_argument('--config', help='headless config with the parameter cells, see headless_config.example.json')
+    parser.add_argument('--snapshots', default='snapshots', help='root of the snapshot store')
+    parser.add_argument('--start', help='first day, YYYY-MM-DD')
+    parser.add_argument('--end', help='last day, YYYY-MM-DD')
+    parser.add_argument('--rebalance', type=int, default=5, help='trading days between two rebalances')
+    parser.add_argument('--cost', type=float, default=0.001, help='cost of trading, as a fraction of the traded value')
+    parser.add_argument('--sweep', action='append', default=[], help="cell=value,value,..., e.g. --sweep 'D5=250&5,200&5'")
+    parser.add_argument('--output', help='CSV file of the results')
+    args = parser.parse_args(argv)
+
+    config = {}
+    if args.config:
+        with open(args.config, encoding='utf-8') as config_file:
+            config = json.load(config_file)
+        if config.get('strategies'):
+            load_strategy_specs(config['strategies'])
+    spec = strategy_specs[args.strategy]
+    sweep = {item.split('=', 1)[0]: item.split('=', 1)[1].split(',') for item in args.sweep}
+    configurations = get_sweep_cells(config.get('parameters', {}).get(spec['source'], {}), sweep)
+    panel = load_panel(args.snapshots, spec['source'], args.start, args.end, get_strategy_columns(spec))
+    print('Backtest ' + spec['title'] + '：' + str(panel.dates.size) + ' days, ' + str(panel.quotes.size) + ' CBs, '
+          + str(len(configurations)) + ' configurations')
+    result = backtest_strategy(spec, panel, configurations, args.rebalance, args.cost)
+    stats = get_backtest_stats(result, configurations, list(sweep)).sort_values('Sharpe', ascending=False)
+    if args.output:
+        stats.to_csv(args.output, index=False, encoding='utf-8-sig')
+    pandas.options.display.max_columns = None
+    print(stats.head(20).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+import os
+import json
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from http.cookies import SimpleCookie
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas
+from quotes import QuoteCache, QuoteFetcher, SnowballTransport
+from pricing import (bs_option, implied_volatility, bs_option_batch, implied_volatility_batch, cb_lattice_batch, cb_implied_volatility_batch,
+                     merton_kmv_batch)
+from executor import PricingExecutor
+from strategies import strategy_specs, get_table_arrays, RankingIndex
+from pipeline import (convertible_bond_columns, underlying_input_columns, get_bond_symbol, get_float_column,
+                      build_convertible_bond_table, select_underlyings, build_underlying_table, price_underlying_table,
+                      rank_strategies, get_scenario_engine, get_greeks_table)
+
+
+# Benchmark the pipeline on synthetic CB universes served by a local stand-in of the quote source:
+#     python benchmark.py --sizes 100 1000 5000 --latency 0.02
+#     python benchmark.py --save-baseline        # store the results in benchmark_baseline.json
+# Every run is compared with the baseline, a stage slower than the baseline by more than --tolerance is a regression.
+
+benchmark_sizes = (100, 1000, 5000)
+benchmark_baseline = 'benchmark_baseline.json'
+ranking_index_rows = 10   # CBs moved by the 'ranking index update' stage, like one streaming tick
+
+# Parameter cells of the sheets, same as the workbook
+benchmark_parameters = {
+    'RealTimeData_ConvertibleBond': {'D2': 250, 'H2': 50, 'M2': 900, 'D3': 150, 'H3': 50, 'M3': 400,
+                                     'D5': '250&5', 'H5': '50&2', 'M5': '900&3', 'D6': '150&7', 'H6': '50&3', 'M6': '400&1'},
+    'Underlying_Values': {'D2': 250, 'P2': -0.1, 'D3': 150, 'W3': -0.05, 'D4': 150, 'S4': 100, 'X4': 0,
+                          'P6': '-0.1&5', 'W6': '-0.05&3', 'X6': '0&2'},
+}
+
+
+# Generate a synthetic CB universe: quote_detail payloads of the bonds and of their underlyings, and the
+# hand-maintained inputs of the stock table, with prices consistent with the conversion terms
+def make_universe(size, seed=0):
+    """
+    return: dict of symbol -> quote_detail payload, list of CB quotes, DataFrame of the underlying inputs
+    """
+    rng = np.random.default_rng(seed)
+    stock_count = max(1, int(size * 0.9))   # a few underlyings have two CBs
+    stocks = ['SH6%05d' % i if i % 2 == 0 else 'SZ00%04d' % (i % 10000) for i in range(stock_count)]
+    stock_price = np.round(rng.lognormal(np.log(12), 0.6, stock_count), 2)
+    payloads = {}
+    for symbol, price in zip(stocks, stock_price):
+        payloads[symbol] = {'data': {'quote': {'symbol': symbol, 'name': 'Stock' + symbol[-4:], 'current': float(price),
+                                               'dividend_yield': float(np.round(rng.uniform(0, 3), 2))}},
+                            'error_code': 0, 'error_description': ''}
+
+    quotes = []
+    conversion_prices = []
+    now = time.time() * 1000
+    underlying = rng.integers(0, stock_count, size)
+    underlying[:stock_count] = np.arange(min(size, stock_count))
+    for i in range(size):
+        quote = str(110000 + i) if i % 3 != 2 else str(123000 + i)
+        symbol = get_bond_symbol(quote)
+        stock = stocks[underlying[i]]
+        conversion_price = float(np.round(stock_price[underlying[i]] * rng.uniform(0.7, 1.4), 2))
+        conversion_value = 100 / conversion_price * stock_price[underlying[i]]
+        current = float(np.round(max(90.0, conversion_value * rng.uniform(1.0, 1.5), 100 + rng.normal(5, 8)), 3))
+        remain_year = float(np.round(rng.uniform(0.3, 6.0), 3))
+        suspended = rng.random() < 0.01
+        conversion_prices.append(conversion_price)
+        payloads[symbol] = {'data': {'quote': {
+            'symbol': symbol, 'name': 'CB' + quote[-4:], 'current': current,
+            'percent': None if suspended else float(np.round(rng.normal(0, 1.5), 2)),
+            'conversion_price': conversion_price, 'conversion_value': float(np.round(conversion_value, 3)),
+            'premium_rate': float(np.round((current / conversion_value - 1) * 100, 2)),
+            'issue_date': now - (6 - remain_year) * 365.25 * 86400000, 'maturity_date': now + remain_year * 365.25 * 86400000,
+            'remain_year': remain_year, 'outstanding_amt': float(rng.uniform(5e7, 3e9)),
+            'amount': 0.0 if suspended else float(rng.uniform(1e6, 2e9)),
+            'benefit_before_tax': float(np.round(rng.normal(0, 2), 2)),
+            'high': None if suspended else current * 1.01, 'low': None if suspended else current * 0.99,
+            'underlying_symbol': stock}}, 'error_code': 0, 'error_description': ''}
+        quotes.append(quote)
+    inputs = pandas.DataFrame({'Quote': quotes, 'Interest Rate': 2.438,
+                               'Realized Volatility': np.round(rng.uniform(20, 60, size), 2),
+                               'Putable Price': np.round(0.7 * np.array(conversion_prices), 2),   # stock price triggers
+                               'Callable Price': np.round(1.3 * np.array(conversion_prices), 2),
+                               'Straight Bond Value': np.round(rng.uniform(80, 110, size), 2)})
+    return payloads, quotes, inputs
+
+
+# Local stand-in of the quote_detail endpoint serving the payloads of a universe, with a fixed latency per request.
+# Unknown symbols get a 404, the 400016 of an expired token is only sent to the tokens listed in expired_tokens
+class StubQuoteServer:
+    """
+    payloads: dict of symbol -> quote_detail payload, see make_universe
+    latency: seconds added to every request, e.g. 0.02 for a typical round trip to the data source
+    expired_tokens: xq_a_token values rejected with 400016, to exercise the token renewal, e.g. {'expired'}
+    """
+    def __init__(self, payloads, latency=0.0, expired_tokens=()):
+        self.payloads = {symbol: json.dumps(payload).encode() for symbol, payload in payloads.items()}
+        self.latency = latency
+        self.expired_tokens = set(expired_tokens)
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'   # keep-alive, like the data source
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)   # headers and body are two writes, no Nagle delay
+
+            def do_GET(self):
+                server.requests += 1
+                symbol = parse_qs(urlparse(self.path).query).get('symbol', [''])[0]
+                cookie = SimpleCookie(self.headers.get('Cookie') or '')
+                if server.latency:
+                    time.sleep(server.latency)
+                status, body = 200, server.payloads.get(symbol)
+                if 'xq_a_token' in cookie and cookie['xq_a_token'].value in server.expired_tokens:
+                    status, body = 400, json.dumps({'data': {}, 'error_code': 400016, 'error_description': 'token expired'}).encode()
+                elif body is None:
+                    status, body = 404, json.dumps({'data': {'quote': None}, 'error_code': 404, 'error_description': 'unknown symbol ' + symbol}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/v5/stock/quote.json?extend=detail&symbol=' % self.httpd.server_port
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# Time and memory of the stages of one run
+class BenchmarkRecorder:
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.seconds = {}
+        self.peak_mb = {}
+
+    def run(self, name, function, *args, **kwargs):
+        if self.memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+            if self.memory:
+                self.peak_mb[name] = max(self.peak_mb.get(name, 0.0), tracemalloc.get_traced_memory()[1] / 2**20)
+                tracemalloc.stop()
+
+
+# Index every strategy on the tables of a universe, see strategies.RankingIndex
+def get_ranking_indexes(data_fund, data_stock):
+    tables = {'RealTimeData_ConvertibleBond': data_fund, 'Underlying_Values': data_stock}
+    arrays = {sheet: {column: values.copy() for column, values in get_table_arrays(table).items()} for sheet, table in tables.items()}
+    indexes = {}
+    for name, spec in strategy_specs.items():
+        indexes[name] = RankingIndex(spec, benchmark_parameters[spec['source']])
+        indexes[name].build(arrays[spec['source']])
+    return indexes, arrays
+
+
+# Re-rank every strategy after a streaming tick moved a few CBs, with the incremental ranking indexes
+def update_ranking_indexes(indexes, arrays, rows):
+    for index in indexes.values():
+        source = arrays[index.spec['source']]
+        changed = rows[rows < len(source['Current'])]
+        source['Current'][changed] *= 1.01
+        index.update(source, changed)
+
+
+# Run the pipeline stages once on a universe: fetch, DataFrame build, pricing, IV solve, ranking and output write
+def run_benchmark(size, latency=0.0, max_workers=8, memory=False, scalar_sample=200, seed=0, pricing_workers=None):
+    """
+    pricing_workers: processes of the 'CB lattice pool' stage, None or 1 to skip it
+    scalar_sample: number of bonds priced with the scalar bs_option/implied_volatility, to compare with the batched solvers
+    return: dict of stage -> {'seconds', 'per_second', 'peak_mb'}
+    """
+    payloads, quotes, inputs = make_universe(size, seed)
+    recorder = BenchmarkRecorder(memory)
+    output = tempfile.mkdtemp(prefix='benchmark_')
+    try:
+        with StubQuoteServer(payloads, latency) as server:
+            fetcher = QuoteFetcher(SnowballTransport('xq_a_token=benchmark;', pool_size=max_workers, base_url=server.url),
+                                   max_workers=max_workers)
+            cache = QuoteCache()
+            details = recorder.run('fetch', cache.get_many, [get_bond_symbol(quote) for quote in quotes], 'realtime', fetcher)
+            data_fund = pandas.DataFrame({'Quote': quotes}).reindex(columns=convertible_bond_columns)
+            data_fund = recorder.run('build', build_convertible_bond_table, data_fund, details, log=lambda *a: None)
+            data_stock = select_underlyings(data_fund, rows=None).reset_index(drop=True)
+            inputs = inputs.set_index('Quote')
+            for column in underlying_input_columns:
+                data_stock[column] = data_stock['Quote'].map(inputs[column]).to_numpy()
+            stock_details = recorder.run('fetch', cache.get_many, data_stock['Stock Quote'], 'realtime', fetcher)
+            fetcher.close()
+
+        data_stock = recorder.run('build', build_underlying_table, data_stock, stock_details, log=lambda *a: None)  # includes one pricing pass
+        data_stock = recorder.run('pricing', price_underlying_table, data_stock)
+        S, K, T = (get_float_column(data_stock, column) for column in ('Stock Current', 'Conversion Price', 'Remain Year'))
+        r, q = get_float_column(data_stock, 'Interest Rate') / 100, get_float_column(data_stock, 'Dividend') / 100
+        sigma = get_float_column(data_stock, 'Realized Volatility') / 100
+        price = recorder.run('bs_option batch', bs_option_batch, S, K, T, r, q, sigma)[2]
+        recorder.run('IV solve batch', implied_volatility_batch, price, S, K, T, r, q)
+        B, put, call = (get_float_column(data_stock, column) for column in ('Straight Bond Value', 'Putable Price', 'Callable Price'))
+        value = recorder.run('CB lattice batch', cb_lattice_batch, S, K, T, r, q, sigma, B, put, call)
+        recorder.run('CB IV solve batch', cb_implied_volatility_batch, value, S, K, T, r, q, B, put, call)
+        E = get_float_column(data_stock, 'Conversion Value')
+        V, sigma_V = recorder.run('KMV calibration', merton_kmv_batch, E, sigma, B, T, r, q)[:2]
+        recorder.run('KMV warm start', merton_kmv_batch, E * 1.01, sigma, B, T, r, q, V * 1.01, sigma_V)   # the next day, 1% higher
+        if pricing_workers and pricing_workers > 1:
+            executor = PricingExecutor(workers=pricing_workers, min_size=0)
+            executor.map(cb_lattice_batch, S[:pricing_workers], K[:pricing_workers], 1.0, 0.02, 0.0, 0.3)   # starts the pool
+            recorder.run('CB lattice pool', executor.map, cb_lattice_batch, S, K, T, r, q, sigma, B, put, call)
+            executor.close()
+        engine = get_scenario_engine(data_stock)
+        recorder.run('greeks', get_greeks_table, data_stock, engine)
+        recorder.run('scenario grid', engine.grid, np.linspace(-0.2, 0.2, 20), np.linspace(-0.1, 0.1, 10), [0.0])   # 200 scenarios
+        sample = slice(0, min(scalar_sample, len(S)))
+        recorder.run('bs_option scalar', lambda: [bs_option(*args) for args in zip(S[sample], K[sample], T[sample], r[sample], q[sample], sigma[sample])])
+        recorder.run('IV solve scalar', lambda: [implied_volatility(*args) for args in zip(price[sample], S[sample], K[sample], T[sample], r[sample], q[sample])])
+        rankings = recorder.run('ranking', rank_strategies, data_fund, data_stock, benchmark_parameters, log=lambda *a: None)
+        indexes, arrays = get_ranking_indexes(data_fund, data_stock)
+        recorder.run('ranking index update', update_ranking_indexes, indexes, arrays, np.arange(0, size, max(1, size // ranking_index_rows)))
+        tables = {'RealTimeData_ConvertibleBond': data_fund, 'Underlying_Values': data_stock, **rankings}
+        recorder.run('write', write_tables, tables, output)
+    finally:
+        shutil.rmtree(output, ignore_errors=True)
+
+    rows = {'fetch': 2 * size, 'ranking index update': ranking_index_rows * len(strategy_specs), 'bs_option scalar': min(scalar_sample, size), 'IV solve scalar': min(scalar_sample, size)}
+    return {name: {'seconds': seconds, 'per_second': rows.get(name, size) / seconds if seconds > 0 else float('inf'),
+                   'peak_mb': recorder.peak_mb.get(name)} for name, seconds in recorder.seconds.items()}
+
+
+# Write the tables as CSV files, like the csv sink of headless.py
+def write_tables(tables, path):
+    for name, table in tables.items():
+        table.to_csv(os.path.join(path, name + '.csv'), encoding='utf-8-sig')
+
+
+# Compare the results with the baseline, a stage slower by more than the tolerance is a regression
+def compare_baseline(results, baseline, tolerance=0.25):
+    """
+    results, baseline: dict of size -> stage -> {'seconds', ...}
+    return: list of (size, stage, seconds, baseline seconds)
+    """
+    regressions = []
+    for size, stages in results.items():
+        for stage, result in stages.items():
+            base = baseline.get(str(size), {}).get(stage)
+            if base and result['seconds'] > base['seconds'] * (1 + tolerance):
+                regressions.append((size, stage, result['seconds'], base['seconds']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on synthetic CB universes')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(benchmark_sizes), help='numbers of CBs')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every quote request')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent quote requests')
+    parser.add_argument('--pricing-workers', type=int, default=None, help='processes of the pricing pool, for the CB lattice pool stage')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per size, the fastest one is kept')
+    parser.add_argument('--memory', action='store_true', help='record the peak memory of every stage, slower')
+    parser.add_argument('--baseline', default=benchmark_baseline, help='baseline file')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='slowdown allowed before a regression, 0.25 for 25%%')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for size in args.sizes:
+        runs = [run_benchmark(size, args.latency, args.workers, args.memory, pricing_workers=args.pricing_workers) for _ in range(max(1, args.repeat))]
+        results[size] = {stage: min((run[stage] for run in runs), key=lambda result: result['seconds']) for stage in runs[0]}
+        print('------------ ' + str(size) + ' CBs ------------')
+        for stage, result in results[size].items():
+            print(format(stage, "<20") + format(result['seconds'], ">10.4f") + ' s' + format(result['per_second'], ">14.0f") + ' /s'
+                  + ('' if result['peak_mb'] is None else format(result['peak_mb'], ">10.1f") + ' MB'))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as baseline_file:
+            json.dump({str(size): stages for size, stages in results.items()}, baseline_file, indent=2)
+        print('Baseline saved：' + args.baseline)
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            regressions = compare_baseline(results, json.load(baseline_file), args.tolerance)
+        for size, stage, seconds, base in regressions:
+            print('Regression：' + str(size) + ' CBs, ' + stage + ' ' + format(seconds, '.4f') + ' s vs ' + format(base, '.4f') + ' s')
+        if regressions:
+            return 1
+        print('No regression against ' + args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
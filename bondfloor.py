@@ -0,0 +1,206 @@
+import os
+import datetime
+import numpy as np
+import pandas
+from quotes import quote_of
+from pipeline import get_bond_symbol
+from scheduler import get_exchange_time
+
+
+default_coupons = (0.3, 0.5, 1.0, 1.5, 1.8, 2.0)   # coupon rates (%) of a typical 6-year CB, used when a bond has no terms
+default_redemption = 110.0   # redemption price at maturity, including the last coupon
+default_rating = 'AA'   # curve of the bonds without a rating
+risk_free_curve = 'Government'   # curve of the risk free rate, i.e., 'Interest Rate' of the stock table
+bond_floor_fields = ('issue_date', 'maturity_date')   # quote fields of the CBs read by fill_straight_bond_value, the field class of the quote cache
+
+
+# Get the coupon rates of a 'coupon&coupon&...' cell, '0.3&0.5&1.0&1.5&1.8&2.0' -> (0.3, 0.5, 1.0, 1.5, 1.8, 2.0)
+def get_coupons(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)) or value == '':
+        return default_coupons
+    return tuple(float(coupon) for coupon in str(value).split('&', -1))
+
+
+# Get a date from a quote_detail timestamp (ms, dated in Beijing time), a 'YYYY-MM-DD' string or a date
+def get_date(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return get_exchange_time(value / 1000).date()
+    return pandas.Timestamp(value).date()
+
+
+# Same day and month, n years later, 29 Feb -> 28 Feb
+def add_years(date, years):
+    try:
+        return date.replace(year=date.year + years)
+    except ValueError:
+        return date.replace(year=date.year + years, day=28)
+
+
+# Build the cash flows of a CB: one coupon per year from the issue date, the redemption price at maturity
+def build_schedule(issue_date, maturity_date, coupons=default_coupons, redemption=default_redemption):
+    """
+    coupons: coupon rates (%) of every year, the last one is repeated if the bond is longer
+    redemption: paid at maturity, including the last coupon. None or NaN for 100 + the last coupon
+    return: payment dates (days since 1970-01-01), amounts per 100 face value
+    """
+    years = max(1, int(round((maturity_date - issue_date).days / 365.25)))
+    coupons = list(coupons) + [coupons[-1]] * max(0, years - len(coupons))
+    dates = [add_years(issue_date, i) for i in range(1, years)] + [maturity_date]
+    amounts = coupons[:years - 1]
+    amounts.append(100 + coupons[years - 1] if redemption is None or np.isnan(redemption) else float(redemption))
+    return np.array([(date - datetime.date(1970, 1, 1)).days for date in dates], dtype=np.int64), np.array(amounts)
+
+
+# Yield curves of several ratings on one tenor grid, e.g. the ChinaBond government and corporate bond curves
+class YieldCurve:
+    """
+    tenors: years, increasing
+    rates: dict of curve name -> yields (%), one per tenor, e.g. {'Government': [...], 'AAA': [...], 'AA': [...]}
+    Yields are linearly interpolated between tenors and flat outside of them, and annually compounded.
+    """
+    def __init__(self, tenors, rates):
+        self.tenors = np.asarray(tenors, dtype=float)
+        self.names = list(rates)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.rates = np.array([np.asarray(rates[name], dtype=float) for name in self.names]).reshape(len(self.names), -1)
+
+    def get_curve_index(self, names, default=default_rating):
+        return np.array([self.index.get(name, self.index.get(default, 0)) for name in names], dtype=np.int64)
+
+    def rate(self, curves, t):
+        """
+        curves: curve index of every row, shape (n,)
+        t: times in years, shape (n,) or (n, m)
+        return: interpolated yields (%), same shape as t
+        """
+        t = np.clip(np.asarray(t, dtype=float), self.tenors[0], self.tenors[-1])
+        right = np.clip(np.searchsorted(self.tenors, t, side='right'), 1, self.tenors.size - 1)
+        left = right - 1
+        curves = np.asarray(curves).reshape((-1,) + (1,) * (t.ndim - 1))
+        r0, r1 = self.rates[curves, left], self.rates[curves, right]
+        width = self.tenors[right] - self.tenors[left]
+        weight = np.where(width > 0, (t - self.tenors[left]) / np.where(width > 0, width, 1), 0.0)
+        return r0 + weight * (r1 - r0)
+
+
+yield_curve_cache = {}   # path -> (modified time, YieldCurve)
+
+
+# Load a yield curve from a CSV file with a 'Tenor' column (years) and one column of yields (%) per curve,
+# cached until the file changes
+def load_yield_curve(path):
+    modified = os.path.getmtime(path)
+    if path not in yield_curve_cache or yield_curve_cache[path][0] != modified:
+        data = pandas.read_csv(path, comment='#').sort_values('Tenor')
+        yield_curve_cache[path] = (modified, YieldCurve(data['Tenor'], {column: data[column] for column in data.columns if column != 'Tenor'}))
+    return yield_curve_cache[path][1]
+
+
+# Load the coupon terms of the CBs from a CSV file with the columns 'Quote', 'Coupons' ('0.3&0.5&...'),
+# 'Redemption' and 'Rating', indexed by the data source symbol
+def load_bond_terms(path):
+    terms = pandas.read_csv(path, dtype={'Quote': str, 'Coupons': str, 'Rating': str}, comment='#')
+    terms.index = [get_bond_symbol(quote) for quote in terms['Quote']]   # 110003 and 110003.0 from the sheet are the same bond
+    return terms[~terms.index.duplicated()]
+
+
+# Straight bond values (bond floors) of all CBs from their cash flow schedules and the yield curves
+class BondFloorEngine:
+    """
+    curve: YieldCurve, or the path of its CSV file, see load_yield_curve
+    terms: DataFrame of coupon terms indexed by get_bond_symbol(Quote), or the path of its CSV file, see load_bond_terms.
+           Bonds without terms get default_coupons, default_redemption and default_rating
+    The schedule of a bond is built once and rebuilt only when its terms change. The schedules of the universe are
+    kept as padded (bonds x payments) arrays, so a refresh is one discount over the whole matrix.
+    """
+    def __init__(self, curve, terms=None):
+        self.curve_path = curve if isinstance(curve, str) else None
+        self.curve = load_yield_curve(curve) if isinstance(curve, str) else curve
+        self.terms = load_bond_terms(terms) if isinstance(terms, str) else terms
+        self.schedules = {}   # quote -> (terms key, dates, amounts)
+        self.universe_key = None
+        self.dates = np.zeros((0, 0), dtype=np.int64)
+        self.amounts = np.zeros((0, 0))
+        self.curve_names = []
+
+    def get_terms(self, quote):
+        if self.terms is not None and quote in self.terms.index:
+            row = self.terms.loc[quote]
+            redemption = pandas.to_numeric(row.get('Redemption', np.nan), errors='coerce')
+            rating = row.get('Rating', default_rating)
+            return (get_coupons(row.get('Coupons')), None if np.isnan(redemption) else float(redemption),
+                    rating if isinstance(rating, str) else default_rating)
+        return default_coupons, default_redemption, default_rating
+
+    def get_schedule(self, quote, issue_date, maturity_date):
+        coupons, redemption, rating = self.get_terms(quote)
+        key = (issue_date, maturity_date, coupons, redemption)
+        if quote not in self.schedules or self.schedules[quote][0] != key:
+            if issue_date is None or maturity_date is None:
+                schedule = (np.zeros(0, dtype=np.int64), np.zeros(0))
+            else:
+                schedule = build_schedule(issue_date, maturity_date, coupons, redemption)
+            self.schedules[quote] = (key,) + schedule
+        return self.schedules[quote], rating
+
+    # Rebuild the padded schedule matrix only when the universe or the terms of a bond change
+    def set_universe(self, quotes, issue_dates, maturity_dates):
+        schedules, ratings = zip(*[self.get_schedule(quote, get_date(issue), get_date(maturity))
+                                   for quote, issue, maturity in zip(quotes, issue_dates, maturity_dates)]) if len(quotes) else ((), ())
+        key = tuple(quotes), tuple(schedule[0] for schedule in schedules), tuple(ratings)
+        if key == self.universe_key:
+            return
+        width = max([schedule[1].size for schedule in schedules] + [1])
+        self.dates = np.zeros((len(schedules), width), dtype=np.int64)
+        self.amounts = np.zeros((len(schedules), width))
+        for i, (terms, dates, amounts) in enumerate(schedules):
+            self.dates[i, :dates.size] = dates
+            self.amounts[i, :amounts.size] = amounts
+        self.curve_names = list(ratings)
+        self.universe_key = key
+
+    def bond_floor(self, quotes, issue_dates, maturity_dates, today=None):
+        """
+        quotes: CB quotes, e.g. data_stock['Quote']
+        issue_dates, maturity_dates: quote_detail timestamps (ms), 'YYYY-MM-DD' strings or dates, one per quote
+        return: present value of the remaining cash flows per 100 face value, NaN for a bond without payments left
+        """
+        if self.curve_path:
+            self.curve = load_yield_curve(self.curve_path)   # reloaded only when the file changes
+        self.set_universe([get_bond_symbol(quote) for quote in quotes], list(issue_dates), list(maturity_dates))
+        today = (today or get_exchange_time().date()) - datetime.date(1970, 1, 1)
+        t = (self.dates - today.days) / 365.0
+        future = (t > 0) & (self.amounts > 0)
+        curves = self.curve.get_curve_index(self.curve_names)
+        discount = (1 + self.curve.rate(curves, np.where(future, t, 0.0)) / 100) ** -np.where(future, t, 0.0)
+        value = np.where(future, self.amounts * discount, 0.0).sum(axis=1)
+        return np.where(future.any(axis=1), value, np.nan)
+
+    # Risk free rate (%) at the remaining life of every bond
+    def risk_free_rate(self, remain_years):
+        if risk_free_curve not in self.curve.index:
+            return np.full(len(remain_years), np.nan)
+        remain_years = np.asarray(remain_years, dtype=float)
+        return self.curve.rate(np.full(remain_years.shape, self.curve.index[risk_free_curve]), remain_years)
+
+
+# Fill 'Straight Bond Value' and 'Interest Rate' of the stock table from the engine, the sheet values are kept
+# where the engine has no value
+def fill_straight_bond_value(data_stock, engine, bond_details, log=print):
+    """
+    data_stock: the 'Underlying_Values' table
+    engine: BondFloorEngine
+    bond_details: quote_detail payloads of the CBs, in the same order as data_stock['Quote'], for the issue and maturity dates
+    """
+    quotes = [quote_of(detail) for detail in bond_details]
+    bond_value = engine.bond_floor(data_stock['Quote'], [quote.get('issue_date') for quote in quotes],
+                                   [quote.get('maturity_date') for quote in quotes])
+    interest_rate = engine.risk_free_rate(pandas.to_numeric(data_stock['Remain Year'], errors='coerce'))
+    log('Straight Bond Value：' + str(int(np.count_nonzero(~np.isnan(bond_value)))) + '/' + str(len(quotes)) + ' from the yield curve')
+    data_stock = data_stock.copy()
+    for column, value in (('Straight Bond Value', bond_value), ('Interest Rate', interest_rate)):
+        sheet_value = pandas.to_numeric(data_stock[column], errors='coerce').to_numpy(dtype=float)
+        data_stock[column] = np.where(np.isnan(value), sheet_value, value)
+    return data_stock
@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+import time
+import subprocess
+import urllib.error
+import urllib.request
+from server import server_url, server_start_timeout, server_functions, server_secret_path, secret_header  # standard library only, imports in milliseconds
+
+
+# Thin client of the compute server (server.py) for the buttons of the workbook: RunPython "import client; client.refresh_all()"
+# The first click starts the server when it is not running, the next ones only post to it. Without a server, e.g.
+# when it cannot start, the function runs in this process like before, and so do the next clicks of the session
+server_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+server_failed = False   # the server did not start in this process, the next clicks run in-process without waiting for it again
+
+
+# Get the secret of the running server, written at its start, '' without a server
+def get_secret():
+    try:
+        with open(server_secret_path, encoding='utf-8') as secret_file:
+            return secret_file.read().strip()
+    except OSError:
+        return ''
+
+
+# Send a request to the server
+def request(path, payload=None, timeout=None):
+    """
+    path: e.g. '/health', '/run/refresh_all'
+    payload: JSON body of a POST, None for a GET
+    return: the JSON answer, also for the error statuses of the server
+    raise: OSError when the server is not reachable
+    """
+    data = None if payload is None else json.dumps(payload).encode('utf-8')
+    req = urllib.request.Request(server_url + path, data=data, headers={'Content-Type': 'application/json', secret_header: get_secret()})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return json.loads(error.read() or b'null')
+
+
+def is_running():
+    try:
+        return request('/health', timeout=1)['status'] == 'ok'
+    except (OSError, ValueError):
+        return False
+
+
+# Start the server in the background and wait until it answers
+def start_server(timeout=server_start_timeout):
+    """
+    return: True when the server answers within the timeout
+    """
+    flags = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP if sys.platform == 'win32' else 0
+    executable = sys.executable
+    if sys.platform == 'win32' and os.path.basename(executable).lower() == 'python.exe':
+        executable = os.path.join(os.path.dirname(executable), 'pythonw.exe')   # no console window next to Excel
+    subprocess.Popen([executable, server_script], cwd=os.path.dirname(server_script), creationflags=flags,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=sys.platform != 'win32')
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if is_running():
+            return True
+        time.sleep(0.2)
+    return False
+
+
+# Run a function of AutoArbitrage on the server, starting it if needed
+def run(function, **kwargs):
+    """
+    function: one of server.server_functions, e.g. 'refresh_all'
+    kwargs: keyword arguments of the function, JSON values
+    return: the answer of the server, {'ok', 'function', 'seconds', ...}
+    """
+    global server_failed
+    if server_failed or not is_running() and not start_server():
+        server_failed = True
+        print('Compute server：not available, running ' + function + ' in this process')
+        import AutoArbitrage
+        getattr(AutoArbitrage, function)(**kwargs)
+        return {'ok': True, 'function': function}
+    result = request('/run/' + function, kwargs)
+    if not result['ok']:
+        print(result.get('traceback') or result['error'])
+    return result
+
+
+# Get a latest table of the server, e.g. the ranking of 'DoubleLow'
+def get_table(name, top=None):
+    """
+    return: {'columns', 'index', 'data'}, None when the server has no such table yet or is not running
+    """
+    try:
+        return request('/tables/' + name + ('' if top is None else '?top=' + str(int(top))), timeout=5)
+    except OSError:
+        return None
+
+
+def get_stats():
+    return request('/stats', timeout=5)
+
+
+def stop_server():
+    return request('/shutdown', {}, timeout=5)
+
+
+# One client function per button, e.g. client.refresh_DoubleLow()
+def get_button(function):
+    def button(**kwargs):
+        return run(function, **kwargs)
+    button.__name__ = function
+    return button
+
+
+for _function in server_functions:
+    globals()[_function] = get_button(_function)
+
+
+if __name__ == "__main__":
+    # python client.py refresh_all | stats | stop
+    command = sys.argv[1] if len(sys.argv) > 1 else 'stats'
+    if command == 'stats':
+        print(json.dumps(get_stats(), indent=1, ensure_ascii=False))
+    elif command == 'stop':
+        print(stop_server())
+    else:
+        print(run(command))
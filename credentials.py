@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import threading
+import webbrowser
+import requests  # HTTP for Humans, https://requests.readthedocs.io/en/latest/
+from metrics import metrics
+
+
+token_cache_path = os.path.join(os.path.expanduser('~'), '.autoarbitrage', 'xq_a_token.json')   # token and expiry kept between runs
+token_url = 'https://xueqiu.com/'   # the home page sets a fresh xq_a_token cookie for every visitor
+token_lifetime = 24 * 3600   # seconds a token is trusted when its cookie has no expiry
+token_renew_margin = 600   # a token expiring within these seconds is renewed before use
+token_expired_codes = (400016, '400016')   # error_code of xueqiu.com when the xq_a_token is expired or invalid
+token_max_attempts = 10   # attempts to get a token before giving up, 10 minutes with the default retry interval
+
+
+# Tell whether a payload or a response of xueqiu.com rejects the token, i.e., error_code 400016
+def is_token_expired(payload):
+    if isinstance(payload, requests.Response):
+        try:
+            payload = payload.json()
+        except ValueError:
+            return False
+    return isinstance(payload, dict) and payload.get('error_code') in token_expired_codes
+
+
+# Keep the xq_a_token of xueqiu.com: acquired once, persisted with its expiry, renewed when it expires or is rejected.
+# Thread-safe, the fetcher threads hitting 400016 together trigger a single renewal. The lock is held while the token
+# sources are read, never while waiting for the next attempt.
+class TokenManager:
+    """
+    path: JSON file keeping the token and its expiry between runs, None to keep it in memory only
+    token: initial token, e.g. from a config, 'xq_a_token=...;' or the bare value, used when the file has no valid one
+    url: page setting a fresh xq_a_token cookie, None to never ask the website
+    browser: read the cookies of the local browsers (browser_cookie3), and open xueqiu.com when none is found
+    retry_interval: seconds between two attempts when no token is found
+    max_attempts: attempts before giving up with an exception, None to keep trying
+    log: print-like function
+    """
+    def __init__(self, path=token_cache_path, token=None, url=token_url, browser=True, retry_interval=60,
+                 max_attempts=token_max_attempts, timeout=10, log=print):
+        self.path = os.path.expanduser(path) if path else None
+        self.url = url
+        self.browser = browser
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.log = log
+        self.lock = threading.RLock()
+        self.value = None
+        self.expires = None
+        self.rejected = None   # last token rejected by the website, never taken again
+        self.load()
+        if token and not self.is_valid():   # a renewed token of the file wins over the initial one
+            self.value = token[len('xq_a_token='):].rstrip(';') if token.startswith('xq_a_token=') else token
+            self.expires = time.time() + token_lifetime
+
+    # Cookie header of the requests, e.g. 'xq_a_token=...;'
+    def cookie(self):
+        return 'xq_a_token=' + self.token() + ';'
+
+    # Current token, acquired only when there is none or it is about to expire
+    def token(self):
+        with self.lock:
+            if self.is_valid():
+                return self.value
+        return self.acquire()
+
+    def is_valid(self):
+        return self.value is not None and (self.expires is None or self.expires - time.time() > token_renew_margin)
+
+    # Replace a token rejected by the website, a token already replaced by another thread is kept
+    def renew(self, stale=None):
+        """
+        stale: the rejected cookie or token, None to renew unconditionally
+        return: the new cookie
+        """
+        stale = stale[len('xq_a_token='):].rstrip(';') if stale and stale.startswith('xq_a_token=') else stale
+        with self.lock:
+            if stale is None or self.value == stale:
+                metrics.inc('token_renewals_total', description='Renewals of the xq_a_token')
+                self.rejected = self.value
+                self.value, self.expires = None, None
+        return self.cookie()
+
+    # Get a new token: from the browser cookies first, then from the website, the rejected token is skipped.
+    # Every attempt re-checks the token under the lock first: a thread waiting for its next attempt takes the token
+    # another thread got meanwhile
+    def acquire(self):
+        attempt = 0
+        while True:
+            attempt += 1
+            with self.lock:
+                if self.is_valid():
+                    return self.value
+                for source in ([self.from_browser] if self.browser else []) + ([self.from_website] if self.url else []):
+                    try:
+                        value, expires = source()
+                    except Exception as error:
+                        self.log('get token, ' + source.__name__ + ' failed：' + str(error))
+                        continue
+                    if value and value != self.rejected and (expires is None or expires - time.time() > token_renew_margin):
+                        self.value, self.expires = value, expires if expires is not None else time.time() + token_lifetime
+                        self.log('get token, xq_a_token = ' + value[:6] + '..., expires ' + time.strftime('%Y-%m-%d %H:%M', time.localtime(self.expires)))
+                        self.save()
+                        return self.value
+            if self.max_attempts is not None and attempt >= self.max_attempts:
+                raise Exception('No valid xq_a_token after ' + str(attempt) + ' attempts')
+            self.log('get token, retrying ......')
+            metrics.inc('token_retries_total', description='Retries to get the xq_a_token')
+            if self.browser and attempt == 1:
+                webbrowser.open("https://xueqiu.com/")   # visiting the site stores a new cookie in the browser
+            time.sleep(self.retry_interval)
+
+    # Token of the browser cookies, scans the cookie databases of all browsers, i.e., slow
+    def from_browser(self):
+        import browser_cookie3  # Loads cookies used by your web browser into a cookiejar object, https://github.com/borisbabic/browser_cookie3
+        for item in browser_cookie3.load(domain_name='xueqiu.com'):
+            if item.name == 'xq_a_token':
+                return item.value, item.expires
+        return None, None
+
+    # Token set by the website for an anonymous visitor
+    def from_website(self):
+        response = requests.get(self.url, timeout=self.timeout,
+                                headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko)',
+                                         'Accept': 'text/html'})
+        for item in response.cookies:
+            if item.name == 'xq_a_token':
+                return item.value, item.expires
+        return None, None
+
+    def load(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as token_file:
+                cached = json.load(token_file)
+            self.value, self.expires = cached['token'], cached.get('expires')
+        except (ValueError, KeyError, OSError):
+            self.value, self.expires = None, None
+
+    # Write the token file atomically, readable by the user only
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        descriptor = os.open(self.path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as token_file:
+            json.dump({'token': self.value, 'expires': self.expires}, token_file)
+        os.replace(self.path + '.tmp', self.path)
+
+    # Forget the token, e.g. after logging out of xueqiu.com
+    def clear(self):
+        with self.lock:
+            self.value, self.expires = None, None
+            if self.path is not None and os.path.isfile(self.path):
+                os.remove(self.path)
@@ -0,0 +1,163 @@
+import os
+import heapq
+import atexit
+import numpy as np
+from multiprocessing import get_context, shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from metrics import metrics
+
+
+pricing_workers = None   # processes of the pricing pool, None for the number of cores
+min_parallel_size = 1000   # universes smaller than this are priced in-process, the pool costs more than it saves
+shards_per_worker = 2   # shards of the universe per process, the pool hands the next shard to the first free process
+
+
+# Copy an array into a new shared memory block
+def get_shared_array(values):
+    """
+    return: (shared memory block, (name, shape, dtype) to attach it in a worker)
+    """
+    values = np.ascontiguousarray(values)
+    block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+    np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[...] = values
+    return block, (block.name, values.shape, values.dtype.str)
+
+
+def attach_shared_array(spec):
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+
+# Split the universe into shards of about the same estimated cost, longest processing time first
+def get_shards(costs, count):
+    """
+    costs: estimated cost of every element, e.g. 0 for the elements with invalid inputs
+    count: number of shards
+    return: list of sorted index arrays, empty shards dropped
+    """
+    costs = np.asarray(costs, dtype=float)
+    count = max(1, min(count, costs.size))
+    heap = [(0.0, shard) for shard in range(count)]
+    assignment = np.empty(costs.size, dtype=np.intp)
+    for i in np.argsort(-costs, kind='stable'):   # every element goes to the least loaded shard
+        load, shard = heapq.heappop(heap)
+        assignment[i] = shard
+        heapq.heappush(heap, (load + costs[i], shard))
+    order = np.argsort(assignment, kind='stable')   # indexes of every shard, ascending
+    bounds = np.searchsorted(assignment[order], np.arange(count + 1))
+    return [order[bounds[k]:bounds[k + 1]] for k in range(count) if bounds[k + 1] > bounds[k]]
+
+
+# Price one shard in a worker process: read the inputs from shared memory, write the results into shared memory
+def run_shard(function, input_specs, output_specs, index, kwargs):
+    blocks = []
+    try:
+        inputs = []
+        for spec in input_specs:
+            block, values = attach_shared_array(spec)
+            blocks.append(block)
+            inputs.append(values[index])   # gathered copy of the shard
+        results = function(*inputs, **kwargs)
+        results = results if isinstance(results, tuple) else (results,)
+        for spec, result in zip(output_specs, results):
+            block, values = attach_shared_array(spec)
+            blocks.append(block)
+            values[index] = result
+        values = None   # no view may outlive its block
+        return index.size
+    finally:
+        for block in blocks:
+            block.close()
+
+
+# Run a batched pricing function over the bond universe on a process pool: the universe is split into shards of
+# about the same estimated cost, the input and output arrays go through shared memory, never pickled.
+# Small universes, a single core or a broken pool run in-process with the same results.
+class PricingExecutor:
+    """
+    workers: processes of the pool, None for pricing_workers, i.e., the number of cores
+    min_size: universes smaller than this are priced in-process
+    shards_per_worker: shards of the universe per process
+    start_method: 'fork', 'spawn' or 'forkserver', None for the default of the platform
+    """
+    def __init__(self, workers=None, min_size=min_parallel_size, shards_per_worker=shards_per_worker, start_method=None, log=print):
+        self.workers = workers or pricing_workers or os.cpu_count() or 1
+        self.min_size = min_size
+        self.shards_per_worker = shards_per_worker
+        self.start_method = start_method
+        self.log = log
+        self.pool = None
+
+    # Price all elements, function(*arrays, **kwargs) returns one array, or a tuple of `outputs` arrays, per element
+    def map(self, function, *arrays, costs=None, outputs=1, **kwargs):
+        """
+        function: batched function defined at module level, e.g. pricing.cb_lattice_batch
+        arrays: inputs, broadcast together and flattened
+        costs: estimated cost of every element, None for the same cost
+        outputs: number of arrays returned by function
+        kwargs: scalar arguments passed to every call, e.g. steps=200
+        return: the float array of function, or a tuple of them, with the broadcast shape of the arrays
+        """
+        arrays = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in arrays))
+        shape = arrays[0].shape
+        arrays = [x.ravel() for x in arrays]
+        size = arrays[0].size
+        if self.workers <= 1 or size < self.min_size:
+            results = self.run_local(function, arrays, kwargs)
+        else:
+            try:
+                results = self.run_pool(function, arrays, costs, outputs, kwargs)
+            except (BrokenProcessPool, OSError) as error:
+                self.log('pricing pool failed, pricing in-process：' + str(error))
+                self.close()
+                results = self.run_local(function, arrays, kwargs)
+        results = tuple(np.asarray(result, dtype=float).reshape(shape) for result in results)
+        return results if outputs > 1 else results[0]
+
+    def run_local(self, function, arrays, kwargs):
+        metrics.inc('pricing_shards_total', description='Shards priced by the pricing executor', mode='local')
+        results = function(*arrays, **kwargs)
+        return results if isinstance(results, tuple) else (results,)
+
+    def run_pool(self, function, arrays, costs, outputs, kwargs):
+        size = arrays[0].size
+        costs = np.ones(size) if costs is None else np.broadcast_to(np.asarray(costs, dtype=float), (size,))
+        blocks = []
+        try:
+            input_specs, output_specs, results = [], [], []
+            for values in arrays:
+                block, spec = get_shared_array(values)
+                blocks.append(block)
+                input_specs.append(spec)
+            for _ in range(outputs):
+                block, spec = get_shared_array(np.full(size, np.nan))
+                blocks.append(block)
+                output_specs.append(spec)
+                results.append(np.ndarray(size, dtype=float, buffer=block.buf))
+            pool = self.get_pool()
+            futures = [pool.submit(run_shard, function, input_specs, output_specs, index, kwargs)
+                       for index in get_shards(costs, self.workers * self.shards_per_worker)]
+            for future in futures:
+                future.result()
+            metrics.inc('pricing_shards_total', len(futures), description='Shards priced by the pricing executor', mode='pool')
+            return tuple(result.copy() for result in results)   # copied out before the blocks are released
+        finally:
+            results = None
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    # Pool kept between the refreshes, started on first use
+    def get_pool(self):
+        if self.pool is None:
+            context = get_context(self.start_method) if self.start_method else None
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            atexit.register(self.close)
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
@@ -0,0 +1,359 @@
+import os
+import time
+import sys
+import json
+import argparse
+import pandas
+from credentials import TokenManager, token_url
+from quotes import QuoteCache, QuoteFetcher, SnowballTransport, quote_detail_url, kline_url, quotec_url
+from volatility import VolatilityEngine, get_kline_fetcher, fill_realized_volatility
+from bondfloor import BondFloorEngine, fill_straight_bond_value, bond_floor_fields
+from streaming import StreamingRefresher, get_realtime_fetcher, streaming_interval
+from snapshots import SnapshotStore
+from strategies import strategy_specs, load_strategy_specs
+from metrics import metrics
+from executor import PricingExecutor
+from kmv import KMVCalibrator
+from alerts import AlertEngine, get_alert_sinks, load_alert_rules
+from scheduler import TradingCalendar, RefreshScheduler, calendar_cache_path, close_time, get_exchange_time
+from pipeline import (convertible_bond_columns, underlying_input_columns, StageTimer, get_bond_symbol,
+                      build_convertible_bond_table, select_underlyings, build_underlying_table, rank_strategies,
+                      get_display_table, get_scenario_engine, get_greeks_table)
+
+
+# Run the refresh, pricing and ranking pipeline without Excel, e.g. on a Linux server:
+#     python headless.py headless_config.json
+# The config is a JSON file, see headless_config.example.json:
+#     bonds: CSV/Parquet/Excel file with a 'Quote' column, the CBs to refresh
+#     underlying_inputs: CSV/Parquet/Excel file with 'Quote' and the hand-maintained columns of 'Underlying_Values',
+#                        i.e., Interest Rate, Realized Volatility, Putable Price, Callable Price, Straight Bond Value
+#     interest_rate: default Interest Rate (%) for bonds without one, e.g. the China 10-Year Government Bond Yield
+#     parameters: the threshold and weight cells of the sheets, {sheet name: {cell: value}}
+#     underlying_rows: number of CBs priced in the stock table, null for all
+#     token: xq_a_token cookie, defaults to the XUEQIUTOKEN environment variable (same as pysnowball). Renewed from
+#            the website when rejected (400016)
+#     token_cache: JSON file keeping the token and its expiry between runs, e.g. "~/.autoarbitrage/xq_a_token.json"
+#     token_url: page setting a fresh token cookie, null to never renew the token
+#     quote_url, kline_url, quotec_url, quote_max_workers, quote_rate_limit, quote_timeout, quote_retries: see quotes.QuoteFetcher
+#     history_dir: local cache of the daily k-line history, 'Realized Volatility' is computed from it. null to keep the inputs.
+#                  Also keeps kmv.json, the last DtD calibration, the first iterates of the next one
+#     realized_volatility_window: trading days of the realized volatility, 250 by default, i.e., the last 12 months
+#     yield_curve: CSV file of the yield curves, 'Straight Bond Value' and 'Interest Rate' are computed from it, see
+#                  yield_curve.example.csv. null to keep the inputs
+#     bond_terms: CSV file of the coupon terms of the CBs, see bond_terms.example.csv
+#     strategies: optional JSON file of extra strategy specs, see strategies.strategy_specs
+#     streaming_interval, streaming_until: poll cadence (seconds) in session and stop time ('HH:MM', Beijing time) of --stream
+#     phase_intervals: poll cadence (seconds) of the other phases, e.g. {"pre-open": 60, "after-close": 300}, see scheduler.phase_intervals
+#     calendar_cache: JSON file of the exchange holidays per year, see scheduler.TradingCalendar. Weekends and holidays
+#                     are never polled, --schedule runs the pipeline once per trading day
+#     convertible_bond_model: 'bs' (default) for the straight bond value plus a Black-Scholes call, 'lattice' to value the
+#                             CBs on a lattice with their soft call, put and conversion, see pipeline.price_underlying_table
+#     pricing_workers: processes pricing the CB lattices of large universes, null for the number of cores, 1 for in-process
+#     greeks: add the 'Greeks' table (delta, gamma, vega, theta, rho of every CB) to the outputs
+#     scenarios: revalue every CB under a grid of shocks, written as a compressed .npz, see scenarios.ScenarioEngine.grid:
+#                {"path": "output/scenarios.npz", "spot_shocks": [-0.2, ..., 0.2], "vol_shocks": [-0.1, ..., 0.1], "rate_shocks": [0]}
+#     alerts: alert rules evaluated on every update of --stream, see alerts.alert_rules:
+#             {"rules": optional JSON file of extra rules, "sinks": [{"type": "webhook", "url": "..."}, {"type": "file", "path": "alerts.jsonl"}, {"type": "stdout"}]}
+#     metrics_dir: directory of the Prometheus text file and the JSON summary of the run, enables the metrics, see metrics.py
+#     metrics_port: serve /metrics and /summary on this port while running, enables the metrics
+#     sinks: list of outputs, e.g. [{"type": "csv", "path": "output"}, {"type": "snapshots", "path": "snapshots"}, {"type": "stdout"}]
+
+
+# Load a table from a CSV, Parquet or Excel file
+def load_table(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.parquet':
+        return pandas.read_parquet(path)
+    elif extension in ('.xlsx', '.xlsm', '.xls'):
+        return pandas.read_excel(path)
+    return pandas.read_csv(path, dtype={'Quote': str})
+
+
+# Write every table into a CSV file named after it
+class CsvSink:
+    def __init__(self, path='output'):
+        self.path = path
+
+    def write(self, tables):
+        os.makedirs(self.path, exist_ok=True)
+        for name, table in tables.items():
+            table.to_csv(os.path.join(self.path, name + '.csv'), encoding='utf-8-sig')
+
+
+# Write every table into a Parquet file named after it, needs pyarrow or fastparquet
+class ParquetSink:
+    def __init__(self, path='output'):
+        self.path = path
+
+    def write(self, tables):
+        os.makedirs(self.path, exist_ok=True)
+        for name, table in tables.items():
+            table.to_parquet(os.path.join(self.path, name + '.parquet'))
+
+
+# Print every table in the console
+class StdoutSink:
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def write(self, tables):
+        for name, table in tables.items():
+            print('------------ ' + name + ' ------------', file=self.stream or sys.stdout)
+            print(get_display_table(table), file=self.stream or sys.stdout)
+
+
+# Append every table to the snapshot store, see snapshots.SnapshotStore
+class SnapshotSink:
+    def __init__(self, path='snapshots'):
+        self.store = SnapshotStore(path)
+
+    def write(self, tables):
+        snapshot_time = time.time()
+        for name, table in tables.items():
+            self.store.append(name, table, snapshot_time)
+
+
+# Write the tables into the workbook at the same cells as the Excel buttons, needs Excel and xlwings
+class WorkbookSink:
+    def __init__(self, path='AutoArbitrage.xlsm'):
+        self.path = path
+
+    def write(self, tables):
+        import xlwings
+        wb = xlwings.Book(self.path)
+        for name, table in tables.items():
+            if name in ('RealTimeData_ConvertibleBond', 'Underlying_Values'):
+                wb.sheets[name].range('A7').value = get_display_table(table)
+            elif name in strategy_specs:
+                wb.sheets[strategy_specs[name]['destination'][0]].range(strategy_specs[name]['destination'][1]).value = table
+        wb.save()
+
+
+sink_types = {'csv': CsvSink, 'parquet': ParquetSink, 'stdout': StdoutSink, 'workbook': WorkbookSink, 'snapshots': SnapshotSink}
+
+
+# Build the sinks of a config, e.g. [{"type": "csv", "path": "output"}]
+def get_sinks(config):
+    sinks = []
+    for sink in config.get('sinks', [{'type': 'stdout'}]):
+        sink = dict(sink)
+        sinks.append(sink_types[sink.pop('type')](**sink))
+    return sinks
+
+
+# Get the token manager of a config: the token of the config, else the token file, else a new token from the website
+def get_token_manager(config):
+    return TokenManager(config.get('token_cache'), token=config.get('token') or os.environ.get('XUEQIUTOKEN'),
+                        url=config.get('token_url', token_url), browser=False, retry_interval=5, max_attempts=3)
+
+
+# Build the quote fetcher of a config
+def get_quote_fetcher(config, token_manager=None):
+    """
+    token_manager: TokenManager shared by the fetchers of a run, a new one if None
+    """
+    max_workers = config.get('quote_max_workers', 8)
+    token_manager = get_token_manager(config) if token_manager is None else token_manager
+    return QuoteFetcher(SnowballTransport(token_manager, pool_size=max_workers, base_url=config.get('quote_url', quote_detail_url),
+                                          kline_url=config.get('kline_url', kline_url), quotec_url=config.get('quotec_url', quotec_url),
+                                          retries=config.get('quote_retries', 3)),
+                        max_workers=max_workers, rate_limit=config.get('quote_rate_limit', 20), timeout=config.get('quote_timeout', 10))
+
+
+pricing_executors = {}   # pricing_workers -> PricingExecutor, the pools are kept between the runs
+
+
+# Get the pricing executor of a config, see executor.PricingExecutor
+def get_pricing_executor(config):
+    workers = config.get('pricing_workers')
+    if workers not in pricing_executors:
+        pricing_executors[workers] = PricingExecutor(workers=workers)
+    return pricing_executors[workers]
+
+
+kmv_calibrators = {}   # solutions path -> KMVCalibrator, warm-started between the runs of --schedule
+
+
+# Get the DtD calibrator of a config: the solutions are kept in the history_dir, in memory without one
+def get_kmv_calibrator(config):
+    path = os.path.join(config['history_dir'], 'kmv.json') if config.get('history_dir') else None
+    if path not in kmv_calibrators:
+        kmv_calibrators[path] = KMVCalibrator(path)
+    return kmv_calibrators[path]
+
+
+# Fill the hand-maintained columns of the stock table from the inputs file, by Quote
+def merge_underlying_inputs(data_stock, inputs, interest_rate=None):
+    data_stock = data_stock.reset_index(drop=True)
+    if inputs is not None:
+        inputs = inputs.assign(Quote=inputs['Quote'].astype(str)).drop_duplicates('Quote').set_index('Quote')
+        quotes = data_stock['Quote'].astype(str)
+        for column in underlying_input_columns:
+            if column in inputs.columns:
+                data_stock[column] = quotes.map(inputs[column]).to_numpy()
+    if interest_rate is not None:
+        if 'Interest Rate' not in data_stock.columns:
+            data_stock['Interest Rate'] = interest_rate
+        data_stock['Interest Rate'] = pandas.to_numeric(data_stock['Interest Rate'], errors='coerce').fillna(interest_rate)
+    return data_stock
+
+
+# Run the refresh, pricing and ranking pipeline on in-memory DataFrames
+def run_pipeline(config, quote_cache=None, log=print, timer=None):
+    """
+    config: dict, see the top of this file
+    quote_cache: QuoteCache shared between runs, a new one if None
+    timer: StageTimer recording the time of every stage
+    return: dict of table name -> DataFrame, i.e., 'RealTimeData_ConvertibleBond', 'Underlying_Values' and the strategies
+    """
+    pandas.options.display.max_columns = None
+    pandas.options.display.max_rows = None
+    timer = StageTimer() if timer is None else timer
+    quote_fetcher = get_quote_fetcher(config)
+    quote_cache = QuoteCache() if quote_cache is None else quote_cache
+    if config.get('strategies'):
+        load_strategy_specs(config['strategies'])
+
+    log("------------ Refresh Convertible Bond Data ------------")
+    with timer.stage('read inputs'):
+        bonds = load_table(config['bonds'])
+        inputs = load_table(config['underlying_inputs']) if config.get('underlying_inputs') else None
+    data_fund = pandas.DataFrame({'Quote': bonds['Quote'].astype(str)}).reindex(columns=convertible_bond_columns)
+    with timer.stage('fetch bonds'):
+        details = quote_cache.get_many([get_bond_symbol(fund_code) for fund_code in data_fund['Quote']], 'realtime', quote_fetcher)
+    with timer.stage('build CB table'):
+        data_fund = build_convertible_bond_table(data_fund, details, log=log)
+
+    log("------------ Refresh Underlying Values ------------")
+    data_stock = select_underlyings(data_fund, rows=config.get('underlying_rows'))
+    data_stock = merge_underlying_inputs(data_stock, inputs, config.get('interest_rate'))
+    with timer.stage('fetch stocks'):
+        details = quote_cache.get_many(data_stock['Stock Quote'], 'realtime', quote_fetcher)
+    if config.get('history_dir'):
+        with timer.stage('realized volatility'):
+            data_stock = fill_realized_volatility(data_stock, VolatilityEngine(config['history_dir']), get_kline_fetcher(quote_fetcher),
+                                                  config.get('realized_volatility_window', 250), log=log)
+    if config.get('yield_curve'):
+        with timer.stage('straight bond value'):
+            bond_details = quote_cache.get_many([get_bond_symbol(fund_code) for fund_code in data_stock['Quote']], bond_floor_fields, quote_fetcher)
+            data_stock = fill_straight_bond_value(data_stock, BondFloorEngine(config['yield_curve'], config.get('bond_terms')), bond_details, log=log)
+    quote_fetcher.close()
+    log('Quote Cache：' + str(quote_cache.stats()))
+    with timer.stage('pricing'):
+        calibrator = get_kmv_calibrator(config)
+        data_stock = build_underlying_table(data_stock, details, log=log, model=config.get('convertible_bond_model'),
+                                            executor=get_pricing_executor(config), calibrator=calibrator)
+        calibrator.prune(data_stock['Quote'])
+        calibrator.save()
+
+    rankings = rank_strategies(data_fund, data_stock, config.get('parameters', {}), log=log, timer=timer)
+    tables = {'RealTimeData_ConvertibleBond': data_fund, 'Underlying_Values': data_stock, **rankings}
+    if config.get('greeks') or config.get('scenarios'):
+        with timer.stage('greeks & scenarios'):
+            engine = get_scenario_engine(data_stock)
+            if config.get('greeks'):
+                tables['Greeks'] = get_greeks_table(data_stock, engine)
+            if config.get('scenarios'):
+                write_scenarios(engine, data_stock, config['scenarios'])
+    return tables
+
+
+# Revalue the CBs of the stock table under the grid of shocks of a config, and write the cube, see ScenarioEngine.save
+def write_scenarios(engine, data_stock, scenarios):
+    shocks = {name: scenarios[name] for name in ('spot_shocks', 'vol_shocks', 'rate_shocks') if name in scenarios}
+    path = scenarios.get('path', os.path.join('output', 'scenarios.npz'))
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    engine.save(path, quotes=list(data_stock['Quote']), **shocks)
+
+
+# Build the alert engine of a config, None without an 'alerts' entry
+def get_alert_engine(config, log=print):
+    alerts = config.get('alerts')
+    if not alerts:
+        return None
+    if alerts.get('rules'):
+        load_alert_rules(alerts['rules'])
+    return AlertEngine(get_alert_sinks(alerts.get('sinks', [{'type': 'stdout'}])), config.get('parameters', {}), log=log)
+
+
+# Keep the tables of run_pipeline fresh until the stop time, the sinks get the tables changed by every poll
+def stream_pipeline(config, tables, sinks, log=print):
+    quote_fetcher = get_quote_fetcher(config)
+    streamer = StreamingRefresher(tables['RealTimeData_ConvertibleBond'], tables['Underlying_Values'], config.get('parameters', {}),
+                                  get_realtime_fetcher(quote_fetcher), names=[name for name in tables if name in strategy_specs], log=log,
+                                  calibrator=get_kmv_calibrator(config), model=config.get('convertible_bond_model'))
+
+    alert_engine = get_alert_engine(config, log=log)
+    if alert_engine is not None:
+        alert_engine.submit({'RealTimeData_ConvertibleBond': streamer.data_fund, 'Underlying_Values': streamer.data_stock, **streamer.rankings})
+
+    def on_update(updated):
+        if alert_engine is not None:
+            alert_engine.submit(updated)
+        for sink in sinks:
+            sink.write(updated)
+        if config.get('metrics_dir'):
+            metrics.write(config['metrics_dir'])
+    try:
+        until = config.get('streaming_until', '15:00')
+        streamer.run(on_update, config.get('streaming_interval', streaming_interval), stop=lambda: get_exchange_time().strftime('%H:%M') >= until,
+                     calendar=get_trading_calendar(config, log), intervals=config.get('phase_intervals'))
+    finally:
+        if alert_engine is not None:
+            alert_engine.stop()
+        quote_fetcher.close()
+    return streamer
+
+
+trading_calendars = {}   # calendar cache path -> TradingCalendar, loaded once per process
+
+
+def get_trading_calendar(config, log=print):
+    path = config.get('calendar_cache', calendar_cache_path)
+    if path not in trading_calendars:
+        trading_calendars[path] = TradingCalendar(path, log=log)
+    return trading_calendars[path]
+
+
+# Refresh once, write the sinks, then stream if asked
+def run_once(config, stream=False, log=print):
+    metrics.start_run('headless')
+    timer = StageTimer()
+    quote_cache = QuoteCache()
+    tables = run_pipeline(config, quote_cache=quote_cache, log=log, timer=timer)
+    with timer.stage('write'):
+        for sink in get_sinks(config):
+            sink.write(tables)
+    print("------------ Refresh Time ------------")
+    print(timer.report())
+    if config.get('metrics_dir'):
+        metrics.write(config['metrics_dir'], quote_cache=quote_cache.stats())
+    if stream:
+        stream_pipeline(config, tables, get_sinks(config), log=log)
+    return tables
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Refresh, price and rank the convertible bonds without Excel')
+    parser.add_argument('config', help='JSON config file, see headless_config.example.json')
+    parser.add_argument('--quiet', action='store_true', help='do not print the per-bond logs')
+    parser.add_argument('--stream', action='store_true', help='keep polling in trading hours, only the changed rows are re-computed')
+    parser.add_argument('--schedule', action='store_true', help='keep running: refresh and stream once per trading day, from the pre-open')
+    args = parser.parse_args(argv)
+
+    with open(args.config, encoding='utf-8') as config_file:
+        config = json.load(config_file)
+    if config.get('metrics_dir') or config.get('metrics_port'):
+        metrics.enable()
+    if config.get('metrics_port'):
+        metrics.serve(config['metrics_port'])
+    log = (lambda *a: None) if args.quiet else print
+    if args.schedule:
+        config = {**config, 'streaming_until': config.get('streaming_until', close_time)}
+        RefreshScheduler({}, calendar=get_trading_calendar(config), daily=lambda: run_once(config, stream=True, log=log)).run()
+    else:
+        run_once(config, stream=args.stream, log=log)
+
+
+if __name__ == "__main__":
+    main()
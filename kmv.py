@@ -0,0 +1,49 @@
+import os
+import json
+import numpy as np
+from pricing import merton_kmv_batch
+
+
+# Calibrated distances to default of the CB issuers, KMV style: the asset value and the asset volatility of every issuer
+# are backed out of its equity, see pricing.merton_kmv_batch. The leverage is measured per 100 face of the CB, the
+# conversion value as the equity and the straight bond value as the debt barrier, the same inputs as the Merton_DtD proxy.
+# The solutions are kept per CB, as the asset/(equity + discounted debt) ratio and the asset volatility, and are the
+# first iterates of the next calibration: a day or a tick later they are a couple of Newton steps away.
+class KMVCalibrator:
+    """
+    path: JSON file keeping the solutions between runs, {Quote: [asset ratio, asset volatility]}, None to keep them in memory only
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.solutions = {}
+        if path and os.path.isfile(path):
+            with open(path, encoding='utf-8') as solution_file:
+                self.solutions = {quote: tuple(values) for quote, values in json.load(solution_file).items()}
+
+    # Keep the solutions of these CBs only, e.g. the stock table of a full refresh: the matured and delisted CBs are dropped
+    def prune(self, quotes):
+        quotes = set(quotes)
+        self.solutions = {quote: values for quote, values in self.solutions.items() if quote in quotes}
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, 'w', encoding='utf-8') as solution_file:
+            json.dump({quote: list(values) for quote, values in self.solutions.items()}, solution_file)
+
+    # Calibrate every CB at once, warm-started from the last solutions
+    def calibrate(self, quotes, E, sigma_E, D, T, r, q):
+        """
+        quotes: CB quotes, the keys of the solutions
+        E, sigma_E, D, T, r, q: see pricing.merton_kmv_batch
+        return: asset values, asset volatilities and distances to default, NaN where not calibrated
+        """
+        E, sigma_E, D, T, r, q = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (E, sigma_E, D, T, r, q)))
+        with np.errstate(invalid='ignore', over='ignore'):
+            cold_V = E + D * np.exp(-r * T)
+        last = np.array([self.solutions.get(quote, (np.nan, np.nan)) for quote in quotes], dtype=float).reshape(-1, 2)
+        V, sigma_V, DtD = merton_kmv_batch(E, sigma_E, D, T, r, q, V0=last[:, 0] * cold_V, sigma_V0=last[:, 1])
+        solved = np.isfinite(V)
+        self.solutions.update(zip(np.asarray(quotes, dtype=object)[solved], zip((V / cold_V)[solved].tolist(), sigma_V[solved].tolist())))
+        return V, sigma_V, DtD
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Buckets of the histograms, in seconds for the latencies
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+iteration_buckets = (1, 2, 3, 5, 8, 13, 21, 34, 55, 100, 200)
+
+
+@contextmanager
+def null_timer():
+    yield
+
+
+# Counters, histograms, per-stage and per-symbol timers of the refresh runs, exposed as Prometheus text and a JSON summary.
+# Disabled by default: every call returns at once, set AUTOARBITRAGE_METRICS=1 or call enable() to record.
+class Metrics:
+    """
+    enabled: record the metrics
+    prefix: prefix of the Prometheus metric names
+    """
+    def __init__(self, enabled=False, prefix='autoarbitrage_'):
+        self.enabled = enabled
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}   # (name, labels) -> value
+        self.histograms = {}   # (name, labels) -> [bucket counts, sum, count]
+        self.buckets = {}   # name -> bucket upper bounds
+        self.help = {}   # name -> description
+        self.server = None
+        self.start_run()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        return self
+
+    # Clear the per-run timers, the counters and histograms keep growing like Prometheus counters
+    def start_run(self, name='refresh'):
+        self.run_name = name
+        self.run_started = time.time()
+        self.stages = {}   # stage -> seconds
+        self.symbols = {}   # symbol -> seconds of its last request
+
+    def inc(self, name, value=1, description=None, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            if description:
+                self.help[name] = description
+
+    def observe(self, name, value, buckets=latency_buckets, description=None, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            bounds = self.buckets.setdefault(name, tuple(buckets))
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(bounds), 0.0, 0]
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+            if description:
+                self.help[name] = description
+
+    # Observe many values at once, e.g. the solver iterations of every bond
+    def observe_many(self, name, values, buckets=latency_buckets, description=None, **labels):
+        if not self.enabled:
+            return
+        import numpy as np
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[np.isfinite(values)]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            bounds = self.buckets.setdefault(name, tuple(buckets))
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(bounds), 0.0, 0]
+            for i, bound in enumerate(bounds):
+                histogram[0][i] += int(np.count_nonzero(values <= bound))
+            histogram[1] += float(values.sum())
+            histogram[2] += int(values.size)
+            if description:
+                self.help[name] = description
+
+    # Record the seconds of a stage of the run, e.g. 'fetch bonds', see pipeline.StageTimer
+    def record_stage(self, stage, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self.observe('stage_seconds', seconds, description='Seconds of every stage of a refresh', stage=stage)
+
+    # Record the latency of the request of one symbol, see quotes.QuoteFetcher
+    def record_request(self, symbol, seconds, endpoint='quote'):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.symbols[str(symbol)] = seconds
+        self.observe('request_seconds', seconds, description='Latency of the data source requests', endpoint=endpoint)
+
+    # Time a block as a stage of the run
+    def timer(self, stage):
+        if not self.enabled:
+            return null_timer()
+        return self.stage_timer(stage)
+
+    @contextmanager
+    def stage_timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(stage, time.perf_counter() - start)
+
+    # Prometheus text exposition format
+    def render_prometheus(self):
+        lines = []
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(value[0]), value[1], value[2]) for key, value in self.histograms.items()}
+        for name in sorted({name for name, labels in counters}):
+            full_name = self.prefix + name
+            lines.append('# HELP ' + full_name + ' ' + self.help.get(name, name))
+            lines.append('# TYPE ' + full_name + ' counter')
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(full_name + format_labels(labels) + ' ' + repr(float(value)))
+        for name in sorted({name for name, labels in histograms}):
+            full_name = self.prefix + name
+            lines.append('# HELP ' + full_name + ' ' + self.help.get(name, name))
+            lines.append('# TYPE ' + full_name + ' histogram')
+            for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, bucket_count in zip(self.buckets[name], counts):
+                    lines.append(full_name + '_bucket' + format_labels(labels + (('le', repr(float(bound))),)) + ' ' + str(bucket_count))
+                lines.append(full_name + '_bucket' + format_labels(labels + (('le', '+Inf'),)) + ' ' + str(count))
+                lines.append(full_name + '_sum' + format_labels(labels) + ' ' + repr(float(total)))
+                lines.append(full_name + '_count' + format_labels(labels) + ' ' + str(count))
+        return '\n'.join(lines) + '\n'
+
+    # JSON summary of the run: stages, slowest symbols, counters and histogram averages
+    def summary(self, slowest=20, **extra):
+        with self.lock:
+            stages = dict(self.stages)
+            symbols = sorted(self.symbols.items(), key=lambda item: -item[1])[:slowest]
+            counters = {name + format_labels(labels): value for (name, labels), value in sorted(self.counters.items())}
+            histograms = {name + format_labels(labels): {'count': count, 'sum': total, 'mean': total / count if count else None}
+                          for (name, labels), (counts, total, count) in sorted(self.histograms.items())}
+        return {'run': self.run_name, 'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.run_started)),
+                'seconds': time.time() - self.run_started, 'stages': stages, 'slowest_symbols': dict(symbols),
+                'counters': counters, 'histograms': histograms, **extra}
+
+    # Write the Prometheus text file (for the node_exporter textfile collector) and the JSON summary of the run
+    def write(self, path='metrics', **extra):
+        if not self.enabled:
+            return
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'autoarbitrage.prom.tmp'), 'w', encoding='utf-8') as prom_file:
+            prom_file.write(self.render_prometheus())
+        os.replace(os.path.join(path, 'autoarbitrage.prom.tmp'), os.path.join(path, 'autoarbitrage.prom'))
+        with open(os.path.join(path, 'last_run.json'), 'w', encoding='utf-8') as summary_file:
+            json.dump(self.summary(**extra), summary_file, indent=2, ensure_ascii=False, default=str)
+
+    # Serve /metrics (Prometheus text) and /summary (JSON) on a background thread
+    def serve(self, port=9108, host='127.0.0.1'):
+        if self.server is not None:
+            return self.server
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith('/summary'):
+                    body, content_type = json.dumps(metrics.summary(), default=str).encode(), 'application/json'
+                else:
+                    body, content_type = metrics.render_prometheus().encode(), 'text/plain; version=0.0.4'
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+
+# Format Prometheus labels, (('stage', 'fetch'),) -> '{stage="fetch"}'
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for name, value in labels) + '}'
+
+
+metrics = Metrics(enabled=os.environ.get('AUTOARBITRAGE_METRICS', '') not in ('', '0'))   # shared by all modules
@@ -0,0 +1,405 @@
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas
+from quotes import quote_of
+from snapshots import get_quote_text
+from metrics import metrics
+from pricing import bs_option_batch, implied_volatility_batch, cb_lattice_batch, cb_implied_volatility_batch
+from strategies import strategy_specs, get_table_arrays, rank_strategy_spec
+from executor import PricingExecutor
+from scenarios import ScenarioEngine
+from kmv import KMVCalibrator
+from scheduler import get_exchange_time
+
+
+# Columns of the CB table, sheet 'RealTimeData_ConvertibleBond'
+convertible_bond_columns = ['Quote', 'Name', 'Current', 'Change', 'Conversion Price', 'Conversion Value', 'Premium Rate', 'Double Low',        # columns=['转债代码', '转债名称', '当前价', '涨跌幅', '转股价', '转股价值', '溢价率', '双低值',
+                            'Issue Date', 'Maturity Date', 'Remain Year', 'Outstanding Amount (m)', 'Amount (k)', 'Turnover Rate',    # '发行时间', '到期时间', '剩余年限', '剩余规模', '成交金额', '换手率', '税前收益', '最高价', '最低价',
+                            'Benefit Before Tax', 'Day High', 'Day Low', 'Amplitude', 'Stock Quote']  # '振幅', '正股代码']
+
+# Columns of the stock table, sheet 'Underlying_Values'
+underlying_columns = ['Quote', 'Name', 'Current', 'Conversion Price', 'Conversion Value', 'Remain Year',
+                      'Premium Rate', 'Stock Quote', 'Stock Name', 'Stock Current', 'Dividend',
+                      'Interest Rate', 'Realized Volatility', 'Implied Volitality', 'Differential Volitality',
+                      'Putable Price', 'Callable Price', 'Straight Bond Value', 'Option Value', 'Option Price',
+                      'Theoretical Value', 'Bias', 'DtD']
+
+# Columns copied from the CB table into the stock table
+underlying_source_columns = ['Quote', 'Name', 'Current', 'Conversion Price', 'Conversion Value', 'Remain Year', 'Premium Rate', 'Stock Quote']
+
+# Hand-maintained inputs of the stock table, not provided by the data source
+underlying_input_columns = ['Interest Rate', 'Realized Volatility', 'Putable Price', 'Callable Price', 'Straight Bond Value']
+
+# Schema of the tables: text columns, category columns and the suspension mask, every other column is float64
+text_columns = ['Quote', 'Name', 'Stock Quote', 'Stock Name']
+category_columns = ['Issue Date', 'Maturity Date']   # few distinct values, kept as pandas categories
+suspended_column = 'Suspended'   # bool mask of the suspended CBs, the last column of the tables, never written to the sheets
+suspended_text = '停牌'   # ‘suspended’, shown in the sheets instead of the missing values of a suspended CB
+suspension_columns = ['Change', 'Premium Rate', 'Benefit Before Tax', 'Amplitude']   # columns showing '停牌' in the sheets
+
+convertible_bond_model = 'bs'   # 'bs': straight bond + Black-Scholes call, 'lattice': CB lattice with soft call, put and conversion
+lattice_steps = 200   # time steps of the CB lattice, see pricing.cb_lattice_batch
+lattice_method = 'binomial'   # or 'trinomial'
+pricing_executor = PricingExecutor()   # shards the lattice pricing of large universes over the cores, see executor.py
+kmv_calibrator = KMVCalibrator()   # DtD of the issuers, warm-started from the last calibration, see kmv.py
+
+
+# Get the data source symbol of a CB quote, SH for 11xxxx/13xxxx and SZ for 12xxxx
+def get_bond_symbol(fund_code):
+    if str(fund_code).startswith('11') or str(fund_code).startswith('13'):
+        return ('SH' + str(fund_code))[0:8]  # SH
+    elif str(fund_code).startswith('12'):
+        return ('SZ' + str(fund_code))[0:8]  # SZ
+    return str(fund_code)
+
+
+# Get the upper limits and weights of the trading strategies from excel
+def get_convertible_bond_factor(factor: str):
+    factor = factor.split('&', -1)
+    return float(factor[0]), float(factor[1])
+
+
+# Get a column as a float array, empty cells and '停牌' become NaN
+def get_float_column(data, column):
+    values = data[column]
+    if pandas.api.types.is_numeric_dtype(values.dtype):
+        return values.to_numpy(dtype=float)   # typed table, no conversion
+    return pandas.to_numeric(values.astype(object), errors='coerce').to_numpy(dtype=float)
+
+
+# Get a table with the dtypes of the schema, e.g. read from a sheet: float64 columns, text and category columns,
+# and the Suspended mask set by the '停牌' cells, which become NaN
+def get_typed_table(data, columns):
+    """
+    data: table with some of the columns, missing ones are filled with NaN
+    columns: columns of the typed table, e.g. convertible_bond_columns, followed by the Suspended column
+    return: a new table with the index of data
+    """
+    size = len(data)
+    if suspended_column in data:
+        suspended = data[suspended_column].eq(True).to_numpy()   # NaN of reindexed rows -> False
+    else:
+        suspended = np.zeros(size, dtype=bool)
+    typed = {}
+    for column in columns:
+        if column not in data:
+            values = np.full(size, None if column in text_columns else np.nan, dtype=object if column in text_columns else float)
+        else:
+            values = data[column].to_numpy()
+        if column in text_columns:
+            typed[column] = np.array([get_quote_text(value) for value in values], dtype=object)
+        elif column in category_columns:
+            typed[column] = pandas.Categorical([get_date_text(value) for value in values])
+        else:
+            if values.dtype == object:
+                suspended |= values == suspended_text
+                values = pandas.to_numeric(pandas.Series(values), errors='coerce').to_numpy()
+            typed[column] = values.astype(float)
+    typed[suspended_column] = suspended
+    return pandas.DataFrame(typed, index=data.index)
+
+
+# Get a table as shown in the sheets: '停牌' in the missing suspension_columns of the suspended CBs, without the Suspended column
+def get_display_table(data):
+    if suspended_column not in data:
+        return data
+    display = data.drop(columns=suspended_column)
+    suspended = data[suspended_column].to_numpy(dtype=bool)
+    for column in display.columns:
+        if isinstance(display[column].dtype, pandas.CategoricalDtype):
+            display[column] = display[column].astype(object)
+        elif column in suspension_columns and suspended.any():
+            values = display[column].to_numpy(dtype=object)
+            values[suspended & pandas.isna(values)] = suspended_text
+            display[column] = values
+    return display
+
+
+# Get the suspension mask of CB rows: a missing value in any of the suspension_columns, the fields the sheets show as
+# '停牌' when the data source has none, e.g. a quote with a daily change but without a premium rate
+def get_suspended_mask(data):
+    return np.isnan(np.column_stack([get_float_column(data, column) for column in suspension_columns])).any(axis=1)
+
+
+# Get a field of the quote_detail payloads as a float array, None becomes NaN
+def get_quote_field(quotes, field):
+    return np.array([quote.get(field) for quote in quotes], dtype=float)
+
+
+# Get the text of a name for the console, '' for a missing one
+def get_name_text(value):
+    return value if isinstance(value, str) else ''
+
+
+# Get the text of a date: epoch in milliseconds of the data source, date read from the sheet or text, e.g. '2020-05-21'.
+# The epochs are dated in Beijing time, whatever the timezone of the machine. Empty cells and NaN become None
+def get_date_text(value):
+    if value is None or isinstance(value, float) and np.isnan(value):
+        return None
+    if isinstance(value, (int, float, np.number)):
+        return get_exchange_time(value / 1000).strftime("%Y-%m-%d")
+    if hasattr(value, 'strftime'):
+        return value.strftime("%Y-%m-%d")
+    return str(value)
+
+
+# Fill the CB table with the quote_detail payloads of its bonds, all rows at once
+def build_convertible_bond_table(data_fund, details, log=print):
+    """
+    data_fund: CB table with at least the 'Quote' column, see convertible_bond_columns
+    details: quote_detail payloads, in the same order as data_fund['Quote']
+    log: callable receiving one line per bond
+    return: the typed CB table sorted by Premium rate, indexed from 1, see get_typed_table
+    """
+    data_fund = get_typed_table(data_fund.reset_index(drop=True), convertible_bond_columns)
+    quotes = [quote_of(detail) for detail in details]
+    current = get_quote_field(quotes, 'current')
+    percent = get_quote_field(quotes, 'percent')
+    premium_rate = get_quote_field(quotes, 'premium_rate')
+    outstanding = get_quote_field(quotes, 'outstanding_amt') / 1000000
+    outstanding = np.where(np.isnan(outstanding), 1, outstanding)
+    amount = get_quote_field(quotes, 'amount') / 1000
+    amount = np.where(np.isnan(amount), 0, amount)
+    high, low = get_quote_field(quotes, 'high'), get_quote_field(quotes, 'low')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        data_fund['Name'] = np.array([quote.get('name') for quote in quotes], dtype=object)   # write the data into data_fund
+        data_fund['Current'] = current
+        data_fund['Change'] = percent / 100
+        data_fund['Conversion Price'] = get_quote_field(quotes, 'conversion_price')
+        data_fund['Conversion Value'] = get_quote_field(quotes, 'conversion_value')
+        data_fund['Premium Rate'] = premium_rate
+        data_fund['Double Low'] = current + premium_rate
+        data_fund['Issue Date'] = pandas.Categorical([get_date_text(quote.get('issue_date')) for quote in quotes])
+        data_fund['Maturity Date'] = pandas.Categorical([get_date_text(quote.get('maturity_date')) for quote in quotes])
+        data_fund['Remain Year'] = get_quote_field(quotes, 'remain_year')
+        data_fund['Outstanding Amount (m)'] = outstanding
+        data_fund['Amount (k)'] = amount
+        data_fund['Turnover Rate'] = (amount / 1000 / current) / (outstanding / 100)
+        data_fund['Benefit Before Tax'] = get_quote_field(quotes, 'benefit_before_tax') / 100
+        data_fund['Day High'] = high
+        data_fund['Day Low'] = low
+        data_fund['Amplitude'] = np.where((high > 0) & (low > 0), (high - low) / low, np.nan)
+        data_fund['Stock Quote'] = np.array([quote.get('underlying_symbol') for quote in quotes], dtype=object)  # get the underlying stock quote
+        data_fund[suspended_column] = get_suspended_mask(data_fund)
+    for i, (fund_code, quote) in enumerate(zip(data_fund['Quote'], quotes)):
+        log_str = format(str(i+1), "<5") + format(get_bond_symbol(fund_code), "<10") \
+                  + format(str(quote.get("name") or ''), "<10") \
+                  + 'Current: ' + format(str(quote.get("current")), "<10") \
+                  + 'Daily Trend(%): ' + format(str(quote.get("percent")), "<10") \
+                  + 'Premium Rate(%): ' + format(str(quote.get("premium_rate")), "<10")
+        log(log_str)   # display the key data in the console: name, current, Premium rate, daily trend
+
+    data_fund = data_fund.sort_values(by='Premium Rate', kind='stable')  # sort all bonds by Preimum rate, ascending, suspended last
+    data_fund.reset_index(drop=True, inplace=True)
+    data_fund.index += 1
+    return data_fund
+
+
+# Select the bonds copied into the stock table, sorted by Quote
+def select_underlyings(data_fund, rows=30):
+    """
+    rows: number of bonds kept, 30 rows fit the 'Underlying_Values' sheet, None for all
+    """
+    data_stock_destination = data_fund[[column for column in underlying_source_columns + [suspended_column] if column in data_fund]]
+    data_stock_destination = data_stock_destination.sort_values(by='Quote')  # sort all bonds by Quote, ascending
+    return data_stock_destination if rows is None else data_stock_destination[:rows]
+
+
+# Fill the stock table with the quote_detail payloads of the underlyings, and price every bond
+def build_underlying_table(data_stock, details, log=print, model=None, executor=None, calibrator=None):
+    """
+    data_stock: stock table, see underlying_columns, with the hand-maintained inputs filled in
+    details: quote_detail payloads, in the same order as data_stock['Stock Quote']
+    log: callable receiving one line per bond
+    model: 'bs' or 'lattice', None for convertible_bond_model, see price_underlying_table
+    executor: executor.PricingExecutor of the lattice pricing, None for pricing_executor
+    calibrator: kmv.KMVCalibrator of the DtD, None for kmv_calibrator
+    return: the typed stock table sorted by Quote, indexed from 1, see get_typed_table
+    """
+    data_stock = get_typed_table(data_stock.reset_index(drop=True), underlying_columns)
+    quotes = [quote_of(detail) for detail in details]
+    data_stock['Stock Name'] = np.array([quote.get('name') for quote in quotes], dtype=object)  # Write the data into data_stock
+    data_stock['Stock Current'] = get_quote_field(quotes, 'current')
+    data_stock['Dividend'] = get_quote_field(quotes, 'dividend_yield')
+
+    data_stock = price_underlying_table(data_stock, model=model, executor=executor, calibrator=calibrator)
+    for i in range(len(data_stock)):
+        log_str = format(str(i+1), "<5") + format(get_name_text(data_stock.loc[i, 'Name']), "<10") \
+              + 'Option Value: ' + format(data_stock.loc[i, 'Option Value'], '<10.2f') \
+              + 'Bond Value: ' + format(data_stock.loc[i, 'Straight Bond Value'], "<10.2f") \
+              + 'Diff Vol.: ' + format(data_stock.loc[i, 'Differential Volitality'], "<10.2f") \
+              + 'DtD: ' + format(data_stock.loc[i, "DtD"], "<10.2f") \
+              + 'Bias: ' + format(data_stock.loc[i, 'Bias'], "<10.2%")  # display the key data in the console: Quote, CB current, Stock current, Option value
+        log(log_str)
+
+    data_stock = data_stock.sort_values(by='Quote', kind='stable')  # sort bt Quote, ascending
+    data_stock.reset_index(drop=True, inplace=True)
+    data_stock.index += 1
+    return data_stock
+
+
+# Calculate Option value, implied volatility, DtD and bias of the whole stock table at once, see pricing.py
+def price_underlying_table(data_stock, model=None, steps=None, executor=None, calibrator=None):
+    """
+    model: 'lattice' to value the CBs on a lattice with the 'Putable Price' and 'Callable Price' stock triggers,
+           'bs' for the straight bond value plus a Black-Scholes call, None for convertible_bond_model
+    steps: time steps of the lattice, None for lattice_steps
+    executor: executor.PricingExecutor of the lattice pricing, None for pricing_executor
+    calibrator: kmv.KMVCalibrator of the DtD, None for kmv_calibrator
+    """
+    model = convertible_bond_model if model is None else model
+    calibrator = kmv_calibrator if calibrator is None else calibrator
+    steps = lattice_steps if steps is None else steps
+    executor = pricing_executor if executor is None else executor
+    stock_current = get_float_column(data_stock, 'Stock Current')
+    dividend = get_float_column(data_stock, 'Dividend') / 100
+    conversion_price = get_float_column(data_stock, 'Conversion Price')
+    remain_year = get_float_column(data_stock, 'Remain Year')
+    interest_rate = get_float_column(data_stock, 'Interest Rate') / 100
+    realized_vol = get_float_column(data_stock, 'Realized Volatility')
+    bond_value = get_float_column(data_stock, 'Straight Bond Value')
+    current = get_float_column(data_stock, 'Current')
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        option_price = current - bond_value
+        implied_vol = 100 * implied_volatility_batch(option_price * conversion_price / 100, stock_current, conversion_price,
+                                                     remain_year, interest_rate, dividend, option='call')
+        if model == 'lattice':
+            put_trigger = get_float_column(data_stock, 'Putable Price')
+            call_trigger = get_float_column(data_stock, 'Callable Price')
+            costs = np.isfinite(stock_current + conversion_price + remain_year + interest_rate + dividend)   # invalid rows cost nothing
+            theoretical_value = executor.map(cb_lattice_batch, stock_current, conversion_price, remain_year, interest_rate, dividend,
+                                             realized_vol / 100, bond_value, put_trigger, call_trigger,
+                                             costs=costs & np.isfinite(realized_vol), steps=steps, method=lattice_method)
+            implied_vol = 100 * executor.map(cb_implied_volatility_batch, current, stock_current, conversion_price, remain_year,
+                                             interest_rate, dividend, bond_value, put_trigger, call_trigger,
+                                             np.where(implied_vol > 0, implied_vol / 100, np.nan),   # Black-Scholes IV as the first guess
+                                             costs=costs & np.isfinite(current), steps=steps, method=lattice_method)
+            option_value = theoretical_value - bond_value
+        else:
+            option_value = 100 / conversion_price * bs_option_batch(stock_current, conversion_price, remain_year, interest_rate, dividend, realized_vol / 100, option='call')[2]  # Calculate the BS option price
+            theoretical_value = bond_value + option_value
+        data_stock['Option Value'] = option_value
+        data_stock['Option Price'] = option_price
+        data_stock['Implied Volitality'] = implied_vol
+        data_stock['Differential Volitality'] = (implied_vol - realized_vol) / 100
+        data_stock['DtD'] = calibrator.calibrate(data_stock['Quote'].to_numpy(dtype=object), get_float_column(data_stock, 'Conversion Value'),
+                                                 realized_vol / 100, bond_value, remain_year, interest_rate, dividend)[2]   # KMV, see kmv.py
+        data_stock['Theoretical Value'] = theoretical_value
+        data_stock['Bias'] = current / theoretical_value - 1
+    return data_stock
+
+
+# Build the scenario engine of the stock table, see scenarios.ScenarioEngine
+def get_scenario_engine(data_stock, volatility='Realized Volatility'):
+    """
+    volatility: column of the volatilities of the Greeks and the grids, e.g. 'Implied Volitality'
+    """
+    return ScenarioEngine(get_float_column(data_stock, 'Stock Current'), get_float_column(data_stock, 'Conversion Price'),
+                          get_float_column(data_stock, 'Remain Year'), get_float_column(data_stock, 'Interest Rate') / 100,
+                          get_float_column(data_stock, 'Dividend') / 100, get_float_column(data_stock, volatility) / 100,
+                          get_float_column(data_stock, 'Straight Bond Value'))
+
+
+# Get the Greeks of every CB of the stock table, per 100 face, see scenarios.ScenarioEngine.greeks
+def get_greeks_table(data_stock, engine=None):
+    """
+    engine: get_scenario_engine(data_stock), when its grids are also needed
+    return: table of Quote, Name, Stock Quote and the Greeks, with the index of data_stock
+    """
+    engine = get_scenario_engine(data_stock) if engine is None else engine
+    greeks = data_stock[['Quote', 'Name', 'Stock Quote']].copy()
+    for column, values in engine.greeks().items():
+        greeks[column] = values
+    return greeks
+
+
+# Rank the CBs of one strategy, see strategies.strategy_specs
+def rank_strategy(name, data_fund_source, cells, arrays=None):
+    """
+    name: key of strategy_specs
+    data_fund_source: the source table of the strategy, i.e., the CB table or the stock table
+    cells: dict of parameter cell -> value, e.g. {'D2': 130, 'H2': 0.2, 'M2': 500}
+    arrays: float columns of data_fund_source, see strategies.get_table_arrays
+    """
+    return rank_strategy_spec(strategy_specs[name], data_fund_source, cells, arrays)
+
+
+# Rank the CBs of all strategies from one snapshot of the CB table, the stock table and the parameter cells of both sheets
+def rank_strategies(data_fund, data_stock, parameters, names=None, log=print, timer=None):
+    """
+    parameters: dict of sheet name -> {cell: value}, e.g. {'RealTimeData_ConvertibleBond': {'D2': 130, ...}, 'Underlying_Values': {...}}
+    names: strategies to rank, None for all
+    timer: StageTimer recording the time of every strategy
+    return: dict of strategy name -> top 20 table
+    """
+    timer = StageTimer() if timer is None else timer
+    tables = {'RealTimeData_ConvertibleBond': data_fund, 'Underlying_Values': data_stock}
+    with timer.stage('ranking: prepare'):
+        arrays = {sheet: get_table_arrays(table) for sheet, table in tables.items()}  # columnar snapshot shared by all strategies
+    rankings = {}
+    for name in (strategy_specs if names is None else names):
+        spec = strategy_specs[name]
+        with timer.stage('ranking: ' + name):
+            rankings[name] = rank_strategy(name, tables[spec['source']], parameters[spec['source']], arrays[spec['source']])
+        log("------------ Refresh Ranking: " + spec['title'] + " ------------")
+        log(rankings[name])
+    return rankings
+
+
+# Range holding the threshold and weight cells of a source sheet, read in one go
+parameter_range = 'A1:X6'
+
+
+# Get the cells of a range read from excel as a dict, e.g. {'A1': ..., 'D2': 250, ...}
+def get_parameter_cells(values, first_cell='A1'):
+    first_column = ord(first_cell[0].upper()) - ord('A')
+    first_row = int(first_cell[1:])
+    cells = {}
+    for i, row in enumerate(values):
+        for j, value in enumerate(row):
+            cells[chr(ord('A') + first_column + j) + str(first_row + i)] = value
+    return cells
+
+
+# Copy the selected bonds into the stock table read from 'Underlying_Values', row by row as the excel does
+def overlay_underlyings(data_stock, data_stock_destination):
+    """
+    The first len(data_stock_destination) rows get the new bonds in the underlying_source_columns, the
+    hand-maintained columns stay on their rows, exactly like writing data_stock_destination at 'A7'.
+    """
+    data_stock = get_typed_table(data_stock.reset_index(drop=True), underlying_columns)
+    data_stock_destination = data_stock_destination.reset_index(drop=True)
+    if len(data_stock_destination) == 0:
+        return data_stock
+    if len(data_stock_destination) > len(data_stock):
+        data_stock = get_typed_table(data_stock.reindex(range(len(data_stock_destination))), underlying_columns)
+    rows = len(data_stock_destination)
+    for column in underlying_source_columns + [suspended_column]:
+        if column in data_stock_destination:
+            values = data_stock[column].to_numpy(copy=True)
+            values[:rows] = data_stock_destination[column].to_numpy(dtype=values.dtype)
+            data_stock[column] = values
+    return data_stock
+
+
+# Record how long every stage of a refresh takes
+class StageTimer:
+    def __init__(self):
+        self.stages = {}   # stage name -> seconds, in the order the stages started
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+            metrics.record_stage(name, seconds)
+
+    def report(self):
+        lines = [format(name, "<40") + format(seconds, ">10.3f") + ' s' for name, seconds in self.stages.items()]
+        lines.append(format('total', "<40") + format(sum(self.stages.values()), ">10.3f") + ' s')
+        return '\n'.join(lines)
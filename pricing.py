@@ -0,0 +1,544 @@
+import numpy as np
+from scipy.stats import norm
+from scipy.special import ndtr  # standard normal CDF on arrays, same values as scipy.stats.norm.cdf(x, 0.0, 1.0)
+from metrics import metrics, iteration_buckets  # solver iterations, recorded only when the metrics are enabled
+
+
+# Calculate Option value based on Black-Scholes model
+def bs_option(S, K, T, r, q, sigma, option='call'):
+    """
+    S: spot price of the underlying stock
+    K: strike price, i.e., the conversion price of Convertible Bonds
+    T: time to maturity, the remain year of the bonds
+    r: risk-free interest rate, here refer to the GCNY10, China 10-Year Government Bond Yield
+    q: rate of continuous dividend, of the underlying stock
+    sigma: standard deviation of price of underlying asset, based on the historical prices in the last 12 months
+    """
+    d1 = (np.log(S/K) + (r - q + 0.5*sigma**2)*T)/(sigma*np.sqrt(T))
+    d2 = (np.log(S/K) + (r - q - 0.5*sigma**2)*T)/(sigma*np.sqrt(T)) # d2 = d1 - sigma*np.sqrt(T)
+
+    if option == 'call':
+        p = (S*np.exp(-q*T)*norm.cdf(d1, 0.0, 1.0) - K*np.exp(-r*T)*norm.cdf(d2, 0.0, 1.0))       
+    elif option == 'put':
+        p = (K*np.exp(-r*T)*norm.cdf(-d2, 0.0, 1.0) - S*np.exp(-q*T)*norm.cdf(-d1, 0.0, 1.0))
+    else:
+        return None
+    return d1, d2, p
+
+# Calculate implied volatility based on Bisection method
+def implied_volatility(P, S, K, T, r, q, option='call'):
+    sigma_min = 0.00001
+    sigma_max = 1.000
+    sigma_mid = (sigma_min + sigma_max) / 2
+    
+    if option == 'call':
+        p_min = bs_option(S, K, T, r, q, sigma_min, option='call')[2]
+        p_max = bs_option(S, K, T, r, q, sigma_max, option='call')[2]
+        p_mid = bs_option(S, K, T, r, q, sigma_mid, option='call')[2]
+        diff = P - p_mid
+        
+        # if P < p_min or P > p_max:
+            # print('Attention, Option Price is beyond the limit, "American Option Case"')
+        
+        Count = 0
+        while abs(diff) > 1e-6:
+            if P > p_mid:
+                sigma_min = sigma_mid
+            else:
+                sigma_max = sigma_mid
+            sigma_mid = (sigma_min + sigma_max) / 2
+            p_mid = bs_option(S, K, T, r, q, sigma_mid, option='call')[2]
+            diff = P - p_mid
+            Count += 1
+            if Count > 100:  
+                sigma_mid = 0
+                metrics.inc('iv_solver_unconverged_total', solver='bisection')
+                return sigma_mid
+    else:
+        p_min = bs_option(S, K, T, r, q, sigma_min, option='put')[2]
+        p_max = bs_option(S, K, T, r, q, sigma_max, option='put')[2]
+        p_mid = bs_option(S, K, T, r, q, sigma_mid, option='put')[2]
+        diff = P - p_mid
+        
+        if P < p_min or P > p_max:
+            print('Attention, Option Price is beyond the limit, "American Option Case"')
+        
+        Count = 0
+        while abs(diff) > 1e-6:
+            if P > p_mid:
+                sigma_min = sigma_mid
+            else:
+                sigma_max = sigma_mid
+            sigma_mid = (sigma_min + sigma_max) / 2
+            p_mid = bs_option(S, K, T, r, q, sigma_mid, option='put')[2]
+            diff = P - p_mid
+            Count += 1
+            if Count > 100:  
+                sigma_mid = 1
+                metrics.inc('iv_solver_unconverged_total', solver='bisection')
+                return sigma_mid           
+    metrics.observe('iv_solver_iterations', Count, iteration_buckets, solver='bisection')
+    return sigma_mid
+
+# Calculate Distance to Default based on Merton Model, the proxy with the equity value and volatility as the asset's,
+# see merton_kmv_batch for the calibrated one
+def Merton_DtD(S,K,T,r,q,sigma):
+    """
+    S: spot conversion value of the Convertible Bonds
+    K: Pure bond value of the Convertible Bonds
+    T: time to maturity, the remain year of the bonds
+    r: risk-free interest rate, here refer to the GCNY10, China 10-Year Government Bond Yield
+    q: rate of continuous dividend, of the underlying stock
+    sigma: standard deviation of price of underlying asset, based on the historical prices in the last 12 months
+    """
+    DtD = (np.log(S/K) + (r - q - 0.5*sigma**2)*T)/(sigma*np.sqrt(T))
+    return DtD
+
+
+# Calculate Option values of the whole bond universe in one call, based on Black-Scholes model
+def bs_option_batch(S, K, T, r, q, sigma, option='call'):
+    """
+    Array version of bs_option, all inputs are broadcast against each other.
+    S: spot prices of the underlying stocks
+    K: strike prices, i.e., the conversion prices of Convertible Bonds
+    T: time to maturity, the remain years of the bonds
+    r: risk-free interest rate, here refer to the GCNY10, China 10-Year Government Bond Yield
+    q: rate of continuous dividend, of the underlying stocks
+    sigma: standard deviation of price of underlying assets
+    return: d1, d2, p as float64 arrays, or None for an unknown option type
+    """
+    S, K, T, r, q, sigma = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (S, K, T, r, q, sigma)))
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        sigma_sqrt_t = sigma * np.sqrt(T)
+        log_moneyness = np.log(S / K)
+        d1 = (log_moneyness + (r - q + 0.5 * sigma**2) * T) / sigma_sqrt_t
+        d2 = (log_moneyness + (r - q - 0.5 * sigma**2) * T) / sigma_sqrt_t  # d2 = d1 - sigma*np.sqrt(T)
+        discounted_S = S * np.exp(-q * T)
+        discounted_K = K * np.exp(-r * T)
+        if option == 'call':
+            p = discounted_S * ndtr(d1) - discounted_K * ndtr(d2)
+        elif option == 'put':
+            p = discounted_K * ndtr(-d2) - discounted_S * ndtr(-d1)
+        else:
+            return None
+    return d1, d2, p
+
+
+# Calculate Vega (dP/dsigma) of the whole bond universe, same for calls and puts
+def bs_vega_batch(S, K, T, r, q, sigma):
+    S, K, T, r, q, sigma = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (S, K, T, r, q, sigma)))
+    d1 = bs_option_batch(S, K, T, r, q, sigma)[0]
+    with np.errstate(invalid='ignore', over='ignore'):
+        return S * np.exp(-q * T) * np.exp(-0.5 * d1**2) / np.sqrt(2 * np.pi) * np.sqrt(T)
+
+
+# Calculate implied volatilities of the whole bond universe, based on safeguarded Newton method
+def implied_volatility_batch(P, S, K, T, r, q, option='call', tol=1e-6, max_iter=100,
+                             sigma_min=0.00001, sigma_max=1.000, full_output=False):
+    """
+    Array version of implied_volatility. Every element keeps its own bracket [sigma_min, sigma_max]:
+    a Newton step is taken when it stays inside the bracket, otherwise the bracket is bisected,
+    so each element converges at least as fast as the scalar bisection.
+    P: option prices, per share of the underlying stock
+    S, K, T, r, q: see bs_option_batch
+    tol: absolute price tolerance, same as the scalar bisection (1e-6)
+    max_iter: iteration limit, elements not converged by then get the sentinel
+              of implied_volatility, i.e., 0 for a call and 1 for a put
+    full_output: also return the iteration count and the convergence mask of every element
+    Elements with missing inputs (NaN) return NaN.
+    """
+    if option not in ('call', 'put'):
+        return None
+    P, S, K, T, r, q = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (P, S, K, T, r, q)))
+    shape = P.shape
+    P, S, K, T, r, q = (x.ravel() for x in (P, S, K, T, r, q))
+    n = P.size
+    sentinel = 0.0 if option == 'call' else 1.0
+
+    lo = np.full(n, sigma_min)
+    hi = np.full(n, sigma_max)
+    sigma = np.full(n, (sigma_min + sigma_max) / 2)
+    iterations = np.zeros(n, dtype=np.int64)
+    converged = np.zeros(n, dtype=bool)
+    valid = np.isfinite(P) & np.isfinite(S) & np.isfinite(K) & np.isfinite(T) & np.isfinite(r) & np.isfinite(q)
+
+    # Prices outside [p(sigma_min), p(sigma_max)] can never be reached ("American Option Case")
+    p_min = bs_option_batch(S, K, T, r, q, lo, option)[2]
+    p_max = bs_option_batch(S, K, T, r, q, hi, option)[2]
+    with np.errstate(invalid='ignore'):
+        reachable = valid & (P >= p_min - tol) & (P <= p_max + tol)
+
+    active = np.flatnonzero(reachable)
+    for _ in range(max_iter + 1):
+        if active.size == 0:
+            break
+        s_a, k_a, t_a, r_a, q_a, sig_a = S[active], K[active], T[active], r[active], q[active], sigma[active]
+        diff = P[active] - bs_option_batch(s_a, k_a, t_a, r_a, q_a, sig_a, option)[2]
+        done = np.abs(diff) <= tol
+        converged[active[done]] = True
+        keep = ~done & np.isfinite(diff)
+        active, diff, sig_a = active[keep], diff[keep], sig_a[keep]
+        if active.size == 0:
+            break
+        iterations[active] += 1
+
+        # Price is increasing in sigma for both calls and puts, so the sign of diff tells which side to cut
+        above = diff > 0
+        lo[active] = np.where(above, sig_a, lo[active])
+        hi[active] = np.where(above, hi[active], sig_a)
+
+        vega = bs_vega_batch(S[active], K[active], T[active], r[active], q[active], sig_a)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = sig_a + diff / vega
+        lo_a, hi_a = lo[active], hi[active]
+        inside = np.isfinite(newton) & (newton > lo_a) & (newton < hi_a)
+        sigma[active] = np.where(inside, newton, (lo_a + hi_a) / 2)
+
+    result = np.where(converged, sigma, sentinel)
+    result = np.where(valid, result, np.nan).reshape(shape)
+    if metrics.enabled:
+        metrics.observe_many('iv_solver_iterations', iterations[valid & converged], iteration_buckets,
+                             description='Iterations of the implied volatility solvers', solver='newton')
+        metrics.inc('iv_solver_unconverged_total', int(np.count_nonzero(valid & ~converged)),
+                    description='Implied volatilities not converged, given the sentinel', solver='newton')
+    if full_output:
+        return result, iterations.reshape(shape), converged.reshape(shape)
+    return result
+
+
+# Apply the call, put and conversion provisions of the CBs on the nodes of one time step of the lattice, in place
+def apply_cb_provisions(value, cash, conversion, call_node, put_node, put_price=100.0, call_price=100.0, work=None):
+    """
+    value, cash: CB values and their cash parts (discounted at the risky rate) on the nodes, shape (nodes, N)
+    conversion: conversion values of the nodes, increasing along the nodes, shape (nodes, N)
+    call_node, put_node: fractional node index of the soft call and of the put triggers, shape (N,),
+                         the CB is called on the nodes >= call_node and put on the nodes <= put_node. inf/-inf for none
+    work: preallocated buffers of the same shape as value, (float, bool, bool)
+    """
+    exercised, mask, other = work if work is not None else (np.empty(value.shape), np.empty(value.shape, dtype=bool),
+                                                            np.empty(value.shape, dtype=bool))
+    nodes = np.arange(value.shape[0])[:, None]
+    # soft call: value capped at max(conversion, call price), the holders convert when it is higher
+    if np.any(call_node < value.shape[0]):
+        np.greater_equal(nodes, call_node, out=mask)
+        np.maximum(conversion, call_price, out=exercised)
+        np.less(exercised, value, out=other)
+        mask &= other
+        np.copyto(value, exercised, where=mask)
+        np.copyto(cash, 0.0, where=mask)
+        if np.any(conversion[0] < call_price):   # the issuer pays cash where the conversion value is under the call price
+            np.less(conversion, call_price, out=other)
+            mask &= other
+            np.copyto(cash, call_price, where=mask)
+    # put: value floored at the put price
+    if np.any(put_node >= 0):
+        np.less_equal(nodes, put_node, out=mask)
+        np.less(value, put_price, out=other)
+        mask &= other
+        np.copyto(value, put_price, where=mask)
+        np.copyto(cash, put_price, where=mask)
+    # conversion at the holder's choice
+    np.greater(conversion, value, out=mask)
+    np.copyto(value, conversion, where=mask)
+    np.copyto(cash, 0.0, where=mask)
+    return value, cash
+
+
+# Calculate the values of valid CBs on a lattice advanced for all bonds in lockstep, see cb_lattice_batch.
+# The arrays are node-major (nodes x bonds), the nodes of a time step are one contiguous block. Nodes further than
+# `band` standard deviations from the spot are dropped, the nodes on the edges of the band get extrapolated children.
+def get_cb_lattice_values(S, K, T, r, q, sigma, spread, put_trigger, call_trigger, redemption, put_price, call_price,
+                          put_period, steps, method, band, monitoring):
+    dt = T / steps
+    ratio = 100 / K
+    if method == 'binomial':   # Cox-Ross-Rubinstein, children at offsets -1/+1 of the parent, in units of h
+        h = sigma * np.sqrt(dt)
+        up = np.exp(h)
+        p_up = np.clip((np.exp((r - q) * dt) - 1 / up) / (up - 1 / up), 0.0, 1.0)
+        weights, distance = [p_up, 1 - p_up], 2   # up first, offsets between neighbour nodes
+        limit = steps if band is None else min(steps, int(band * np.sqrt(steps)))
+    elif method == 'trinomial':   # Hull's trinomial tree, children at offsets -1/0/+1, h = sigma*sqrt(3dt)
+        h = sigma * np.sqrt(3 * dt)
+        drift = np.clip(np.sqrt(dt / (12 * sigma**2)) * (r - q - 0.5 * sigma**2), -1 / 6, 1 / 6)
+        weights, distance = [1 / 6 + drift, np.full(drift.shape, 2 / 3), 1 / 6 - drift], 1
+        limit = steps if band is None else min(steps, int(band * np.sqrt(steps / 3)))
+    else:
+        raise ValueError('Unknown lattice method: ' + str(method))
+    branches = len(weights)
+    discount_cash = np.exp(-(r + spread) * dt)
+    discount_equity = np.exp(-r * dt)
+    weights_cash = [w * discount_cash for w in weights]
+    weights_value = [w * discount_equity for w in weights]
+    cash_factor = 1 - discount_equity / discount_cash   # value = de*E[value] + (1 - de/dc) * dc*E[cash]
+    # the lattice checks the triggers once per time step, the bonds once per trading day: the triggers are shifted by the
+    # Broadie-Glasserman-Kou continuity correction, so that the values converge to the daily monitored ones
+    shift = 0.5826 * sigma * (np.sqrt(monitoring) - np.sqrt(dt))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        call_distance = np.where(np.isfinite(call_trigger), np.log(call_trigger / S) + shift, np.inf)   # log-distance from the spot
+        put_distance = np.where(np.isfinite(put_trigger), np.log(put_trigger / S) - shift, -np.inf)
+
+    # conversion values of every offset, the nodes of a step are a slice of it
+    grid_low = -limit - 2
+    conversion_grid = np.exp(np.arange(grid_low, limit + 3, dtype=float)[:, None] * h) * (ratio * S)
+
+    def get_offsets(j):   # offsets of the nodes of step j kept in the band
+        low = -min(j, limit)
+        if (low - j) % distance:   # binomial nodes have the parity of j
+            low += 1
+        return low, -low
+
+    def get_conversion(low, count):
+        return conversion_grid[low - grid_low:low - grid_low + count * distance:distance]
+
+    low, high = get_offsets(steps)
+    count = (high - low) // distance + 1
+    height = count + 4
+    value_buffer, cash_buffer, new_value_buffer, new_cash_buffer = (np.empty((height, S.size)) for _ in range(4))
+    term, exercised = np.empty((height, S.size)), np.empty((height, S.size))
+    mask, other = np.empty((height, S.size), dtype=bool), np.empty((height, S.size), dtype=bool)
+    conversion = get_conversion(low, count)
+    np.maximum(conversion, redemption, out=value_buffer[1:1 + count])   # converted or redeemed at maturity
+    np.copyto(cash_buffer[1:1 + count], np.where(conversion > redemption, 0.0, redemption))
+    for j in range(steps - 1, -1, -1):
+        parent_low, parent_high = get_offsets(j)
+        width = (parent_high - parent_low) // distance + 1
+        child_low = parent_low - 1
+        start = 1 - (low - child_low) // distance   # 0 when the lowest child is out of the band
+        children = width + branches - 1
+        value, cash = value_buffer[start:start + children], cash_buffer[start:start + children]
+        if start == 0:   # deep out of the money: the value of the lowest node in the band
+            value[0], cash[0] = value[1], cash[1]
+        if child_low + (children - 1) * distance > high:   # deep in the money: moves one to one with the conversion value
+            top = count - start
+            value[top + 1] = value[top] + get_conversion(high + distance, 1)[0] - get_conversion(high, 1)[0]
+            cash[top + 1] = cash[top]
+        v, c, t = new_value_buffer[1:1 + width], new_cash_buffer[1:1 + width], term[1:1 + width]
+        np.multiply(cash[branches - 1:], weights_cash[0], out=c)
+        np.multiply(value[branches - 1:], weights_value[0], out=v)
+        for b in range(1, branches):
+            offset = branches - 1 - b
+            np.multiply(cash[offset:offset + width], weights_cash[b], out=t)
+            c += t
+            np.multiply(value[offset:offset + width], weights_value[b], out=t)
+            v += t
+        np.multiply(c, cash_factor, out=t)
+        v += t
+        base = parent_low * h   # log-distance of the lowest node from the spot
+        with np.errstate(invalid='ignore'):
+            call_node = (call_distance - base) / (distance * h)
+            put_node = np.where(T * (1 - j / steps) <= put_period, (put_distance - base) / (distance * h), -np.inf)
+        apply_cb_provisions(v, c, get_conversion(parent_low, width), call_node, put_node, put_price, call_price,
+                            (exercised[:width], mask[:width], other[:width]))
+        value_buffer, new_value_buffer = new_value_buffer, value_buffer
+        cash_buffer, new_cash_buffer = new_cash_buffer, cash_buffer
+        low, high, count = parent_low, parent_high, width
+    return value_buffer[1]
+
+
+# Calculate the values of the whole CB universe on binomial or trinomial lattices, with soft call, put and conversion.
+# The lattices of all bonds are advanced in lockstep as 2-D arrays (bonds x nodes), one NumPy step per time step.
+def cb_lattice_batch(S, K, T, r, q, sigma, bond_value=np.nan, put_trigger=np.nan, call_trigger=np.nan, redemption=110.0,
+                     put_price=100.0, call_price=100.0, put_period=2.0, steps=200, method='binomial', band=6.0,
+                     monitoring=1 / 250):
+    """
+    Tsiveriotis-Fernandes split: the cash part of the CB is discounted at the risky rate, the equity part at r.
+    S: spot prices of the underlying stocks
+    K: conversion prices, the CB is converted into 100 / K shares
+    T: remain years of the bonds
+    r: risk-free interest rate
+    q: rate of continuous dividend, of the underlying stocks
+    sigma: volatility of the underlying stocks
+    bond_value: straight bond values, the credit spread is the one discounting the redemption to it. NaN for no spread
+    put_trigger: stock price under which the holders can sell the CB back at put_price, i.e., 'Putable Price'. NaN for none
+    call_trigger: stock price over which the issuer calls the CB at call_price (soft call), i.e., 'Callable Price'. NaN for none
+    redemption: price paid at maturity, including the last coupon, see bondfloor.default_redemption
+    put_price, call_price: prices of the put and of the call, per 100 face value, accrued interest ignored
+    put_period: the put can be exercised in the last years of the bond only, 2 for most Chinese CBs
+    steps: time steps of the lattices, the same for every bond
+    method: 'binomial' or 'trinomial'
+    band: nodes further than this many standard deviations from the spot are dropped, None for the full lattice
+    monitoring: years between two checks of the triggers, 1/250 for the daily closes, 0 for continuous monitoring
+    return: CB values per 100 face value, NaN where an input is missing
+    """
+    arrays = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (S, K, T, r, q, sigma, bond_value, put_trigger, call_trigger)))
+    shape = arrays[0].shape
+    S, K, T, r, q, sigma, bond_value, put_trigger, call_trigger = (x.ravel() for x in arrays)
+    value = np.full(S.size, np.nan)
+    with np.errstate(invalid='ignore'):
+        valid = np.isfinite(S) & np.isfinite(K) & np.isfinite(T) & np.isfinite(r) & np.isfinite(q) & np.isfinite(sigma) \
+            & (S > 0) & (K > 0) & (T > 0) & (sigma > 0)
+    if not valid.any():
+        return value.reshape(shape)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        spread = np.log(redemption / bond_value[valid]) / T[valid] - r[valid]
+        spread = np.where(np.isfinite(spread), np.maximum(spread, 0.0), 0.0)
+        value[valid] = get_cb_lattice_values(S[valid], K[valid], T[valid], r[valid], q[valid], sigma[valid], spread,
+                                             put_trigger[valid], call_trigger[valid], redemption, put_price, call_price,
+                                             put_period, int(steps), method, band, monitoring)
+    return value.reshape(shape)
+
+
+# Calculate implied volatilities of the whole CB universe on the lattices of cb_lattice_batch, based on the Illinois method
+def cb_implied_volatility_batch(P, S, K, T, r, q, bond_value=np.nan, put_trigger=np.nan, call_trigger=np.nan, guess=None,
+                                tol=1e-4, max_iter=50, sigma_min=0.00001, sigma_max=1.000, full_output=False, **lattice):
+    """
+    Every element keeps its own bracket [sigma_min, sigma_max] and takes false position steps (Illinois variant),
+    only the elements not converged yet are priced again.
+    P: CB prices, per 100 face value
+    S, K, T, r, q, bond_value, put_trigger, call_trigger: see cb_lattice_batch
+    guess: first iterate, e.g. the Black-Scholes implied volatility, NaN or None to start with a false position step
+    tol: absolute price tolerance, per 100 face value
+    max_iter: iteration limit, elements not converged by then, or priced out of the bracket, get 0 like implied_volatility
+    full_output: also return the iteration count and the convergence mask of every element
+    lattice: other arguments of cb_lattice_batch, e.g. steps, method
+    """
+    arrays = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (P, S, K, T, r, q, bond_value, put_trigger, call_trigger)))
+    shape = arrays[0].shape
+    P, S, K, T, r, q, bond_value, put_trigger, call_trigger = (x.ravel() for x in arrays)
+
+    def price_error(sigma, index):
+        return cb_lattice_batch(S[index], K[index], T[index], r[index], q[index], sigma, bond_value[index],
+                                put_trigger[index], call_trigger[index], **lattice) - P[index]
+
+    index = np.flatnonzero(np.isfinite(P))
+    low, high = np.full(P.size, sigma_min), np.full(P.size, sigma_max)
+    error_low, error_high = np.full(P.size, np.nan), np.full(P.size, np.nan)
+    error_low[index] = price_error(low[index], index)
+    error_high[index] = price_error(high[index], index)
+    valid = np.isfinite(error_low) & np.isfinite(error_high)
+    with np.errstate(invalid='ignore'):
+        bracketed = valid & (error_low <= 0) & (error_high >= 0)
+    sigma = np.where(np.abs(error_low) < tol, low, high)
+    converged = bracketed & ((np.abs(error_low) < tol) | (np.abs(error_high) < tol))
+    side = np.zeros(P.size, dtype=np.int8)   # side of the last step, -1 low, +1 high, for the Illinois halving
+    iterations = np.zeros(P.size, dtype=np.int64)
+    guess = None if guess is None else np.broadcast_to(np.asarray(guess, dtype=float), shape).ravel()
+    for iteration in range(max_iter):
+        index = np.flatnonzero(bracketed & ~converged)
+        if index.size == 0:
+            break
+        l, h, el, eh = low[index], high[index], error_low[index], error_high[index]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = guess[index] if iteration == 0 and guess is not None else l - el * (h - l) / (eh - el)
+            x = np.where(np.isfinite(x) & (x > l) & (x < h), x, 0.5 * (l + h))
+        error = price_error(x, index)
+        iterations[index] += 1
+        sigma[index] = x
+        converged[index] = (np.abs(error) < tol) | (h - l < 1e-7) | ~np.isfinite(error)
+        below = error < 0
+        low[index] = np.where(below, x, l)
+        high[index] = np.where(below, h, x)
+        error_low[index] = np.where(below, error, np.where(side[index] == 1, 0.5 * el, el))
+        error_high[index] = np.where(below, np.where(side[index] == -1, 0.5 * eh, eh), error)
+        side[index] = np.where(below, -1, 1)
+    result = np.where(converged, sigma, 0.0)   # sentinel of implied_volatility for a call
+    result = np.where(valid, result, np.nan).reshape(shape)
+    if metrics.enabled:
+        metrics.observe_many('iv_solver_iterations', iterations[valid & converged], iteration_buckets,
+                             description='Iterations of the implied volatility solvers', solver='lattice')
+        metrics.inc('iv_solver_unconverged_total', int(np.count_nonzero(valid & ~converged)),
+                    description='Implied volatilities not converged, given the sentinel', solver='lattice')
+    if full_output:
+        return result, iterations.reshape(shape), (converged & valid).reshape(shape)
+    return result
+
+
+# Back out the asset values and asset volatilities of many issuers from their equity, KMV style: the equity is a call on
+# the assets struck at the debt barrier (Merton), solved with a damped Newton iteration on both equations at once
+#     E = V exp(-qT) N(d1) - D exp(-rT) N(d2)
+#     sigma_E E = exp(-qT) N(d1) sigma_V V
+def merton_kmv_batch(E, sigma_E, D, T, r, q, V0=None, sigma_V0=None, tol=1e-10, max_iter=50, max_halvings=10, full_output=False):
+    """
+    E: equity values
+    sigma_E: equity volatilities, 0.3 for 30%
+    D: debt barriers, in the unit of E
+    T: horizons in years, the remain years of the bonds
+    r, q: interest rates and dividend yields, 0.025 for 2.5%
+    V0, sigma_V0: first iterates, e.g. the solution of the last run, None or NaN for E + D exp(-rT) and sigma_E E / V0
+    tol: tolerance of the relative residuals of both equations
+    max_halvings: the Newton step is halved until the residuals decrease, at most this many times
+    full_output: also return the iteration count and the convergence mask of every issuer
+    return: asset values V, asset volatilities sigma_V and distances to default (ln(V/D) + (r - q - sigma_V^2/2)T) / (sigma_V sqrt(T)),
+            NaN for invalid inputs and for the issuers not converged
+    """
+    arrays = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (E, sigma_E, D, T, r, q)))
+    shape = arrays[0].shape
+    E, sigma_E, D, T, r, q = (x.ravel() for x in arrays)
+    with np.errstate(invalid='ignore'):
+        valid = (E > 0) & (sigma_E > 0) & (D > 0) & (T > 0) & np.isfinite(r) & np.isfinite(q)
+    dividend_discount, debt_discount, sqrt_t = np.exp(-q * T), D * np.exp(-r * T), np.sqrt(T)
+
+    # Unknowns in logs, x = ln V and y = ln sigma_V, so both stay positive
+    cold_V = E + debt_discount
+    V0 = cold_V if V0 is None else np.where(np.isfinite(V0) & (V0 > 0), np.broadcast_to(V0, shape).ravel(), cold_V)
+    sigma_V0 = sigma_E * E / V0 if sigma_V0 is None else np.where(np.isfinite(sigma_V0) & (sigma_V0 > 0),
+                                                                  np.broadcast_to(sigma_V0, shape).ravel(), sigma_E * E / V0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x, y = np.log(V0), np.log(sigma_V0)
+
+    def get_residuals(x, y, index):
+        V, sigma_V = np.exp(x), np.exp(y)
+        d1 = (x - np.log(D[index]) + (r[index] - q[index] + 0.5 * sigma_V**2) * T[index]) / (sigma_V * sqrt_t[index])
+        d2 = d1 - sigma_V * sqrt_t[index]
+        delta = dividend_discount[index] * ndtr(d1)
+        f1 = (V * delta - debt_discount[index] * ndtr(d2)) / E[index] - 1
+        f2 = delta * sigma_V * V / (sigma_E[index] * E[index]) - 1
+        return f1, f2, V, sigma_V, d1, d2, delta
+
+    iterations = np.zeros(E.size, dtype=np.int64)
+    converged = np.zeros(E.size, dtype=bool)
+    active = np.flatnonzero(valid & np.isfinite(x) & np.isfinite(y))
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for _ in range(max_iter + 1):
+            if active.size == 0:
+                break
+            f1, f2, V, sigma_V, d1, d2, delta = get_residuals(x[active], y[active], active)
+            norm = np.maximum(np.abs(f1), np.abs(f2))
+            done = norm < tol
+            converged[active[done]] = True
+            keep = ~done & np.isfinite(norm)
+            active, f1, f2, V, sigma_V, d1, d2, delta, norm = (a[keep] for a in (active, f1, f2, V, sigma_V, d1, d2, delta, norm))
+            if active.size == 0:
+                break
+            iterations[active] += 1
+
+            # Jacobian of the relative residuals in (ln V, ln sigma_V)
+            density = dividend_discount[active] * np.exp(-0.5 * d1**2) / np.sqrt(2 * np.pi)
+            e, scale = E[active], sigma_E[active] * E[active]
+            j11 = V * delta / e
+            j12 = V * density * sqrt_t[active] * sigma_V / e
+            j21 = sigma_V * V * (delta + density / (sigma_V * sqrt_t[active])) / scale
+            j22 = sigma_V * V * (delta - density * d2) / scale
+            determinant = j11 * j22 - j12 * j21
+            step_x = (-f1 * j22 + f2 * j12) / determinant
+            step_y = (-f2 * j11 + f1 * j21) / determinant
+            size = np.maximum(np.abs(step_x), np.abs(step_y))
+            damping = np.where(size > 1, 1 / size, 1.0)   # at most a factor e per iteration on V and sigma_V
+            damping = np.where(np.isfinite(damping), damping, 0.0)
+
+            # Halve the steps that do not decrease the residuals
+            pending = np.arange(active.size)
+            for _ in range(max_halvings):
+                index = active[pending]
+                new_f1, new_f2 = get_residuals(x[index] + damping[pending] * step_x[pending],
+                                               y[index] + damping[pending] * step_y[pending], index)[:2]
+                better = np.maximum(np.abs(new_f1), np.abs(new_f2)) < norm[pending]
+                pending = pending[~better]
+                if pending.size == 0:
+                    break
+                damping[pending] *= 0.5
+            x[active] += damping * step_x
+            y[active] += damping * step_y
+
+    V, sigma_V = np.exp(x), np.exp(y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        DtD = (np.log(V / D) + (r - q - 0.5 * sigma_V**2) * T) / (sigma_V * sqrt_t)
+    V, sigma_V, DtD = (np.where(converged, a, np.nan).reshape(shape) for a in (V, sigma_V, DtD))
+    if metrics.enabled:
+        metrics.observe_many('kmv_solver_iterations', iterations[valid & converged], iteration_buckets,
+                             description='Newton iterations of the KMV calibration')
+        metrics.inc('kmv_solver_unconverged_total', int(np.count_nonzero(valid & ~converged)),
+                    description='KMV calibrations not converged, given NaN')
+    if full_output:
+        return V, sigma_V, DtD, iterations.reshape(shape), converged.reshape(shape)
+    return V, sigma_V, DtD
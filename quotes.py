@@ -0,0 +1,298 @@
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import requests  # HTTP for Humans, https://requests.readthedocs.io/en/latest/
+from requests.adapters import HTTPAdapter
+from metrics import metrics
+from credentials import is_token_expired
+
+
+quote_detail_url = 'https://stock.xueqiu.com/v5/stock/quote.json?extend=detail&symbol='  # same endpoint as pysnowball.quote_detail
+quotec_url = 'https://stock.xueqiu.com/v5/stock/realtime/quotec.json?symbol='  # same endpoint as pysnowball.quotec, many symbols per request
+kline_url = 'https://stock.xueqiu.com/v5/stock/chart/kline.json?symbol={}&begin={}&period={}&type=after&count=-{}&indicator=kline'  # same endpoint as pysnowball.kline
+retry_status_codes = (429, 500, 502, 503, 504)   # transient HTTP errors, the request is replayed
+
+
+# Transport sending quote_detail requests to xueqiu.com over one keep-alive connection pool.
+# A request rejected with 400016 (expired token) renews the token and is replayed, like the 429/5xx and connection
+# errors, with exponential backoff
+class SnowballTransport:
+    """
+    token: cookie string from get_xq_a_token(), e.g. 'xq_a_token=...;', or a credentials.TokenManager to renew it
+    pool_size: number of keep-alive connections kept open, should be >= the fetcher's max_workers
+    base_url: quote endpoint, the symbol is appended to it. Point it to a local stub server for tests and benchmarks
+    host: Host header of every request, None for the host of each URL
+    retries: replays of a failed request, 0 to fail at once
+    backoff: seconds before the first replay, doubled for every next one
+    """
+    def __init__(self, token, pool_size=16, base_url=quote_detail_url, host=None, kline_url=kline_url,
+                 quotec_url=quotec_url, retries=3, backoff=0.5):
+        self.base_url = base_url
+        self.kline_url = kline_url
+        self.quotec_url = quotec_url
+        self.credentials = None if isinstance(token, str) else token
+        self.token = token if isinstance(token, str) else None
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Accept': 'application/json',
+                                     'User-Agent': 'Xueqiu iPhone 14.15.1',
+                                     'Accept-Language': 'zh-Hans-CN;q=1, ja-JP;q=0.9',
+                                     'Accept-Encoding': 'br, gzip, deflate',
+                                     'Connection': 'keep-alive'})   # same headers as pysnowball
+        if host is not None:
+            self.session.headers['Host'] = host
+
+    def cookie(self):
+        return self.token if self.credentials is None else self.credentials.cookie()
+
+    # GET a JSON payload, replaying the request after a token renewal or a transient error
+    def get(self, url, timeout=None, endpoint='quote'):
+        for attempt in range(self.retries + 1):
+            cookie = self.cookie()
+            last = attempt == self.retries
+            try:
+                response = self.session.get(url, timeout=timeout, headers={'Cookie': cookie})
+            except (requests.ConnectionError, requests.Timeout):
+                if last:
+                    raise
+                self.wait(attempt, endpoint, 'connection')
+                continue
+            if is_token_expired(response) and self.credentials is not None and not last:
+                self.credentials.renew(cookie)
+                self.wait(attempt, endpoint, 'token')
+                continue
+            if response.status_code in retry_status_codes and not last:
+                self.wait(attempt, endpoint, str(response.status_code))
+                continue
+            if response.status_code != 200:
+                raise Exception(response.content)
+            return response.json()
+
+    def wait(self, attempt, endpoint, reason):
+        metrics.inc('request_retries_total', description='Replays of failed data source requests', endpoint=endpoint, reason=reason)
+        time.sleep(self.backoff * 2 ** attempt)
+
+    def __call__(self, symbol, timeout=None):
+        return self.get(self.base_url + symbol, timeout)
+
+    # Get the last `count` daily k-line bars of a symbol, backward adjusted: the past closes never change after a
+    # dividend or a split, only the new ones are scaled. Same payload as pysnowball.kline
+    def kline(self, symbol, count=284, timeout=None, period='day'):
+        return self.get(self.kline_url.format(symbol, int(time.time() * 1000), period, count), timeout, 'kline')
+
+    # Get the light real-time quotes (current, percent, high, low, amount, ...) of many symbols in one request
+    def quotec(self, symbols, timeout=None):
+        return self.get(self.quotec_url + ','.join(symbols), timeout, 'quotec')
+
+    def close(self):
+        self.session.close()
+
+
+# Transport calling pysnowball.quote_detail, for setups where the token is set through pysnowball.set_token()
+def pysnowball_transport(symbol, timeout=None):
+    import pysnowball
+    return pysnowball.quote_detail(symbol)
+
+
+# Token bucket shared by all worker threads: at most `rate` requests per second, with bursts up to `burst`
+class RateLimiter:
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Fetch quote_detail payloads of many symbols concurrently, results are returned in input order
+class QuoteFetcher:
+    """
+    transport: callable(symbol, timeout) -> quote_detail payload, e.g. SnowballTransport or pysnowball_transport
+    max_workers: concurrency limit, i.e., number of requests in flight at the same time
+    rate_limit: max requests per second over all workers, None for no limit
+    timeout: per-request timeout in seconds, passed to the transport
+    endpoint: name of the requests in the metrics, e.g. 'quote', 'kline'
+    close_transport: close() also closes the transport, False for a transport shared between refreshes
+    """
+    def __init__(self, transport, max_workers=8, rate_limit=None, timeout=10.0, endpoint='quote', close_transport=True):
+        self.transport = transport
+        self.endpoint = endpoint
+        self.close_transport = close_transport
+        self.max_workers = max(1, int(max_workers))
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(rate_limit, burst=self.max_workers) if rate_limit else None
+
+    def fetch_one(self, symbol):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        if not metrics.enabled:
+            return self.transport(symbol, timeout=self.timeout)
+        start = time.perf_counter()
+        try:
+            return self.transport(symbol, timeout=self.timeout)
+        except Exception as error:
+            metrics.inc('request_errors_total', description='Failed data source requests', endpoint=self.endpoint, error=type(error).__name__)
+            raise
+        finally:
+            metrics.record_request(symbol if isinstance(symbol, str) else symbol[0], time.perf_counter() - start, self.endpoint)
+
+    def fetch(self, symbols, return_exceptions=False):
+        """
+        symbols: list of quotes, e.g. ['SH113050', 'SZ123107']
+        return_exceptions: put the exception of a failed request in its slot instead of raising it
+        """
+        symbols = list(symbols)
+        if not symbols:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(symbols))) as executor:
+            futures = [executor.submit(self.fetch_one, symbol) for symbol in symbols]
+            results = []
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as error:
+                    if not return_exceptions:
+                        for pending in futures:
+                            pending.cancel()
+                        raise
+                    results.append(error)
+        return results
+
+    def close(self):
+        if self.close_transport and hasattr(self.transport, 'close'):
+            self.transport.close()
+
+
+# Get the quote dict of a quote_detail payload, i.e., pandas.DataFrame(payload).loc["quote"][0]
+def quote_of(payload):
+    return payload['data']['quote']
+
+
+# TTL of every field class, in seconds. A cached payload is fresh for a caller if it is younger than the TTL of the class it needs
+quote_cache_ttl = {'realtime': 10,   # prices, change, premium rate, amount, etc.
+                   'daily': 4 * 3600,   # dividend yield, outstanding amount, remain year, etc.
+                   'static': 24 * 3600}   # name, conversion price, issue/maturity date, underlying symbol, etc.
+
+# Field class of the quote fields used by the refresh functions, fields not listed here are 'realtime'
+quote_field_class = {'dividend_yield': 'daily', 'outstanding_amt': 'daily', 'remain_year': 'daily',
+                     'name': 'static', 'conversion_price': 'static', 'issue_date': 'static',
+                     'maturity_date': 'static', 'underlying_symbol': 'static'}
+
+
+# Get the field class a caller needs to stay fresh for a list of quote fields, i.e., the one with the shortest TTL
+def get_field_class(fields, ttl=None):
+    ttl = quote_cache_ttl if ttl is None else ttl
+    return min((quote_field_class.get(field, 'realtime') for field in fields), key=lambda c: ttl[c])
+
+
+# In-process quote cache keyed by symbol, shared by all refresh entry points
+class QuoteCache:
+    """
+    fetcher: default QuoteFetcher used for cache misses, can be overridden per call
+    ttl: dict of field class -> TTL in seconds, see quote_cache_ttl
+    max_entries: least recently used symbols are evicted above this size
+    Concurrent requests for a symbol already being fetched wait for that request instead of sending another one.
+    """
+    def __init__(self, fetcher=None, ttl=None, max_entries=5000, clock=time.monotonic):
+        self.fetcher = fetcher
+        self.ttl = dict(quote_cache_ttl if ttl is None else ttl)
+        self.max_entries = max_entries
+        self.clock = clock
+        self.entries = OrderedDict()   # symbol -> (fetched time, payload), in LRU order
+        self.inflight = {}   # symbol -> Future of the request in flight
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def get(self, symbol, field_class='realtime', fetcher=None):
+        return self.get_many([symbol], field_class, fetcher)[0]
+
+    def get_many(self, symbols, field_class='realtime', fetcher=None):
+        """
+        symbols: list of quotes, duplicates are fetched once
+        field_class: the class of fields the caller needs to be fresh, 'realtime', 'daily' or 'static', or the list of
+                     the quote fields it reads, e.g. ['issue_date', 'maturity_date'], see quote_field_class
+        return: quote_detail payloads in input order
+        """
+        symbols = list(symbols)
+        fetcher = self.fetcher if fetcher is None else fetcher
+        if not isinstance(field_class, str):
+            field_class = get_field_class(field_class, self.ttl)
+        max_age = self.ttl[field_class]
+        found = {}
+        waiting = {}
+        to_fetch = []
+        with self.lock:
+            now = self.clock()
+            for symbol in dict.fromkeys(symbols):
+                entry = self.entries.get(symbol)
+                if entry is not None and now - entry[0] < max_age:
+                    self.entries.move_to_end(symbol)
+                    found[symbol] = entry[1]
+                    self.hits += 1
+                elif symbol in self.inflight:
+                    waiting[symbol] = self.inflight[symbol]
+                    self.coalesced += 1
+                else:
+                    self.inflight[symbol] = Future()
+                    to_fetch.append(symbol)
+                    self.misses += 1
+
+        if to_fetch:
+            try:
+                payloads = fetcher.fetch(to_fetch, return_exceptions=True)
+            except BaseException as error:
+                payloads = [error] * len(to_fetch)
+            with self.lock:
+                fetched_at = self.clock()
+                for symbol, payload in zip(to_fetch, payloads):
+                    future = self.inflight.pop(symbol)
+                    if isinstance(payload, BaseException):
+                        future.set_exception(payload)
+                        continue
+                    self.entries[symbol] = (fetched_at, payload)
+                    self.entries.move_to_end(symbol)
+                    future.set_result(payload)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+            for symbol, payload in zip(to_fetch, payloads):
+                if isinstance(payload, BaseException):
+                    raise payload
+                found[symbol] = payload
+
+        for symbol, future in waiting.items():
+            found[symbol] = future.result()
+        return [found[symbol] for symbol in symbols]
+
+    def invalidate(self, symbols=None):
+        with self.lock:
+            if symbols is None:
+                self.entries.clear()
+            else:
+                for symbol in symbols:
+                    self.entries.pop(symbol, None)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'coalesced': self.coalesced, 'evictions': self.evictions}
@@ -0,0 +1,133 @@
+import numpy as np
+from scipy.special import ndtr  # standard normal CDF on arrays
+
+
+default_spot_shocks = np.round(np.linspace(-0.2, 0.2, 21), 4)   # relative stock price shocks, -20% to +20% by 2%
+default_vol_shocks = np.round(np.linspace(-0.1, 0.1, 11), 4)   # absolute volatility shocks, -10 to +10 vol points
+default_rate_shocks = np.array([0.0])   # absolute interest rate shocks, e.g. [-0.005, 0, 0.005] for +-50bp
+min_volatility = 0.01   # floor of the shocked volatilities
+
+
+def normal_pdf(x):
+    return np.exp(-0.5 * x**2) / np.sqrt(2 * np.pi)
+
+
+# Greeks and scenario revaluation of the whole CB universe, with every CB valued as its straight bond value plus
+# 100/K calls of Black-Scholes, like pipeline.price_underlying_table with model='bs'.
+# The terms shared by the Greeks and the grids (log moneyness, sqrt(T), discount factors, d1/d2) are computed once,
+# a grid of bonds x spot x vol x rate shocks is one broadcast computation.
+class ScenarioEngine:
+    """
+    S: stock prices
+    K: conversion prices
+    T: remain years
+    r: interest rates, 0.025 for 2.5%
+    q: dividend yields, 0.01 for 1%
+    sigma: volatilities, 0.3 for 30%
+    bond_value: straight bond values per 100 face, NaN for 0
+    """
+    def __init__(self, S, K, T, r, q, sigma, bond_value=np.nan):
+        arrays = np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (S, K, T, r, q, sigma, bond_value)))
+        self.S, self.K, self.T, self.r, self.q, self.sigma, bond_value = (x.ravel() for x in arrays)
+        self.bond_value = np.where(np.isnan(bond_value), 0.0, bond_value)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.ratio = 100 / self.K   # conversion ratio, shares per 100 face
+            self.sqrt_t = np.sqrt(self.T)
+            self.log_moneyness = np.log(self.S / self.K)
+            self.dividend_discount = np.exp(-self.q * self.T)
+        self.base = None
+        self.grids = {}   # (spot, vol, rate shocks) -> cube, the last grids asked
+
+    # d1, d2 and the terms derived from them at the current state, computed once
+    def get_base(self):
+        if self.base is None:
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                sigma_sqrt_t = self.sigma * self.sqrt_t
+                d1 = (self.log_moneyness + (self.r - self.q + 0.5 * self.sigma**2) * self.T) / sigma_sqrt_t
+                d2 = d1 - sigma_sqrt_t
+                self.base = {'d1': d1, 'd2': d2, 'pdf_d1': normal_pdf(d1), 'cdf_d1': ndtr(d1), 'cdf_d2': ndtr(d2),
+                             'sigma_sqrt_t': sigma_sqrt_t, 'strike_discount': self.K * np.exp(-self.r * self.T)}
+        return self.base
+
+    # CB values at the current state, per 100 face
+    def value(self):
+        base = self.get_base()
+        call = self.S * self.dividend_discount * base['cdf_d1'] - base['strike_discount'] * base['cdf_d2']
+        return self.bond_value + self.ratio * call
+
+    # Greeks of the CBs per 100 face, from the cached d1/d2
+    def greeks(self):
+        """
+        return: dict of float arrays
+            Delta: CB price change for a stock price change of 1
+            Gamma: Delta change for a stock price change of 1
+            Vega: CB price change for +1 vol point
+            Theta: CB price change in one calendar day, of the conversion option
+            Rho: CB price change for +1% interest rate, the straight bond value with a duration of T
+            Hedge Ratio: shares to short per converted share, i.e., the option delta exp(-qT) N(d1)
+        """
+        base = self.get_base()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hedge_ratio = self.dividend_discount * base['cdf_d1']
+            density = self.S * self.dividend_discount * base['pdf_d1']
+            theta = (-density * self.sigma / (2 * self.sqrt_t) - self.r * base['strike_discount'] * base['cdf_d2']
+                     + self.q * self.S * hedge_ratio)
+            return {'Delta': self.ratio * hedge_ratio,
+                    'Gamma': self.ratio * density / (self.S**2 * base['sigma_sqrt_t']),
+                    'Vega': self.ratio * density * self.sqrt_t / 100,
+                    'Theta': self.ratio * theta / 365,
+                    'Rho': (self.ratio * self.T * base['strike_discount'] * base['cdf_d2'] - self.T * self.bond_value) / 100,
+                    'Hedge Ratio': hedge_ratio}
+
+    # Revalue every CB under every combination of the shocks
+    def grid(self, spot_shocks=default_spot_shocks, vol_shocks=default_vol_shocks, rate_shocks=default_rate_shocks):
+        """
+        spot_shocks: relative stock price shocks, e.g. [-0.2, ..., 0.2]
+        vol_shocks: absolute volatility shocks, e.g. [-0.1, ..., 0.1] for +-10 vol points
+        rate_shocks: absolute interest rate shocks, applied to the discounting of the option and the straight bond value
+        return: float64 cube (bonds, spot shocks, vol shocks, rate shocks) of CB values per 100 face
+        """
+        axes = tuple(np.atleast_1d(np.asarray(x, dtype=float)) for x in (spot_shocks, vol_shocks, rate_shocks))
+        key = tuple(axis.tobytes() for axis in axes)
+        if key in self.grids:
+            return self.grids[key]
+        spot, vol, rate = axes
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            # terms of one axis only, broadcast into the cube at the end
+            log_moneyness = self.log_moneyness[:, None, None, None] + np.log1p(spot)[None, :, None, None]   # (N, s, 1, 1)
+            spot_discounted = (self.S * self.dividend_discount)[:, None, None, None] * (1 + spot)[None, :, None, None]
+            sigma = np.maximum(self.sigma[:, None] + vol[None, :], min_volatility)   # (N, v)
+            sigma_sqrt_t = (sigma * self.sqrt_t[:, None])[:, None, :, None]   # (N, 1, v, 1)
+            rates = self.r[:, None] + rate[None, :]   # (N, r)
+            drift = ((rates - self.q[:, None]) * self.T[:, None])[:, None, None, :]   # (N, 1, 1, r)
+            variance = (0.5 * sigma**2 * self.T[:, None])[:, None, :, None]   # (N, 1, v, 1)
+            strike_discount = (self.K[:, None] * np.exp(-rates * self.T[:, None]))[:, None, None, :]
+            bond_value = (self.bond_value[:, None] * np.exp(-rate[None, :] * self.T[:, None]))[:, None, None, :]
+
+            d1 = (log_moneyness + drift + variance) / sigma_sqrt_t
+            call = spot_discounted * ndtr(d1) - strike_discount * ndtr(d1 - sigma_sqrt_t)
+            cube = bond_value + self.ratio[:, None, None, None] * call
+        self.grids = {key: cube}
+        return cube
+
+    # Write a grid as a compressed .npz: float32 values, and the P&L against the current values
+    def save(self, path, cube=None, quotes=None, spot_shocks=default_spot_shocks, vol_shocks=default_vol_shocks,
+             rate_shocks=default_rate_shocks):
+        """
+        cube: a cube of grid() with the same shocks, None to compute it
+        quotes: CB quotes of the bonds, stored as the first axis
+        """
+        cube = self.grid(spot_shocks, vol_shocks, rate_shocks) if cube is None else cube
+        np.savez_compressed(path, values=cube.astype(np.float32), base=self.value().astype(np.float32),
+                            quotes=np.asarray([] if quotes is None else quotes, dtype=str),
+                            spot_shocks=np.atleast_1d(spot_shocks), vol_shocks=np.atleast_1d(vol_shocks),
+                            rate_shocks=np.atleast_1d(rate_shocks))
+
+
+# Read a grid written by ScenarioEngine.save
+def load_scenarios(path):
+    """
+    return: dict with 'values' (bonds, spot, vol, rate), 'base', 'quotes' and the shock axes
+    """
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
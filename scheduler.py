@@ -0,0 +1,198 @@
+import os
+import sys
+import json
+import time
+import datetime
+from metrics import metrics
+
+try:
+    from zoneinfo import ZoneInfo  # IANA time zones, Python 3.9+
+    exchange_timezone = ZoneInfo('Asia/Shanghai')
+except (ImportError, KeyError):   # no tz database, e.g. Windows without tzdata: China has no daylight saving time
+    exchange_timezone = datetime.timezone(datetime.timedelta(hours=8), 'Asia/Shanghai')
+
+calendar_cache_path = os.path.join(os.path.expanduser('~'), '.autoarbitrage', 'trading_calendar.json')   # exchange holidays per year, kept between runs
+trading_sessions = (('09:30', '11:30'), ('13:00', '15:00'))   # SSE/SZSE continuous trading, Beijing time
+# Phases of a trading day from their start time, Beijing time. Before the first one, and all day on weekends and
+# exchange holidays, the market is 'closed'
+day_phases = (('07:00', 'pre-open'), ('09:30', 'session'), ('11:30', 'lunch'), ('13:00', 'session'),
+              ('15:00', 'after-close'), ('15:30', 'closed'))
+pre_open_time = day_phases[0][0]   # the daily jobs run from this time, e.g. the full refresh
+close_time = day_phases[-1][0]   # end of the after-close, nothing changes until the next pre-open
+# Seconds between two runs of the jobs of every phase, None for no runs, e.g. nothing to poll in the lunch break
+phase_intervals = {'pre-open': 60, 'session': 5, 'lunch': None, 'after-close': 300, 'closed': None}
+max_sleep = 300   # the phase is checked again at least this often, e.g. after the computer slept
+
+
+# Get the exchange time of an epoch, now by default, as a naive datetime like datetime.datetime.now(). The sessions and the
+# daily closes are in Beijing time whatever the time zone of the computer
+def get_exchange_time(timestamp=None):
+    return datetime.datetime.fromtimestamp(time.time() if timestamp is None else timestamp, exchange_timezone).replace(tzinfo=None)
+
+
+# Get the weekdays without trading of a year from chinese_calendar: the exchanges close on the public holidays and do
+# not open on the make-up workdays on weekends
+def get_exchange_holidays(year):
+    """
+    return: sorted list of datetime.date
+    raise: ImportError without chinese_calendar, NotImplementedError for a year it does not know yet
+    """
+    import chinese_calendar  # determine workdays in China from 2004, https://github.com/LKI/chinese-calendar
+    day = datetime.date(year, 1, 1)
+    holidays = []
+    while day.year == year:
+        if day.weekday() < 5 and not chinese_calendar.is_workday(day):
+            holidays.append(day)
+        day += datetime.timedelta(days=1)
+    return holidays
+
+
+# SSE/SZSE trading days and the phases of a trading day. The holidays are computed once per year and kept in a JSON
+# file {year: [dates]}, which can also be edited by hand, e.g. for a year chinese_calendar does not know yet
+class TradingCalendar:
+    """
+    path: JSON cache of the holidays, None to keep them in memory only
+    """
+    def __init__(self, path=calendar_cache_path, log=print):
+        self.path = path
+        self.log = log
+        self.holidays = {}   # year -> set of datetime.date
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as cache_file:
+                for year, dates in json.load(cache_file).items():
+                    self.holidays[int(year)] = {datetime.date.fromisoformat(date) for date in dates}
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, 'w', encoding='utf-8') as cache_file:
+            json.dump({str(year): sorted(date.isoformat() for date in dates) for year, dates in sorted(self.holidays.items())},
+                      cache_file, indent=1)
+
+    # Get the holidays of a year, from the cache or computed and cached
+    def get_holidays(self, year):
+        if year not in self.holidays:
+            try:
+                self.holidays[year] = set(get_exchange_holidays(year))
+                self.save()
+            except (ImportError, NotImplementedError) as error:
+                self.log('Trading calendar of ' + str(year) + ' unknown, every weekday is a trading day：' + repr(error))
+                self.holidays[year] = set()   # not saved, computed again by the next run
+        return self.holidays[year]
+
+    # Compute and cache the holidays of some years ahead, e.g. python scheduler.py 2025 2026
+    def precompute(self, years):
+        for year in years:
+            self.holidays.pop(year, None)
+            self.get_holidays(year)
+
+    def is_trading_day(self, date):
+        return date.weekday() < 5 and date not in self.get_holidays(date.year)
+
+    def next_trading_day(self, date):
+        date += datetime.timedelta(days=1)
+        while not self.is_trading_day(date):
+            date += datetime.timedelta(days=1)
+        return date
+
+    # Get the phase at a time: 'closed', 'pre-open', 'session', 'lunch' or 'after-close'
+    def get_phase(self, now):
+        if not self.is_trading_day(now.date()):
+            return 'closed'
+        clock = now.strftime('%H:%M')
+        phase = 'closed'
+        for start, name in day_phases:
+            if clock >= start:
+                phase = name
+        return phase
+
+    # Get the time the phase changes next, e.g. the next pre-open when closed
+    def get_next_change(self, now):
+        if self.is_trading_day(now.date()):
+            for start, name in day_phases:
+                change = datetime.datetime.combine(now.date(), datetime.time.fromisoformat(start))
+                if change > now:
+                    return change
+        return datetime.datetime.combine(self.next_trading_day(now.date()), datetime.time.fromisoformat(pre_open_time))
+
+    def in_session(self, now=None):
+        return self.get_phase(get_exchange_time() if now is None else now) == 'session'
+
+
+# Run jobs at the cadence of the phase of the trading day, e.g. poll every 5 seconds in session, every minute in the
+# pre-open, never in the lunch break, on weekends or on holidays. A run that is late, e.g. after a slow refresh or a
+# sleeping computer, is run once: the missed runs are coalesced, not replayed
+class RefreshScheduler:
+    """
+    jobs: dict of phase -> callable(phase), e.g. {'session': poll, 'pre-open': poll}
+    calendar: TradingCalendar, a new one if None
+    intervals: seconds between two runs of every phase, merged into phase_intervals
+    daily: callable() run once per trading day from the pre-open, e.g. the full refresh. Also run when started later
+           in the day, then never twice the same day
+    clock: callable() -> naive datetime in Beijing time, see get_exchange_time
+    """
+    def __init__(self, jobs, calendar=None, intervals=None, daily=None, clock=get_exchange_time, log=print):
+        self.jobs = dict(jobs)
+        self.calendar = TradingCalendar(log=log) if calendar is None else calendar
+        self.intervals = {**phase_intervals, **(intervals or {})}
+        self.daily = daily
+        self.clock = clock
+        self.log = log
+        self.phase = None
+        self.last_run = None   # time.monotonic() of the last run in this phase
+        self.last_day = None   # date of the last daily run
+        self.runs = 0
+        self.missed = 0
+
+    # Run what is due now
+    def run_pending(self):
+        """
+        return: seconds to sleep before the next call
+        """
+        now = self.clock()
+        if self.daily is not None and self.last_day != now.date() and self.calendar.is_trading_day(now.date()) \
+                and now.strftime('%H:%M') >= pre_open_time:
+            self.last_day = now.date()
+            self.daily()
+            now = self.clock()
+        phase = self.calendar.get_phase(now)
+        if phase != self.phase:
+            self.log('Scheduler：' + phase + ' until ' + str(self.calendar.get_next_change(now)))
+            self.phase = phase
+            self.last_run = None   # the first run of a phase is not delayed
+        until_change = max(0.0, (self.calendar.get_next_change(now) - now).total_seconds())
+        interval = self.intervals.get(phase)
+        job = self.jobs.get(phase)
+        if job is None or not interval:
+            return min(until_change, max_sleep)
+
+        if self.last_run is not None:
+            elapsed = time.monotonic() - self.last_run
+            if elapsed < interval:
+                return min(interval - elapsed, until_change, max_sleep)
+            missed = int(elapsed // interval) - 1
+            if missed > 0:
+                self.missed += missed
+                metrics.inc('scheduler_missed_runs_total', missed, description='Late runs coalesced into one', phase=phase)
+        self.last_run = time.monotonic()
+        job(phase)
+        self.runs += 1
+        metrics.inc('scheduler_runs_total', description='Runs of the scheduled jobs', phase=phase)
+        return min(max(0.0, interval - (time.monotonic() - self.last_run)), until_change, max_sleep)
+
+    # Run the jobs until stop() returns True
+    def run(self, stop=None, sleep=time.sleep):
+        """
+        stop: callable() -> bool, None to run forever
+        """
+        while stop is None or not stop():
+            sleep(self.run_pending())
+
+
+if __name__ == "__main__":
+    # python scheduler.py 2025 2026: compute the holidays of these years into the calendar cache
+    calendar = TradingCalendar()
+    calendar.precompute([int(year) for year in sys.argv[1:]] or [get_exchange_time().year])
+    for year in sorted(calendar.holidays):
+        print(year, len(calendar.holidays[year]), 'holidays')
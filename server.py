@@ -0,0 +1,257 @@
+import os
+import sys
+import json
+import time
+import hmac
+import secrets
+import argparse
+import importlib
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+# Long-lived compute server behind the buttons of the workbook: python server.py
+# AutoArbitrage is imported once and kept warm: the quote cache, the token and its session, the volatility history,
+# the pricing pool, the DtD calibrations and the latest tables stay in memory between the clicks. The buttons become
+# thin clients (client.py) posting to a local HTTP API:
+#     GET  /health              status, uptime, whether AutoArbitrage is imported and the running job
+#     GET  /stats               /health plus the runs of every function, the quote cache, the token and the metrics
+#     GET  /tables              names of the latest tables, e.g. 'RealTimeData_ConvertibleBond', 'multifactor1'
+#     GET  /tables/<name>?top=N a latest table as {'columns', 'index', 'data'}, without reading the workbook
+#     POST /run/<function>      run a button of AutoArbitrage with the JSON body as keyword arguments
+#     POST /shutdown            stop the server
+# A POST needs 'Content-Type: application/json', no 'Origin' header and the secret of the session in the
+# 'X-AutoArbitrage-Secret' header: a web page open in the browser can post to 127.0.0.1, but cannot read the secret file
+# Only the standard library is imported here: the clients import this module for its settings.
+server_host = '127.0.0.1'   # local clients only
+server_port = int(os.environ.get('AUTOARBITRAGE_SERVER_PORT', 9109))
+server_url = 'http://' + server_host + ':' + str(server_port)
+server_start_timeout = 60   # seconds a client waits for a server it started, the first import takes a few seconds
+server_secret_path = os.path.join(os.path.expanduser('~'), '.autoarbitrage', 'server_secret')   # secret of the running server, readable by the user only
+secret_header = 'X-AutoArbitrage-Secret'
+# Functions of AutoArbitrage the clients may run, i.e., the buttons of the workbook. Streaming runs until the close
+# and would hold the job thread, it stays a separate process (python AutoArbitrage.py --stream)
+server_functions = ('main_function', 'refresh_all', 'refresh_convertible_bond', 'refresh_underlying_values',
+                    'refresh_premium_rate', 'refresh_DoubleLow', 'refresh_diff_volatility', 'refresh_Bias', 'refresh_DtD',
+                    'refresh_singlefactor_strategies', 'refresh_multifactor1_convertible_bond',
+                    'refresh_multifactor2_convertible_bond', 'refresh_multifactor3_convertible_bond',
+                    'refresh_multifactor_strategies')
+
+
+# Initialize COM on the job thread, every thread talking to Excel needs it
+def init_job_thread():
+    if sys.platform == 'win32':
+        import pythoncom  # pywin32, installed with xlwings on Windows
+        pythoncom.CoInitialize()
+
+
+# Run the functions of a module on one job thread, the module imported on first use and kept warm.
+# The jobs run one at a time in arrival order, like clicks on the buttons: the workbook has a single writer
+class ComputeServer:
+    """
+    module: name of the module of the functions, imported lazily
+    functions: names of the functions the clients may run
+    secret_path: file of the secret the clients send with every POST, a new secret is written at every start
+    """
+    def __init__(self, module='AutoArbitrage', functions=server_functions, log=print, secret_path=server_secret_path):
+        self.module_name = module
+        self.functions = tuple(functions)
+        self.log = log
+        self.secret_path = secret_path
+        self.secret = None
+        self.module = None
+        self.import_seconds = None
+        self.import_lock = threading.Lock()
+        self.jobs = ThreadPoolExecutor(max_workers=1, thread_name_prefix='compute', initializer=init_job_thread)
+        self.started = time.time()
+        self.running = None   # function of the running job
+        self.queued = 0
+        self.runs = {}   # function -> {'count', 'errors', 'seconds', 'last_seconds', 'last_run'}
+        self.http = None
+
+    # Import the module once, e.g. AutoArbitrage with pandas, scipy, xlwings and pysnowball
+    def get_module(self):
+        with self.import_lock:
+            if self.module is None:
+                started = time.perf_counter()
+                self.module = importlib.import_module(self.module_name)
+                self.import_seconds = time.perf_counter() - started
+                self.log('Compute server：' + self.module_name + ' imported in ' + format(self.import_seconds, '.2f') + ' s')
+            return self.module
+
+    # Import the module ahead of the first job, a failure is logged and the import is tried again by the first job
+    def warm_up(self):
+        try:
+            self.get_module()
+        except Exception as error:
+            self.log('Compute server：import of ' + self.module_name + ' failed：' + repr(error))
+
+    # Run a function on the job thread and wait for it
+    def run(self, function, kwargs=None):
+        """
+        return: {'ok': True, 'function', 'seconds', 'waited'} or {'ok': False, 'function', 'error', 'traceback'}
+        """
+        if function not in self.functions:
+            return {'ok': False, 'function': function, 'error': 'unknown function'}
+        self.queued += 1
+        submitted = time.perf_counter()
+        return self.jobs.submit(self.call, function, kwargs or {}, submitted).result()
+
+    def call(self, function, kwargs, submitted):
+        self.queued -= 1
+        self.running = function
+        started = time.perf_counter()
+        runs = self.runs.setdefault(function, {'count': 0, 'errors': 0, 'seconds': 0.0, 'last_seconds': None, 'last_run': None})
+        try:
+            getattr(self.get_module(), function)(**kwargs)
+            result = {'ok': True}
+        except Exception as error:
+            runs['errors'] += 1
+            result = {'ok': False, 'error': repr(error), 'traceback': traceback.format_exc()}
+            self.log('Compute server：' + function + ' failed：' + repr(error))
+        finally:
+            self.running = None
+        seconds = time.perf_counter() - started
+        runs['count'] += 1
+        runs['seconds'] += seconds
+        runs['last_seconds'] = seconds
+        runs['last_run'] = time.time()
+        return {**result, 'function': function, 'seconds': seconds, 'waited': started - submitted}
+
+    # Write a new secret into a file only the user can read (0600), the clients read it from there
+    def write_secret(self):
+        self.secret = secrets.token_hex(32)
+        os.makedirs(os.path.dirname(os.path.abspath(self.secret_path)), exist_ok=True)
+        descriptor = os.open(self.secret_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.chmod(self.secret_path, 0o600)   # an older file keeps its mode otherwise
+        with os.fdopen(descriptor, 'w', encoding='utf-8') as secret_file:
+            secret_file.write(self.secret)
+
+    # Whether a POST comes from a client of this machine: a JSON body, no browser Origin and the secret of the session
+    def is_authorized(self, headers):
+        content_type = (headers.get('Content-Type') or '').split(';')[0].strip().lower()
+        return (headers.get('Origin') is None and content_type == 'application/json'
+                and hmac.compare_digest((headers.get(secret_header) or '').encode(), self.secret.encode()))
+
+    def health(self):
+        return {'status': 'ok', 'pid': os.getpid(), 'uptime': time.time() - self.started, 'module': self.module_name,
+                'warm': self.module is not None, 'import_seconds': self.import_seconds, 'running': self.running,
+                'queued': self.queued}
+
+    # Health, runs and the warm state of the module, read without waiting for the running job
+    def stats(self):
+        stats = {**self.health(), 'runs': self.runs}
+        module = self.module
+        if module is None:
+            return stats
+        if hasattr(module, 'quote_cache'):
+            stats['quote_cache'] = module.quote_cache.stats()
+        if hasattr(module, 'token_manager'):
+            stats['token'] = {'valid': module.token_manager.is_valid(), 'expires': module.token_manager.expires}
+        if hasattr(module, 'latest_tables'):
+            stats['tables'] = {name: len(table) for name, table in list(module.latest_tables.items())}
+        metrics = sys.modules.get('metrics')
+        if metrics is not None and metrics.metrics.enabled:
+            stats['metrics'] = metrics.metrics.summary()
+        return stats
+
+    def get_table_names(self):
+        return list(getattr(self.module, 'latest_tables', {}))
+
+    # Get a latest table as JSON, None when there is none yet
+    def get_table(self, name, top=None):
+        table = getattr(self.module, 'latest_tables', {}).get(name)
+        if table is None:
+            return None
+        table = table if top is None else table.head(top)
+        return json.loads(table.to_json(orient='split', force_ascii=False, default_handler=str))
+
+    # Serve the HTTP API until shutdown
+    def serve(self, host=server_host, port=server_port, warm=True):
+        """
+        warm: import the module right away on the job thread, False to import it on the first job
+        """
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/health':
+                    self.send_json(server.health())
+                elif url.path == '/stats':
+                    self.send_json(server.stats())
+                elif url.path == '/tables':
+                    self.send_json(server.get_table_names())
+                elif url.path.startswith('/tables/'):
+                    top = parse_qs(url.query).get('top')
+                    try:
+                        top = int(top[0]) if top else None
+                    except ValueError:
+                        return self.send_json({'error': 'top is not an integer'}, 400)
+                    table = server.get_table(url.path[len('/tables/'):], top)
+                    self.send_json(table, 200 if table is not None else 404)
+                else:
+                    self.send_json({'error': 'not found'}, 404)
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                if not server.is_authorized(self.headers):
+                    return self.send_json({'error': 'forbidden'}, 403)
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    kwargs = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    return self.send_json({'error': 'the body is not JSON'}, 400)
+                if not isinstance(kwargs, dict):
+                    return self.send_json({'error': 'the body is not a JSON object of keyword arguments'}, 400)
+                if url.path.startswith('/run/'):
+                    result = server.run(url.path[len('/run/'):], kwargs)
+                    self.send_json(result, 200 if result['ok'] else 404 if result['error'] == 'unknown function' else 500)
+                elif url.path == '/shutdown':
+                    self.send_json({'status': 'stopping'})
+                    threading.Thread(target=server.shutdown, daemon=True).start()
+                else:
+                    self.send_json({'error': 'not found'}, 404)
+
+            def send_json(self, payload, status=200):
+                body = json.dumps(payload, default=str, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.write_secret()
+        self.http = ThreadingHTTPServer((host, port), Handler)
+        self.http.daemon_threads = True
+        if warm:
+            self.jobs.submit(self.warm_up)
+        self.log('Compute server：listening on http://' + host + ':' + str(self.http.server_address[1]))
+        try:
+            self.http.serve_forever()
+        finally:
+            self.http.server_close()
+            self.jobs.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        if self.http is not None:
+            self.http.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Keep AutoArbitrage warm behind the buttons of the workbook')
+    parser.add_argument('--port', type=int, default=server_port, help='local port of the HTTP API')
+    parser.add_argument('--lazy', action='store_true', help='import AutoArbitrage on the first job, not at start')
+    args = parser.parse_args(argv)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))   # the workbook, the caches and the history are next to the scripts
+    ComputeServer().serve(port=args.port, warm=not args.lazy)
+
+
+if __name__ == "__main__":
+    main()
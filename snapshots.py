@@ -0,0 +1,160 @@
+import os
+import time
+import datetime
+import numpy as np
+import pandas
+from scheduler import get_exchange_time
+
+
+# Columns stored as text, every other column of a snapshot is a float64 column
+text_columns = ['Quote', 'Name', 'Stock Quote', 'Stock Name', 'Issue Date', 'Maturity Date']
+
+
+# Get a quote as text, 110003.0 read from the sheet -> '110003'
+def get_quote_text(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if isinstance(value, (float, np.floating)) and float(value).is_integer():
+        return str(int(value))
+    return str(value)
+
+
+# Build the typed snapshot of a table: a 'Time' column, text and float columns, '停牌' becomes NaN with 'Suspended' = True.
+# The 'Suspended' mask of a typed table (see pipeline.get_typed_table) is kept, its float columns are not converted
+def get_snapshot_table(data, snapshot_time):
+    """
+    data: the CB table, the stock table or a ranking, see pipeline.convertible_bond_columns
+    snapshot_time: seconds since the epoch, stored as Beijing time
+    """
+    snapshot = pandas.DataFrame(index=range(len(data)))
+    snapshot['Time'] = pandas.Series(pandas.Timestamp(get_exchange_time(snapshot_time)),   # Beijing time, like the partitions
+                                     index=snapshot.index).astype('datetime64[ms]')
+    suspended = data['Suspended'].eq(True).to_numpy() if 'Suspended' in data else np.zeros(len(data), dtype=bool)
+    for column in data.columns:
+        if column == 'Suspended':
+            continue
+        if column in text_columns:
+            snapshot[column] = pandas.Series([get_quote_text(value) for value in data[column].to_numpy(dtype=object)], dtype=object)
+        elif pandas.api.types.is_numeric_dtype(data[column].dtype):
+            snapshot[column] = data[column].to_numpy(dtype=float)
+        else:
+            values = data[column].to_numpy(dtype=object)
+            suspended |= values == '停牌'
+            snapshot[column] = pandas.to_numeric(pandas.Series(values), errors='coerce').to_numpy(dtype=float)
+    snapshot['Suspended'] = suspended
+    return snapshot
+
+
+# Get the Timestamp of a read bound, a day ('YYYY-MM-DD' or a date) used as an end bound includes the whole day
+def get_time_bound(value, end=False):
+    if value is None:
+        return None
+    day = isinstance(value, datetime.date) and not isinstance(value, datetime.datetime) or isinstance(value, str) and len(value) <= 10
+    value = pandas.Timestamp(value)
+    return value + pandas.Timedelta(days=1) - pandas.Timedelta(milliseconds=1) if day and end else value
+
+
+# Append-only store of table snapshots, partitioned by table and by trading day (Beijing time), one Parquet file per append:
+#     <root>/<table>/date=YYYY-MM-DD/part-<HHMMSS>-<ns>.parquet
+# The files of a past day are merged into one by compact(). Needs pyarrow.
+class SnapshotStore:
+    """
+    root: directory of the store
+    """
+    def __init__(self, root='snapshots'):
+        self.root = root
+
+    def get_partition(self, table, date):
+        return os.path.join(self.root, table, 'date=' + date.strftime('%Y-%m-%d'))
+
+    # Dates stored for a table, oldest first
+    def partitions(self, table):
+        path = os.path.join(self.root, table)
+        if not os.path.isdir(path):
+            return []
+        return sorted(datetime.date.fromisoformat(name[5:]) for name in os.listdir(path) if name.startswith('date='))
+
+    def get_files(self, table, date):
+        path = self.get_partition(table, date)
+        if not os.path.isdir(path):
+            return []
+        return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.parquet'))
+
+    # Store one snapshot of a table, never rewriting a file
+    def append(self, table, data, snapshot_time=None):
+        """
+        table: name of the table, e.g. 'RealTimeData_ConvertibleBond'
+        data: DataFrame, see get_snapshot_table
+        snapshot_time: seconds since the epoch, now by default
+        return: path of the new file
+        """
+        import pyarrow
+        import pyarrow.parquet
+        snapshot_time = time.time() if snapshot_time is None else snapshot_time
+        exchange_time = get_exchange_time(snapshot_time)
+        path = self.get_partition(table, exchange_time.date())
+        os.makedirs(path, exist_ok=True)
+        name = 'part-' + exchange_time.strftime('%H%M%S') + '-' + str(time.time_ns()) + '.parquet'
+        arrow_table = pyarrow.Table.from_pandas(get_snapshot_table(data, snapshot_time), preserve_index=False)
+        pyarrow.parquet.write_table(arrow_table, os.path.join(path, name + '.tmp'))
+        os.replace(os.path.join(path, name + '.tmp'), os.path.join(path, name))   # readers never see a partial file
+        return os.path.join(path, name)
+
+    # Read the snapshots of a time range, only the partitions of the range are opened, files are memory-mapped
+    def read(self, table, start=None, end=None, symbols=None, columns=None):
+        """
+        start, end: datetime/date/'YYYY-MM-DD[ HH:MM:SS]', inclusive, None for no limit
+        symbols: values of 'Quote' to keep, None for all
+        columns: columns to read, 'Time' and 'Quote' are always read
+        return: DataFrame sorted by Time, empty if nothing matches
+        """
+        import pyarrow.parquet
+        start, end = get_time_bound(start), get_time_bound(end, end=True)
+        files = []
+        for date in self.partitions(table):
+            if (start is None or date >= start.date()) and (end is None or date <= end.date()):
+                files += self.get_files(table, date)
+        if not files:
+            return pandas.DataFrame(columns=['Time', 'Quote'] + [column for column in columns or [] if column not in ('Time', 'Quote')])
+        filters = []
+        if start is not None:
+            filters.append(('Time', '>=', start))
+        if end is not None:
+            filters.append(('Time', '<=', end))
+        if symbols is not None:
+            filters.append(('Quote', 'in', [get_quote_text(symbol) for symbol in symbols]))
+        if columns is not None:
+            columns = ['Time', 'Quote'] + [column for column in columns if column not in ('Time', 'Quote')]
+        data = pyarrow.parquet.read_table(files, columns=columns, filters=filters or None, memory_map=True,
+                                            partitioning=None).to_pandas()
+        return data.sort_values('Time', kind='stable').reset_index(drop=True)
+
+    # Merge the files of every past day into one file sorted by Time and Quote, today is left untouched
+    def compact(self, table, before=None):
+        """
+        before: only the days before this date are compacted, today (Beijing time) by default
+        return: number of files removed
+        """
+        import pyarrow
+        import pyarrow.parquet
+        before = get_exchange_time().date() if before is None else before
+        removed = 0
+        for date in self.partitions(table):
+            files = self.get_files(table, date)
+            if date >= before or len(files) < 2:
+                continue
+            merged = pyarrow.concat_tables([pyarrow.parquet.read_table(path, memory_map=True, partitioning=None) for path in files], promote_options='default')
+            merged = merged.sort_by([('Time', 'ascending'), ('Quote', 'ascending')])
+            path = os.path.join(self.get_partition(table, date), 'part-compacted-' + str(time.time_ns()) + '.parquet')
+            pyarrow.parquet.write_table(merged, path + '.tmp', row_group_size=65536)
+            os.replace(path + '.tmp', path)
+            for old in files:
+                os.remove(old)
+            removed += len(files)
+        return removed
+
+    # Tables stored in the store
+    def tables(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name)))
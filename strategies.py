@@ -0,0 +1,362 @@
+import re
+import json
+import bisect
+import numpy as np
+import pandas
+
+
+# Strategy registry: every CB ranking is a spec, new strategies are added here or loaded from a JSON file
+#     title: printed when the strategy is refreshed
+#     source: sheet of the source table, 'RealTimeData_ConvertibleBond' or 'Underlying_Values'
+#     columns: columns of the ranking table
+#     filters: list of [column, '<' | '<=' | '>' | '>=', threshold], a threshold is a number or a parameter
+#              cell of the source sheet. A 'threshold&weight' cell, e.g. '250&5', gives its threshold part
+#     score: column to sort by, or {'name': score column, 'terms': [[column, weight, sign], ...]} for a weighted
+#            sum of factors. A weight is a number or a cell, a 'threshold&weight' cell gives its weight part
+#     ascending: sort direction of the score
+#     top: number of CBs kept
+#     destination: [sheet, top left cell] of the ranking table
+strategy_specs = {
+    'premium_rate': {
+        'title': '[Low Premium Rate] Strategy',
+        'source': 'RealTimeData_ConvertibleBond',
+        'columns': ['Quote', 'Name', 'Current', 'Premium Rate', 'Outstanding Amount (m)'],
+        'filters': [['Current', '<', 'D2'], ['Premium Rate', '<', 'H2'], ['Outstanding Amount (m)', '<', 'M2']],
+        'score': 'Premium Rate',
+        'ascending': True,
+        'top': 20,
+        'destination': ['Singlefactor Strategies', 'J2'],
+    },
+    'DoubleLow': {
+        'title': '[Double Low] Strategy',
+        'source': 'RealTimeData_ConvertibleBond',
+        'columns': ['Quote', 'Name', 'Current', 'Double Low', 'Outstanding Amount (m)'],
+        'filters': [['Current', '<', 'D3'], ['Premium Rate', '<', 'H3'], ['Outstanding Amount (m)', '<', 'M3']],
+        'score': 'Double Low',
+        'ascending': True,
+        'top': 20,
+        'destination': ['Singlefactor Strategies', 'R2'],
+    },
+    'diff_volatility': {
+        'title': '[High Differential Volatility] Strategy',
+        'source': 'Underlying_Values',
+        'columns': ['Quote', 'Name', 'Current', 'Realized Volatility', 'Implied Volitality', 'Differential Volitality'],
+        'filters': [['Current', '<', 'D2'], ['Implied Volitality', '>', 0], ['Differential Volitality', '<', 'P2']],
+        'score': 'Differential Volitality',
+        'ascending': True,
+        'top': 20,
+        'destination': ['Singlefactor Strategies', 'A20'],
+    },
+    'Bias': {
+        'title': '[Low Price/Value Bias] Strategy',
+        'source': 'Underlying_Values',
+        'columns': ['Quote', 'Name', 'Current', 'Theoretical Value', 'Bias'],
+        'filters': [['Current', '<', 'D3'], ['Bias', '<', 'W3']],
+        'score': 'Bias',
+        'ascending': True,
+        'top': 20,
+        'destination': ['Singlefactor Strategies', 'J20'],
+    },
+    'DtD': {
+        'title': '[Hight Distace to Default DtD] Strategy',
+        'source': 'Underlying_Values',
+        'columns': ['Quote', 'Name', 'Current', 'Straight Bond Value', 'DtD'],
+        'filters': [['Current', '<', 'D4'], ['Straight Bond Value', '<', 'S4'], ['DtD', '>', 'X4']],
+        'score': 'DtD',
+        'ascending': False,
+        'top': 20,
+        'destination': ['Singlefactor Strategies', 'R20'],
+    },
+    'multifactor1': {
+        'title': '[Multifactor Model 1] Strategy',
+        'source': 'RealTimeData_ConvertibleBond',
+        'columns': ['Quote', 'Name', 'Current', 'Premium Rate', 'Outstanding Amount (m)'],
+        'filters': [['Current', '<', 'D5'], ['Premium Rate', '<', 'H5'], ['Outstanding Amount (m)', '<', 'M5']],
+        'score': {'name': 'multifactor1',
+                  'terms': [['Current', 'D5', 1], ['Premium Rate', 'H5', 1], ['Outstanding Amount (m)', 'M5', 1]]},
+        'ascending': True,
+        'top': 20,
+        'destination': ['Multifactor Strategies', 'H2'],
+    },
+    'multifactor2': {
+        'title': '[Multifactor Model 2] Strategy',
+        'source': 'RealTimeData_ConvertibleBond',
+        'columns': ['Quote', 'Name', 'Current', 'Premium Rate', 'Outstanding Amount (m)'],
+        'filters': [['Current', '<', 'D6'], ['Premium Rate', '<', 'H6'], ['Outstanding Amount (m)', '<', 'M6']],
+        'score': {'name': 'multifactor2',
+                  'terms': [['Current', 'D6', 1], ['Premium Rate', 'H6', 1], ['Outstanding Amount (m)', 'M6', 1]]},
+        'ascending': True,
+        'top': 20,
+        'destination': ['Multifactor Strategies', 'Q2'],
+    },
+    'multifactor3': {
+        'title': '[Multifactor Model 3] Strategy',
+        'source': 'Underlying_Values',
+        'columns': ['Quote', 'Name', 'Differential Volitality', 'Bias', 'DtD'],
+        'filters': [['Differential Volitality', '<', 'P6'], ['Bias', '<', 'W6'], ['DtD', '>', 'X6']],
+        'score': {'name': 'multifactor3',
+                  'terms': [['Differential Volitality', 'P6', 1], ['Bias', 'W6', 1], ['DtD', 'X6', -1]]},
+        'ascending': True,
+        'top': 20,
+        'destination': ['Multifactor Strategies', 'Z2'],
+    },
+}
+
+comparisons = {'<': np.less, '<=': np.less_equal, '>': np.greater, '>=': np.greater_equal}
+
+
+# Add a strategy to the registry, e.g. from a config file
+def register_strategy(name, spec):
+    strategy_specs[name] = spec
+    return spec
+
+
+# Load strategies from a JSON file {name: spec, ...} into the registry
+def load_strategy_specs(path):
+    with open(path, encoding='utf-8') as spec_file:
+        specs = json.load(spec_file)
+    for name, spec in specs.items():
+        register_strategy(name, spec)
+    return specs
+
+
+# Get the parameter cells a strategy reads from its source sheet
+def get_strategy_cells(spec):
+    cells = [threshold for column, op, threshold in spec['filters'] if isinstance(threshold, str)]
+    if isinstance(spec['score'], dict):
+        cells += [weight for column, weight, sign in spec['score']['terms'] if isinstance(weight, str)]
+    return list(dict.fromkeys(cells))
+
+
+# Get the threshold or the weight of a parameter, '250&5' -> 250 or 5, see get_convertible_bond_factor
+def get_parameter(value, cells, part=0):
+    if isinstance(value, str):
+        value = cells[value]
+    if isinstance(value, str) and '&' in value:
+        return float(value.split('&', -1)[part])
+    return float(value)
+
+
+# Get the score name of a strategy, i.e., the sort column
+def get_score_name(spec):
+    return spec['score']['name'] if isinstance(spec['score'], dict) else spec['score']
+
+
+# Get the columns a strategy reads from its source table: filter columns and score columns
+def get_strategy_columns(spec):
+    columns = [column for column, op, threshold in spec['filters']]
+    columns += [column for column, weight, sign in spec['score']['terms']] if isinstance(spec['score'], dict) else [spec['score']]
+    return list(dict.fromkeys(columns))
+
+
+# Get the filter mask and the score of every row of a strategy
+def get_mask_and_score(spec, arrays, cells):
+    """
+    arrays: dict of column -> float64 array, at least the columns of get_strategy_columns
+    return: bool array of the rows passing all filters, float array of the scores
+    """
+    mask = np.ones(len(next(iter(arrays.values()))), dtype=bool)
+    with np.errstate(invalid='ignore'):
+        for column, op, threshold in spec['filters']:
+            mask &= comparisons[op](arrays[column], get_parameter(threshold, cells, 0))  # NaN never passes a filter
+
+    if isinstance(spec['score'], dict):
+        score = np.zeros(mask.size)
+        for column, weight, sign in spec['score']['terms']:
+            score = score + sign * get_parameter(weight, cells, 1) * arrays[column]
+    else:
+        score = arrays[spec['score']]
+    return mask, score
+
+
+# Get the sort keys of scores: ascending, NaN scores last like sort_values
+def get_sort_key(spec, score):
+    key = score if spec.get('ascending', True) else -score
+    return np.where(np.isnan(key), np.inf, key)
+
+
+# Evaluate one strategy on the float columns of its source table
+def evaluate_strategy(spec, arrays, cells):
+    """
+    arrays: dict of column -> float64 array, every column of the source table
+    cells: dict of parameter cell -> value
+    return: row positions of the top CBs in ranking order, and the score of every row
+    """
+    mask, score = get_mask_and_score(spec, arrays, cells)
+    candidates = np.flatnonzero(mask)
+    key = get_sort_key(spec, score[candidates])
+    top = spec.get('top', 20)
+    if candidates.size > top:
+        kth = np.partition(key, top - 1)[top - 1]   # partial sort, only the top N and their ties are ordered below
+        selected = np.flatnonzero(key <= kth)
+    else:
+        selected = np.arange(candidates.size)
+    order = selected[np.lexsort((candidates[selected], key[selected]))][:top]   # ties at the cut go by row position
+    return candidates[order], score
+
+
+# Get the float columns of a source table, '停牌' and empty cells become NaN. The numeric columns of a typed table
+# (see pipeline.get_typed_table) are used as they are, category columns are skipped
+def get_table_arrays(data):
+    arrays = {}
+    for column in data.columns:
+        values = data[column]
+        if pandas.api.types.is_numeric_dtype(values.dtype):
+            arrays[column] = values.to_numpy(dtype=float)
+        elif values.dtype == object:
+            arrays[column] = pandas.to_numeric(values, errors='coerce').to_numpy(dtype=float)
+    return arrays
+
+
+# Rank the CBs of one strategy, indexed from 1
+def rank_strategy_spec(spec, data_fund_source, cells, arrays=None):
+    """
+    data_fund_source: the source table of the strategy
+    cells: dict of parameter cell -> value
+    arrays: get_table_arrays(data_fund_source), computed once when several strategies share the table
+    """
+    arrays = get_table_arrays(data_fund_source) if arrays is None else arrays
+    rows, score = evaluate_strategy(spec, arrays, cells)
+    return get_ranking_table(spec, data_fund_source, arrays, rows, score)
+
+
+# Build the ranking table of a strategy from the row positions of the top CBs, indexed from 1
+def get_ranking_table(spec, data_fund_source, arrays, rows, score):
+    """
+    rows: row positions of the top CBs in ranking order
+    score: score of every row of the source table
+    """
+    data_fund_destination = data_fund_source.iloc[rows][spec['columns']].reset_index(drop=True)
+    for column in spec['columns']:
+        if column not in ('Quote', 'Name', 'Stock Quote', 'Stock Name') and column in arrays:
+            data_fund_destination[column] = arrays[column][rows]
+    if isinstance(spec['score'], dict):
+        data_fund_destination[get_score_name(spec)] = score[rows]
+    data_fund_destination.index += 1
+    return data_fund_destination
+
+
+# Top N of one strategy kept up to date row by row, for streaming: the rows passing the filters are kept in a list
+# sorted on (sort key, row position), the same order as evaluate_strategy. A changed row is found by bisection and
+# moved, the other rows are not touched, so an update costs a few microseconds instead of filtering and sorting the
+# whole table. The list is a plain Python list: its inserts shift pointers, which is faster than a tree for the few
+# thousand CBs of the market
+class RankingIndex:
+    """
+    spec: strategy spec, see strategy_specs
+    cells: dict of parameter cell -> value of the source sheet, a change of the cells needs build() again
+    """
+    def __init__(self, spec, cells):
+        self.spec = spec
+        self.cells = cells
+        self.columns = get_strategy_columns(spec)
+        self.top = spec.get('top', 20)
+        self.keys = []   # sorted (sort key, row) of the rows passing the filters
+        self.key_of = {}   # row -> (sort key, row), for the rows in self.keys
+        self.score = np.zeros(0)   # score of every row
+        self.top_rows = []   # row positions of the top N, in ranking order
+
+    # Index every row of the source table
+    def build(self, arrays):
+        """
+        arrays: float columns of the source table, see get_table_arrays
+        """
+        mask, score = get_mask_and_score(self.spec, {column: arrays[column] for column in self.columns}, self.cells)
+        self.score = np.array(score, dtype=float)
+        rows = np.flatnonzero(mask)
+        self.keys = sorted(zip(get_sort_key(self.spec, self.score[rows]).tolist(), rows.tolist()))
+        self.key_of = {entry[1]: entry for entry in self.keys}
+        self.top_rows = [row for key, row in self.keys[:self.top]]
+        return self.top_rows
+
+    # Re-index the rows whose inputs changed, return the changes of the top N
+    def update(self, arrays, rows):
+        """
+        arrays: float columns of the source table with the new values
+        rows: positions of the changed rows
+        return: list of deltas in ranking order, {'event': 'enter' | 'exit' | 'move' | 'change', 'row': position,
+                'rank': new rank, 'previous': old rank}, ranks from 1, None when not in the top N.
+                'change' is a row of the top N keeping its rank with new values
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        if rows.size == 0:
+            return []
+        if self.score.size != len(arrays[self.columns[0]]):   # the table changed shape
+            previous = self.top_rows
+            self.build(arrays)
+            return get_ranking_deltas(previous, self.top_rows, self.top_rows)
+        mask, score = get_mask_and_score(self.spec, {column: arrays[column][rows] for column in self.columns}, self.cells)
+        self.score[rows] = score
+        keys = get_sort_key(self.spec, np.asarray(score, dtype=float)).tolist()
+        for row, key, member in zip(rows.tolist(), keys, mask.tolist()):
+            entry = self.key_of.pop(row, None)
+            if entry is not None:
+                del self.keys[bisect.bisect_left(self.keys, entry)]
+            if member:
+                entry = (key, row)
+                bisect.insort(self.keys, entry)
+                self.key_of[row] = entry
+        previous = self.top_rows
+        self.top_rows = [row for key, row in self.keys[:self.top]]
+        return get_ranking_deltas(previous, self.top_rows, rows.tolist())
+
+    # Build the ranking table of the top N, the same table as rank_strategy_spec
+    def get_table(self, data_fund_source, arrays):
+        return get_ranking_table(self.spec, data_fund_source, arrays, np.array(self.top_rows, dtype=np.intp), self.score)
+
+
+# Compare two top N lists of row positions
+def get_ranking_deltas(previous, current, changed_rows=()):
+    """
+    changed_rows: rows whose values changed, reported as 'change' when they keep their rank in the top N
+    return: see RankingIndex.update
+    """
+    old_ranks = {row: rank for rank, row in enumerate(previous, 1)}
+    new_ranks = {row: rank for rank, row in enumerate(current, 1)}
+    changed_rows = set(changed_rows)
+    deltas = []
+    for row, rank in new_ranks.items():
+        if row not in old_ranks:
+            deltas.append({'event': 'enter', 'row': row, 'rank': rank, 'previous': None})
+        elif old_ranks[row] != rank:
+            deltas.append({'event': 'move', 'row': row, 'rank': rank, 'previous': old_ranks[row]})
+        elif row in changed_rows:
+            deltas.append({'event': 'change', 'row': row, 'rank': rank, 'previous': rank})
+    deltas += [{'event': 'exit', 'row': row, 'rank': None, 'previous': rank} for row, rank in old_ranks.items() if row not in new_ranks]
+    return deltas
+
+
+# Get the cell some rows and columns away from a cell, e.g. ('J2', 3) -> 'J5'
+def offset_cell(cell, rows=0, columns=0):
+    letters, digits = re.match(r'([A-Za-z]+)(\d+)', cell).groups()
+    number = 0
+    for letter in letters.upper():
+        number = number * 26 + ord(letter) - ord('A') + 1
+    number += columns
+    letters = ''
+    while number:
+        number, remainder = divmod(number - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters + str(int(digits) + rows)
+
+
+# Get the sheet writes of the ranks touched by some deltas: one row per rank, under the header at the destination
+# cell of the strategy, blank rows where the table got shorter
+def get_ranking_blocks(spec, table, deltas, previous_size):
+    """
+    table: the new ranking table, indexed from 1, see RankingIndex.get_table
+    previous_size: number of rows of the ranking table written before
+    return: list of (sheet name, cell, [[rank, values...]]) for AutoArbitrage.write_blocks
+    """
+    sheet, cell = spec['destination']
+    ranks = sorted({delta['rank'] for delta in deltas if delta['rank'] is not None}
+                   | set(range(len(table) + 1, previous_size + 1)))
+    blocks = []
+    for rank in ranks:
+        if rank <= len(table):
+            values = [value.item() if isinstance(value, np.generic) else value for value in table.loc[rank].tolist()]
+            values = [rank] + [None if isinstance(value, float) and np.isnan(value) else value for value in values]
+        else:
+            values = [None] * (len(table.columns) + 1)
+        blocks.append((sheet, offset_cell(cell, rank), [values]))
+    return blocks
@@ -0,0 +1,291 @@
+import time
+import numpy as np
+import pandas
+from quotes import QuoteFetcher
+from strategies import strategy_specs, comparisons, get_parameter, get_table_arrays, RankingIndex
+from scheduler import TradingCalendar, RefreshScheduler, trading_sessions, get_exchange_time
+from pipeline import (get_bond_symbol, get_float_column, price_underlying_table, StageTimer,
+                      convertible_bond_columns, underlying_columns, get_typed_table, suspended_column, get_suspended_mask)
+
+
+streaming_interval = 5   # seconds between two polls in trading hours
+quotec_batch_size = 50   # symbols per real-time quote request
+streaming_phases = ('pre-open', 'session', 'after-close')   # phases polled by StreamingRefresher.run, see scheduler.day_phases
+hot_ticks = 12   # a symbol whose price moved in the last 12 polls is hot, i.e., polled every time
+hot_band = 0.05   # a row within 5% of a filter threshold of a strategy is hot, e.g. a premium rate in 47.5-52.5 for H2=50
+stale_slices = 6   # the other symbols are polled in turns, 1/6 of them per poll, i.e., each one every 6 polls
+
+# Columns of the stock table re-computed by price_underlying_table
+priced_columns = ['Option Value', 'Option Price', 'Implied Volitality', 'Differential Volitality', 'DtD', 'Theoretical Value', 'Bias']
+# Columns of the CB and stock tables updated by the ticks, the other columns keep the values of the full refresh
+streamed_columns = ['Current', 'Change', 'Amount (k)', 'Turnover Rate', 'Day High', 'Day Low', 'Amplitude', 'Conversion Value',
+                    'Premium Rate', 'Double Low', 'Stock Current', suspended_column] + priced_columns
+
+
+# Is the market open at this time (Beijing time, now by default), weekends and exchange holidays excluded, see scheduler.TradingCalendar
+def in_trading_session(now=None, calendar=None):
+    now = get_exchange_time() if now is None else now
+    return (calendar or get_default_calendar()).is_trading_day(now.date()) \
+        and any(start <= now.strftime('%H:%M') < end for start, end in trading_sessions)
+
+
+default_calendar = None
+
+
+# Calendar shared by the streaming runs, loaded on first use
+def get_default_calendar():
+    global default_calendar
+    if default_calendar is None:
+        default_calendar = TradingCalendar()
+    return default_calendar
+
+
+# Build the real-time quote fetcher of the streaming mode on top of a quote fetcher: many symbols per request,
+# the batches are sent concurrently over the same pool, with the same rate limit
+def get_realtime_fetcher(quote_fetcher, batch_size=quotec_batch_size):
+    transport = quote_fetcher.transport   # needs a quotec method, e.g. quotes.SnowballTransport
+    batch_fetcher = QuoteFetcher(lambda symbols, timeout=None: transport.quotec(symbols, timeout),
+                                 max_workers=quote_fetcher.max_workers, timeout=quote_fetcher.timeout, endpoint='quotec')
+    batch_fetcher.rate_limiter = quote_fetcher.rate_limiter
+
+    def fetch_realtime(symbols):
+        """
+        return: dict of symbol -> quotec quote, symbols of failed batches are missing
+        """
+        symbols = list(symbols)
+        batches = [symbols[i:i + batch_size] for i in range(0, len(symbols), batch_size)]
+        quotes = {}
+        for payload in batch_fetcher.fetch(batches, return_exceptions=True):
+            if not isinstance(payload, Exception):
+                for quote in payload.get('data') or []:
+                    if quote:
+                        quotes[quote['symbol']] = quote
+        return quotes
+    return fetch_realtime
+
+
+# Keep the CB table, the stock table and the rankings fresh in trading hours: poll the real-time quotes, and re-compute
+# only the rows whose bond or stock price changed
+class StreamingRefresher:
+    """
+    data_fund, data_stock: CB table and stock table after a full refresh, see pipeline.build_convertible_bond_table
+                           and pipeline.build_underlying_table
+    parameters: dict of sheet name -> {cell: value}, see pipeline.rank_strategies
+    fetch_realtime: callable(symbols) -> {symbol: quote}, see get_realtime_fetcher
+    names: strategies to keep ranked, None for all
+    calibrator: kmv.KMVCalibrator of the DtD, e.g. the one of the full refresh, None for pipeline.kmv_calibrator
+    model: 'bs' or 'lattice', the model of the full refresh, None for pipeline.convertible_bond_model
+    """
+    def __init__(self, data_fund, data_stock, parameters, fetch_realtime, names=None, log=print, calibrator=None, model=None):
+        self.data_fund = get_typed_table(data_fund, convertible_bond_columns)   # typed copies, updated in place by the ticks
+        self.data_stock = get_typed_table(data_stock, underlying_columns)
+        self.parameters = parameters
+        self.fetch_realtime = fetch_realtime
+        self.names = list(strategy_specs) if names is None else list(names)
+        self.log = log
+        self.calibrator = calibrator
+        self.model = model
+        self.bond_symbols = np.array([get_bond_symbol(fund_code) for fund_code in self.data_fund['Quote']], dtype=object)
+        self.stock_bond_symbols = np.array([get_bond_symbol(fund_code) for fund_code in self.data_stock['Quote']], dtype=object)
+        self.prices = dict(zip(self.stock_bond_symbols, get_float_column(self.data_stock, 'Current')))
+        self.prices.update(zip(self.bond_symbols, get_float_column(self.data_fund, 'Current')))
+        self.prices.update(zip(self.data_stock['Stock Quote'], get_float_column(self.data_stock, 'Stock Current')))
+        self.tables = {'RealTimeData_ConvertibleBond': self.data_fund, 'Underlying_Values': self.data_stock}
+        self.arrays = {sheet: {column: values.copy() for column, values in get_table_arrays(table).items()}
+                       for sheet, table in self.tables.items()}   # float columns of the rankings, updated row by row
+        self.indexes = {}   # strategy name -> RankingIndex, updated with the changed rows only
+        self.rankings = {}
+        for name in self.names:
+            spec = strategy_specs[name]
+            self.indexes[name] = RankingIndex(spec, parameters[spec['source']])
+            self.indexes[name].build(self.arrays[spec['source']])
+            self.rankings[name] = self.indexes[name].get_table(self.tables[spec['source']], self.arrays[spec['source']])
+        self.ranking_deltas = {}   # strategy name -> rank changes of the last tick, see strategies.RankingIndex.update
+        self.ticks = 0
+        self.changed_rows = 0
+        self.moved = {}   # symbol -> last tick its price changed
+        self.hot_symbols = set()   # symbols of the rows near a strategy threshold or in a ranking
+        self.update_hot_symbols()
+
+    def get_symbols(self):
+        stocks = [symbol for symbol in pandas.concat([self.data_fund['Stock Quote'], self.data_stock['Stock Quote']])
+                  if isinstance(symbol, str) and symbol]
+        return list(dict.fromkeys(list(self.bond_symbols) + list(self.stock_bond_symbols) + stocks))
+
+    # Get the symbols of the next poll: the hot symbols, i.e., recently moved, near a strategy threshold or ranked,
+    # and the next slice of the stale ones
+    def get_poll_symbols(self):
+        symbols = self.get_symbols()
+        hot = [symbol for symbol in symbols if symbol in self.hot_symbols or self.ticks - self.moved.get(symbol, -hot_ticks - 1) <= hot_ticks]
+        hot_set = set(hot)
+        stale = [symbol for symbol in symbols if symbol not in hot_set]
+        return hot + stale[self.ticks % stale_slices::stale_slices]
+
+    # Find the rows near a filter threshold of a strategy, or in one of its rankings, and keep their bond and stock
+    # symbols. Only the filters on the columns updated by the ticks are checked, e.g. not 'Outstanding Amount (m)'
+    def update_hot_symbols(self):
+        tables = {'RealTimeData_ConvertibleBond': (self.data_fund, self.bond_symbols),
+                  'Underlying_Values': (self.data_stock, self.stock_bond_symbols)}
+        moving = set(streamed_columns)
+        hot = set()
+        for name in self.names:
+            spec = strategy_specs[name]
+            data, bond_symbols = tables[spec['source']]
+            cells = self.parameters.get(spec['source'], {})
+            near = np.zeros(len(data), dtype=bool)
+            for column, op, threshold in spec['filters']:
+                if column not in moving or column not in data or op not in comparisons:
+                    continue
+                try:
+                    threshold = get_parameter(threshold, cells)
+                except (KeyError, ValueError):
+                    continue
+                values = get_float_column(data, column)
+                scale = abs(threshold) if threshold else np.nanstd(values) if np.isfinite(values).any() else 0.0
+                with np.errstate(invalid='ignore'):
+                    near |= np.abs(values - threshold) <= hot_band * scale
+            if name in self.rankings and 'Quote' in self.rankings[name]:
+                near |= data['Quote'].isin(self.rankings[name]['Quote']).to_numpy()
+            hot.update(bond_symbols[near])
+            hot.update(symbol for symbol in data['Stock Quote'].to_numpy(dtype=object)[near] if isinstance(symbol, str) and symbol)
+        self.hot_symbols = hot
+
+    # Poll once, update the changed rows and the rankings they feed
+    def tick(self, timer=None, symbols=None):
+        """
+        symbols: symbols to poll, None for the hot symbols and a slice of the others, see get_poll_symbols
+        return: dict of table name -> DataFrame, only the tables that changed, e.g. {'RealTimeData_ConvertibleBond': ..., 'DtD': ...}
+        """
+        timer = StageTimer() if timer is None else timer
+        with timer.stage('poll'):
+            quotes = self.fetch_realtime(self.get_poll_symbols() if symbols is None else symbols)
+        changed = {symbol for symbol, quote in quotes.items()
+                   if quote.get('current') is not None and quote['current'] != self.prices.get(symbol)}
+        self.ticks += 1
+        if not changed:
+            return {}
+
+        with timer.stage('update CBs'):
+            stock_symbols = self.data_fund['Stock Quote'].to_numpy(dtype=object)
+            fund_rows = np.flatnonzero([bond in changed or stock in changed for bond, stock in zip(self.bond_symbols, stock_symbols)])
+            self.update_convertible_bonds(fund_rows, quotes)
+        with timer.stage('update underlyings'):
+            stock_symbols = self.data_stock['Stock Quote'].to_numpy(dtype=object)
+            stock_rows = np.flatnonzero([bond in changed or stock in changed for bond, stock in zip(self.stock_bond_symbols, stock_symbols)])
+            self.update_underlyings(stock_rows, quotes)
+        for symbol in changed:
+            self.prices[symbol] = quotes[symbol]['current']
+            self.moved[symbol] = self.ticks
+        self.changed_rows += len(fund_rows) + len(stock_rows)
+
+        updated, changed_rows = {}, {}
+        if len(fund_rows):
+            updated['RealTimeData_ConvertibleBond'] = self.data_fund
+            changed_rows['RealTimeData_ConvertibleBond'] = fund_rows
+        if len(stock_rows):
+            updated['Underlying_Values'] = self.data_stock
+            changed_rows['Underlying_Values'] = stock_rows
+        for sheet, rows in changed_rows.items():
+            self.update_arrays(sheet, rows)
+        self.ranking_deltas = {}
+        for name in self.names:
+            source = strategy_specs[name]['source']
+            if source not in changed_rows:
+                continue
+            with timer.stage('ranking: ' + name):
+                deltas = self.indexes[name].update(self.arrays[source], changed_rows[source])
+                if deltas:   # only the rankings that moved are written
+                    self.rankings[name] = self.indexes[name].get_table(self.tables[source], self.arrays[source])
+                    self.ranking_deltas[name] = deltas
+                    updated[name] = self.rankings[name]
+        self.update_hot_symbols()
+        self.log('Tick ' + str(self.ticks) + '：' + str(len(changed)) + ' prices changed, ' + str(len(fund_rows)) + ' CBs and '
+                 + str(len(stock_rows)) + ' underlyings re-computed, ' + str(len(updated)) + ' tables updated')
+        return updated
+
+    # Copy the streamed columns of some rows of a table into its float columns
+    def update_arrays(self, sheet, rows):
+        data, arrays = self.tables[sheet], self.arrays[sheet]
+        for column in streamed_columns:
+            if column in arrays:
+                arrays[column][rows] = get_float_column(data, column)[rows]
+
+    # Update the price columns of the CB rows, and their conversion value and premium rate from the stock price
+    def update_convertible_bonds(self, rows, quotes):
+        if len(rows) == 0:
+            return
+        data = self.data_fund
+        labels = data.index[rows]
+        bond_quotes = [quotes.get(symbol, {}) for symbol in self.bond_symbols[rows]]
+        current = np.array([quote.get('current', np.nan) if quote.get('current') is not None else np.nan for quote in bond_quotes], dtype=float)
+        current = np.where(np.isnan(current), get_float_column(data, 'Current')[rows], current)
+        stock_current = np.array([self.get_price(symbol, quotes) for symbol in data['Stock Quote'].to_numpy(dtype=object)[rows]], dtype=float)
+        conversion_value = 100 / get_float_column(data, 'Conversion Price')[rows] * stock_current
+        conversion_value = np.where(np.isnan(conversion_value), get_float_column(data, 'Conversion Value')[rows], conversion_value)
+        premium_rate = (current / conversion_value - 1) * 100
+        outstanding = get_float_column(data, 'Outstanding Amount (m)')[rows]
+
+        data.loc[labels, 'Current'] = current
+        data.loc[labels, 'Conversion Value'] = conversion_value
+        data.loc[labels, 'Premium Rate'] = premium_rate
+        data.loc[labels, 'Double Low'] = current + premium_rate
+        quoted = np.array([bool(quote) for quote in bond_quotes], dtype=bool)   # rows without a new quote keep their values
+        if not quoted.any():
+            return
+        labels, bond_quotes = labels[quoted], [quote for quote in bond_quotes if quote]
+        current, outstanding = current[quoted], outstanding[quoted]
+        percent = np.array([quote.get('percent') for quote in bond_quotes], dtype=float)
+        amount = np.array([quote.get('amount') for quote in bond_quotes], dtype=float)
+        high = np.array([quote.get('high') for quote in bond_quotes], dtype=float)
+        low = np.array([quote.get('low') for quote in bond_quotes], dtype=float)
+        data.loc[labels, 'Change'] = percent / 100
+        traded = ~np.isnan(amount)
+        data.loc[labels[traded], 'Amount (k)'] = amount[traded] / 1000
+        data.loc[labels[traded], 'Turnover Rate'] = (amount[traded] / 1000000 / current[traded]) / (outstanding[traded] / 100)
+        data.loc[labels, 'Day High'] = high
+        data.loc[labels, 'Day Low'] = low
+        with np.errstate(divide='ignore', invalid='ignore'):
+            data.loc[labels, 'Amplitude'] = np.where((high > 0) & (low > 0), (high - low) / low, np.nan)
+        data.loc[labels, suspended_column] = get_suspended_mask(data.loc[labels])
+
+    # Update the CB and stock prices of the stock rows, then re-price those rows only
+    def update_underlyings(self, rows, quotes):
+        if len(rows) == 0:
+            return
+        data = self.data_stock
+        labels = data.index[rows]
+        current = np.array([self.get_price(symbol, quotes) for symbol in self.stock_bond_symbols[rows]], dtype=float)
+        current = np.where(np.isnan(current), get_float_column(data, 'Current')[rows], current)
+        stock_current = np.array([self.get_price(symbol, quotes) for symbol in data['Stock Quote'].to_numpy(dtype=object)[rows]], dtype=float)
+        conversion_value = 100 / get_float_column(data, 'Conversion Price')[rows] * stock_current
+        conversion_value = np.where(np.isnan(conversion_value), get_float_column(data, 'Conversion Value')[rows], conversion_value)
+        data.loc[labels, 'Current'] = current
+        data.loc[labels, 'Stock Current'] = stock_current
+        data.loc[labels, 'Conversion Value'] = conversion_value
+        data.loc[labels, 'Premium Rate'] = (current / conversion_value - 1) * 100
+        priced = price_underlying_table(data.loc[labels].copy(), model=self.model, calibrator=self.calibrator)
+        data.loc[labels, priced_columns] = priced[priced_columns].to_numpy(dtype=float)
+
+    def get_price(self, symbol, quotes):
+        if symbol in quotes and quotes[symbol].get('current') is not None:
+            return quotes[symbol]['current']
+        return self.prices.get(symbol, np.nan)
+
+    # Poll until stop() returns True, at the cadence of the phase of the trading day: every `interval` seconds in
+    # session, less often in the pre-open and after the close, never in the lunch break, on weekends or on holidays.
+    # The after-close polls get every symbol, for the closing prices
+    def run(self, on_update, interval=streaming_interval, stop=None, calendar=None, intervals=None, sleep=time.sleep):
+        """
+        on_update: callable(dict of table name -> DataFrame) receiving the tables changed by a tick
+        stop: callable() -> bool, e.g. lambda: scheduler.get_exchange_time().hour >= 15, None to run forever
+        calendar: scheduler.TradingCalendar, None for the shared one
+        intervals: seconds between two polls of the other phases, see scheduler.phase_intervals
+        """
+        def poll(phase):
+            updated = self.tick(symbols=self.get_symbols() if phase == 'after-close' else None)
+            if updated:
+                on_update(updated)
+        scheduler = RefreshScheduler({phase: poll for phase in streaming_phases}, calendar=calendar or get_default_calendar(),
+                                     intervals={**(intervals or {}), 'session': interval}, log=self.log)
+        scheduler.run(stop, sleep)
+        return scheduler
@@ -0,0 +1,6 @@
+import os
+import sys
+
+
+# The modules are flat at the root of the repository, next to the workbook
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,138 @@
+import io
+import json
+import asyncio
+import threading
+import numpy as np
+import pandas
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import alerts
+from alerts import (AlertEngine, RuleState, StdoutAlertSink, FileAlertSink, WebhookAlertSink, get_alert_sinks, format_alert,
+                    register_alert_rule, load_alert_rules, alert_rules)
+
+
+bias_rule = {'title': 'Bias under W3', 'type': 'threshold', 'source': 'Underlying_Values', 'column': 'Bias', 'op': '<',
+             'threshold': 'W3', 'hysteresis': 0.01, 'debounce': 2, 'initial': True}
+parameters = {'Underlying_Values': {'W3': -0.05}}
+
+
+def stock_table(*bias):
+    return {'Underlying_Values': pandas.DataFrame({'Quote': ['110003', '123107'], 'Name': ['A转债', 'B转债'], 'Bias': list(bias)})}
+
+
+# Keep the alerts delivered by the engine
+class ListSink:
+    def __init__(self):
+        self.alerts = []
+
+    async def send(self, alerts):
+        self.alerts += alerts
+
+
+class FailingSink:
+    async def send(self, alerts):
+        raise RuntimeError('sink down')
+
+
+def test_rule_state_debounce_and_initial():
+    state = RuleState()
+    quotes = np.array(['a', 'b'], dtype=object)
+    triggered, cleared = state.update(quotes, np.array([True, False]), np.array([False, True]), debounce=1)
+    assert not triggered.any() and not cleared.any()   # known on the first update, not notified
+    triggered, cleared = state.update(quotes, np.array([True, True]), np.array([False, False]), debounce=1)
+    assert triggered.tolist() == [False, True]
+    triggered, cleared = state.update(quotes, np.array([False, False]), np.array([True, True]), debounce=2)
+    assert not cleared.any()
+    triggered, cleared = state.update(quotes, np.array([False, False]), np.array([True, True]), debounce=2)
+    assert cleared.tolist() == [True, True]
+
+
+def test_threshold_debounce_and_hysteresis():
+    engine = AlertEngine([], parameters, rules={'bias': bias_rule}, log=lambda *args: None)
+    assert engine.evaluate(stock_table(-0.06, 0.0)) == []   # first update of the debounce
+    alerts = engine.evaluate(stock_table(-0.07, 0.0))
+    assert [(alert['event'], alert['quote'], alert['name']) for alert in alerts] == [('trigger', '110003', 'A转债')]
+    assert alerts[0]['value'] == -0.07 and alerts[0]['threshold'] == -0.05
+    assert engine.evaluate(stock_table(np.nan, 0.0)) == []   # missing values keep the state
+    assert engine.evaluate(stock_table(-0.045, 0.0)) == []   # above the threshold, within the hysteresis
+    assert engine.evaluate(stock_table(-0.045, 0.0)) == []
+    assert engine.evaluate(stock_table(-0.03, 0.0)) == []
+    assert [alert['event'] for alert in engine.evaluate(stock_table(-0.03, 0.0))] == ['clear']
+    assert engine.evaluate(stock_table(-0.03, 0.0)) == []
+
+
+def test_known_conditions_are_not_notified_without_initial():
+    engine = AlertEngine([], parameters, rules={'bias': {**bias_rule, 'initial': False, 'debounce': 1}})
+    assert engine.evaluate(stock_table(-0.06, -0.06)) == []
+    assert engine.evaluate(stock_table(-0.045, -0.06)) == []   # within the hysteresis
+    assert [(alert['event'], alert['quote']) for alert in engine.evaluate(stock_table(-0.03, -0.06))] == [('clear', '110003')]
+
+
+def test_ranking_enter_and_exit():
+    rule = {'title': 'top', 'type': 'ranking', 'strategy': 'multifactor1', 'debounce': 1, 'initial': True}
+    engine = AlertEngine([], {}, rules={'top': rule})
+    universe = pandas.DataFrame({'Quote': ['110003', '123107', '113050'], 'Name': ['A转债', 'B转债', 'C转债']})
+    alerts = engine.evaluate({'RealTimeData_ConvertibleBond': universe, 'multifactor1': universe[['Quote']].iloc[:2]})
+    assert [(alert['event'], alert['quote']) for alert in alerts] == [('enter', '110003'), ('enter', '123107')]
+    alerts = engine.evaluate({'multifactor1': universe[['Quote']].iloc[1:]})
+    assert [(alert['event'], alert['quote'], alert['name']) for alert in alerts] == [('enter', '113050', 'C转债'),
+                                                                                     ('exit', '110003', 'A转债')]
+    assert engine.evaluate({'multifactor1': universe[['Quote']].iloc[1:]}) == []
+
+
+def test_engine_delivers_to_all_sinks(tmp_path):
+    sink, path, failures = ListSink(), str(tmp_path / 'alerts.jsonl'), []
+    engine = AlertEngine([sink, FailingSink(), FileAlertSink(path)], parameters, rules={'bias': {**bias_rule, 'debounce': 1}},
+                         log=failures.append).start()
+    data = stock_table(-0.06, 0.0)
+    engine.submit(data)
+    data['Underlying_Values'].loc[0, 'Bias'] = 0.0   # the update was copied
+    engine.stop()
+    assert [alert['quote'] for alert in sink.alerts] == ['110003'] and sink.alerts[0]['value'] == -0.06
+    with open(path, encoding='utf-8') as alert_file:
+        assert [json.loads(line)['quote'] for line in alert_file] == ['110003']
+    assert failures and 'FailingSink' in failures[0]
+
+
+def test_stdout_sink_and_format():
+    alert = {'time': 0, 'rule': 'bias', 'title': 'Bias under W3', 'event': 'trigger', 'quote': '110003', 'name': None,
+             'value': -0.0612, 'threshold': -0.05}
+    stream = io.StringIO()
+    asyncio.run(StdoutAlertSink(stream).send([alert]))
+    assert stream.getvalue().strip().endswith('[trigger] Bias under W3：110003  -0.0612 (-0.05)')
+    assert format_alert({**alert, 'value': None}).endswith('：110003 ')
+
+
+def test_webhook_sink_posts_the_alerts():
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        sinks = get_alert_sinks([{'type': 'webhook', 'url': 'http://127.0.0.1:' + str(server.server_address[1]) + '/alerts'},
+                                 {'type': 'stdout'}])
+        assert isinstance(sinks[0], WebhookAlertSink) and isinstance(sinks[1], StdoutAlertSink)
+        asyncio.run(sinks[0].send([{'quote': '110003'}]))
+        assert received == [[{'quote': '110003'}]]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_rules_registry(tmp_path, monkeypatch):
+    monkeypatch.setattr('alerts.alert_rules', dict(alert_rules))
+    path = tmp_path / 'rules.json'
+    path.write_text(json.dumps({'amplitude': {'type': 'threshold', 'source': 'RealTimeData_ConvertibleBond',
+                                              'column': 'Amplitude', 'op': '>', 'threshold': 8}}), encoding='utf-8')
+    load_alert_rules(str(path))
+    register_alert_rule('other', bias_rule)
+    assert {'amplitude', 'other', 'bias_below_W3'} <= set(alerts.alert_rules)
+    assert 'amplitude' not in alert_rules   # the registry of the module is restored after the test
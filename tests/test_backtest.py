@@ -0,0 +1,90 @@
+import datetime
+import numpy as np
+import pandas
+import pytest
+from strategies import strategy_specs, evaluate_strategy
+from snapshots import SnapshotStore
+from scheduler import exchange_timezone
+from backtest import (BacktestPanel, load_panel, get_sweep_cells, get_strategy_parameters, select_batch, backtest_strategy,
+                      get_backtest_stats)
+
+
+cells = {'D2': 250, 'H2': 50, 'M2': 900, 'D3': 200, 'H3': 30, 'M3': 600, 'D5': '250&5', 'H5': '50&2', 'M5': '900&3'}
+cheapest = {'title': 'Cheapest', 'source': 'RealTimeData_ConvertibleBond', 'columns': ['Quote', 'Current'], 'filters': [],
+            'score': 'Current', 'ascending': True, 'top': 1}
+
+
+def make_panel(current, suspended=None):
+    current = np.array(current, dtype=float)
+    dates = np.arange(current.shape[0]).astype('datetime64[D]')
+    quotes = np.array(['110003', '123107', '113050'][:current.shape[1]], dtype=object)
+    suspended = np.zeros(current.shape, dtype=bool) if suspended is None else np.array(suspended)
+    return BacktestPanel(dates, quotes, {'Current': current}, suspended)
+
+
+def test_sweep_cells_and_parameters():
+    configurations = get_sweep_cells(cells, {'D5': ['250&5', '200&1'], 'H5': ['50&1', '50&2', '50&3']})
+    assert len(configurations) == 6 and configurations[-1]['D5'] == '200&1' and configurations[-1]['M2'] == 900
+    assert get_sweep_cells(cells) == [cells]
+    thresholds, weights = get_strategy_parameters(strategy_specs['multifactor1'], configurations)
+    assert thresholds.shape == (6, len(strategy_specs['multifactor1']['filters']))
+    assert weights[-1].tolist() == [1.0, 3.0, 3.0]
+
+
+@pytest.mark.parametrize('name', ['premium_rate', 'DoubleLow', 'multifactor1'])
+def test_select_batch_matches_evaluate_strategy(name):
+    spec = strategy_specs[name]
+    rng = np.random.default_rng(2)
+    size = 200
+    arrays = {'Current': rng.uniform(90, 300, size).round(-1), 'Premium Rate': rng.uniform(-5, 80, size).round(-1),
+              'Outstanding Amount (m)': rng.uniform(50, 1500, size).round(-2)}   # many equal scores
+    arrays['Premium Rate'][::17] = np.nan
+    arrays['Double Low'] = arrays['Current'] + arrays['Premium Rate']
+    tradable = rng.random(size) > 0.05
+    configurations = get_sweep_cells(cells, {'D5': ['250&5', '250&1'], 'H5': ['50&2', '50&0'], 'D2': [250, 150], 'D3': [200, 150]})
+    thresholds, weights = get_strategy_parameters(spec, configurations)
+    selected = select_batch(spec, arrays, thresholds, weights, tradable)
+    for c, configuration in enumerate(configurations):
+        rows = evaluate_strategy(spec, {column: np.where(tradable, values, np.nan) for column, values in arrays.items()},
+                                 configuration)[0]
+        assert np.flatnonzero(selected[c]).tolist() == sorted(rows.tolist())
+
+
+def test_backtest_returns_costs_and_suspensions():
+    panel = make_panel([[100, 110], [110, 99], [121, 99]])
+    result = backtest_strategy(cheapest, panel, [{}], rebalance_days=1, cost_rate=0.0)
+    np.testing.assert_allclose(result['nav'][0], [1.0, 1.1, 1.1])   # the 2nd CB is bought on day 1, before it moves
+    np.testing.assert_allclose(result['turnover'][0], [1.0, 2.0, 0.0])
+    result = backtest_strategy(cheapest, panel, [{}], rebalance_days=1, cost_rate=0.001)
+    np.testing.assert_allclose(result['nav'][0], [0.999, 0.999 * 1.1 * 0.998, 0.999 * 1.1 * 0.998])
+
+    # the 1st CB is suspended on day 1: it cannot be sold, nothing else can be bought
+    suspended = make_panel([[100, 110], [110, 99], [121, 99]], [[False, False], [True, False], [False, False]])
+    result = backtest_strategy(cheapest, suspended, [{}], rebalance_days=1, cost_rate=0.0)
+    np.testing.assert_allclose(result['nav'][0], [1.0, 1.1, 1.21])
+    assert result['holdings'][0].tolist() == [1, 1, 1] and result['turnover'][0, 1] == 0.0
+
+
+def test_backtest_stats():
+    panel = make_panel([[100, 110], [110, 99], [121, 99], [100, 99]])
+    configurations = [{'H5': '50&1'}, {'H5': '50&2'}]
+    stats = get_backtest_stats(backtest_strategy(cheapest, panel, configurations, rebalance_days=5, cost_rate=0.0),
+                               configurations, ['H5'])
+    assert stats['H5'].tolist() == ['50&1', '50&2']
+    assert stats['Total Return'][0] == pytest.approx(0.0) and stats['Max Drawdown'][0] == pytest.approx(100 / 121 - 1)
+    assert stats['Holdings'][0] == 1.0
+
+
+def test_load_panel_keeps_the_last_snapshot_of_every_day(tmp_path):
+    pytest.importorskip('pyarrow')
+    store = SnapshotStore(str(tmp_path))
+    for day, hour, current in ((4, 10, [120.0, 99.0]), (4, 14, [121.0, '停牌']), (5, 10, [122.0, 101.0])):
+        table = pandas.DataFrame({'Quote': ['110003', '123107'], 'Current': current, 'Premium Rate': [10.0, 20.0]})
+        store.append('RealTimeData_ConvertibleBond', table, datetime.datetime(2024, 3, day, hour, tzinfo=exchange_timezone).timestamp())
+    panel = load_panel(store, 'RealTimeData_ConvertibleBond', columns=['Premium Rate'])
+    assert panel.quotes.tolist() == ['110003', '123107'] and panel.dates.size == 2
+    np.testing.assert_array_equal(panel.arrays['Current'], [[121.0, np.nan], [122.0, 101.0]])
+    assert panel.suspended.tolist() == [[False, True], [False, False]]
+    assert set(panel.arrays) == {'Current', 'Premium Rate'}
+    with pytest.raises(Exception):
+        load_panel(str(tmp_path), 'RealTimeData_ConvertibleBond', start='2025-01-01')
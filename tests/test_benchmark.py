@@ -0,0 +1,84 @@
+import json
+import urllib.error
+import urllib.request
+import numpy as np
+import pytest
+from pipeline import get_bond_symbol
+from quotes import SnowballTransport
+from benchmark import make_universe, StubQuoteServer, BenchmarkRecorder, compare_baseline, run_benchmark, main
+
+
+def test_make_universe_is_consistent_and_seeded():
+    payloads, quotes, inputs = make_universe(50, seed=3)
+    assert len(quotes) == 50 and inputs['Quote'].tolist() == quotes
+    for quote in quotes:
+        bond = payloads[get_bond_symbol(quote)]['data']['quote']
+        stock = payloads[bond['underlying_symbol']]['data']['quote']   # every underlying is served
+        assert bond['conversion_value'] == pytest.approx(100 / bond['conversion_price'] * stock['current'], abs=1e-3)
+    assert make_universe(50, seed=3)[2].equals(inputs) and not make_universe(50, seed=4)[2].equals(inputs)   # the payload dates follow the clock
+
+
+def test_stub_quote_server():
+    payloads, quotes, inputs = make_universe(5)
+    symbol = get_bond_symbol(quotes[0])
+    with StubQuoteServer(payloads) as server:
+        with urllib.request.urlopen(server.url + symbol, timeout=5) as response:
+            assert json.loads(response.read()) == payloads[symbol]
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(server.url + 'SH000000', timeout=5)
+        assert error.value.code == 404 and json.loads(error.value.read())['error_code'] != 400016   # not a token expiry
+        assert server.requests == 2
+
+
+# Token of the transport, renewed once the server rejects it
+class Credentials:
+    def __init__(self):
+        self.value = 'expired'
+
+    def cookie(self):
+        return 'xq_a_token=' + self.value + ';'
+
+    def renew(self, rejected):
+        self.value = 'fresh'
+
+
+def test_stub_quote_server_expired_tokens():
+    payloads, quotes, inputs = make_universe(5)
+    symbol = get_bond_symbol(quotes[0])
+    with StubQuoteServer(payloads, expired_tokens={'expired'}) as server:
+        transport = SnowballTransport(Credentials(), base_url=server.url, backoff=0.0)
+        assert transport(symbol, timeout=5) == payloads[symbol]
+        assert server.requests == 2 and transport.credentials.value == 'fresh'
+        with pytest.raises(Exception):
+            transport('SH000000', timeout=5)   # unknown symbol: no renewal, no replay
+        assert server.requests == 3 and transport.credentials.value == 'fresh'
+        transport.close()
+
+
+def test_recorder_adds_up_the_runs_of_a_stage():
+    recorder = BenchmarkRecorder(memory=True)
+    assert recorder.run('build', sum, [1, 2]) == 3
+    recorder.run('build', lambda: np.zeros(2**18))
+    assert list(recorder.seconds) == ['build'] and recorder.peak_mb['build'] >= 2.0
+    with pytest.raises(ZeroDivisionError):
+        recorder.run('fail', lambda: 1 / 0)
+    assert 'fail' in recorder.seconds   # the time of a failed stage is kept
+
+
+def test_compare_baseline():
+    results = {100: {'fetch': {'seconds': 1.2}, 'ranking': {'seconds': 2.0}, 'greeks': {'seconds': 0.1}}}
+    baseline = {'100': {'fetch': {'seconds': 1.0}, 'ranking': {'seconds': 1.0}}}
+    assert compare_baseline(results, baseline) == [(100, 'ranking', 2.0, 1.0)]   # new stages are not regressions
+    assert compare_baseline(results, baseline, tolerance=0.1) == [(100, 'fetch', 1.2, 1.0), (100, 'ranking', 2.0, 1.0)]
+    assert compare_baseline(results, {}) == []
+
+
+def test_run_benchmark_and_baseline(tmp_path, capsys):
+    results = run_benchmark(20, max_workers=2, scalar_sample=5)
+    assert {'fetch', 'build', 'pricing', 'IV solve batch', 'ranking', 'ranking index update', 'write'} <= set(results)
+    assert all(result['seconds'] >= 0 and result['peak_mb'] is None for result in results.values())
+    baseline = str(tmp_path / 'baseline.json')
+    assert main(['--sizes', '20', '--repeat', '1', '--baseline', baseline, '--save-baseline']) == 0
+    assert set(json.load(open(baseline, encoding='utf-8'))['20']) == set(results)
+    assert main(['--sizes', '20', '--repeat', '1', '--baseline', baseline, '--tolerance', '1000']) == 0
+    assert 'No regression' in capsys.readouterr().out
@@ -0,0 +1,77 @@
+import os
+import time
+import datetime
+import numpy as np
+import pandas
+import pytest
+from bondfloor import (build_schedule, add_years, YieldCurve, BondFloorEngine, load_yield_curve, load_bond_terms,
+                       fill_straight_bond_value, default_coupons, get_date)
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+epoch = datetime.date(1970, 1, 1)
+
+
+def test_build_schedule():
+    dates, amounts = build_schedule(datetime.date(2020, 2, 29), datetime.date(2026, 2, 28), default_coupons, 110.0)
+    assert [epoch + datetime.timedelta(days=int(day)) for day in dates] == \
+        [datetime.date(2021, 2, 28), datetime.date(2022, 2, 28), datetime.date(2023, 2, 28), datetime.date(2024, 2, 29),
+         datetime.date(2025, 2, 28), datetime.date(2026, 2, 28)]
+    np.testing.assert_allclose(amounts, [0.3, 0.5, 1.0, 1.5, 1.8, 110.0])
+    dates, amounts = build_schedule(datetime.date(2020, 1, 1), datetime.date(2027, 1, 1), (1.0, 2.0), None)
+    np.testing.assert_allclose(amounts, [1.0, 2.0, 2.0, 2.0, 2.0, 2.0, 102.0])   # last coupon repeated, 100 + coupon at maturity
+    assert add_years(datetime.date(2024, 2, 29), 1) == datetime.date(2025, 2, 28)
+
+
+def test_yield_curve_interpolation():
+    curve = YieldCurve([1, 2, 5], {'Government': [1.0, 2.0, 3.5], 'AA': [3.0, 4.0, 5.0]})
+    np.testing.assert_allclose(curve.rate([0, 0, 0, 1], [0.5, 1.5, 9.0, 3.5]), [1.0, 1.5, 3.5, 4.5])
+    assert curve.get_curve_index(['AA', 'unknown']).tolist() == [1, 1]
+
+
+def test_bond_floor_discounts_the_remaining_flows():
+    curve = YieldCurve([1, 10], {'Government': [2.0, 2.0], 'AA': [3.0, 3.0]})
+    engine = BondFloorEngine(curve)
+    today = datetime.date(2024, 1, 1)
+    value = engine.bond_floor(['110001', '110002'], ['2020-06-01', None], ['2026-06-01', None], today=today)
+    dates, amounts = build_schedule(datetime.date(2020, 6, 1), datetime.date(2026, 6, 1))
+    t = (dates - (today - epoch).days) / 365.0
+    expected = np.sum(np.where(t > 0, amounts * 1.03 ** -np.maximum(t, 0), 0.0))
+    assert value[0] == pytest.approx(expected)
+    assert np.isnan(value[1])   # no dates, no schedule
+    assert np.isnan(engine.bond_floor(['110001'], ['2010-06-01'], ['2016-06-01'], today=today)[0])   # matured
+    np.testing.assert_allclose(engine.risk_free_rate([1.0, 3.0]), [2.0, 2.0])
+
+
+def test_terms_and_example_files():
+    engine = BondFloorEngine(os.path.join(root, 'yield_curve.example.csv'), os.path.join(root, 'bond_terms.example.csv'))
+    assert engine.get_terms('SH113050') == ((0.2, 0.4, 0.6, 1.0, 1.5, 2.0), 108.0, 'AAA')
+    assert engine.get_terms('SZ128000')[2] == 'AA'
+    value = engine.bond_floor(['113050', '123107'], ['2019-12-01', '2021-03-01'], ['2025-12-01', '2027-03-01'],
+                              today=datetime.date(2024, 1, 1))
+    assert 90 < value[0] < 110 and 90 < value[1] < 115
+    assert load_yield_curve(os.path.join(root, 'yield_curve.example.csv')) is engine.curve   # cached until the file changes
+    assert list(load_bond_terms(os.path.join(root, 'bond_terms.example.csv')).index) == ['SH113050', 'SZ123107']
+
+
+def test_fill_straight_bond_value_keeps_sheet_values():
+    engine = BondFloorEngine(YieldCurve([1, 10], {'Government': [2.0, 2.0], 'AA': [3.0, 3.0]}))
+    data_stock = pandas.DataFrame({'Quote': ['110001', '110002'], 'Remain Year': [2.5, 1.0],
+                                   'Straight Bond Value': [95.0, 97.0], 'Interest Rate': [2.4, 2.4]})
+    details = [{'data': {'quote': {'issue_date': '2024-06-01', 'maturity_date': '2099-06-01'}}}, {'data': {'quote': {}}}]
+    filled = fill_straight_bond_value(data_stock, engine, details, log=lambda *args: None)
+    assert filled['Straight Bond Value'][0] != 95.0 and filled['Straight Bond Value'][1] == 97.0
+    np.testing.assert_allclose(filled['Interest Rate'], [2.0, 2.0])
+
+
+def test_timestamps_are_dated_in_beijing_time(monkeypatch):
+    midnight = datetime.datetime(2020, 5, 21, tzinfo=datetime.timezone(datetime.timedelta(hours=8))).timestamp() * 1000
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    try:
+        assert get_date(midnight) == get_date(int(midnight)) == datetime.date(2020, 5, 21)
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+    assert get_date('2020-05-21') == get_date(datetime.date(2020, 5, 21)) == datetime.date(2020, 5, 21)
+    assert get_date(None) is None and get_date(np.nan) is None
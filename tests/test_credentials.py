@@ -0,0 +1,67 @@
+import time
+import threading
+import pytest
+from credentials import TokenManager, is_token_expired, token_max_attempts
+
+
+# Token manager reading its tokens from a list instead of the website, None for a failed attempt
+def make_manager(tokens, tmp_path=None, **kwargs):
+    manager = TokenManager(str(tmp_path / 'token.json') if tmp_path else None, browser=False, retry_interval=0.3,
+                           log=lambda *args: None, **kwargs)
+    tokens = list(tokens)
+    manager.calls = 0
+
+    def from_website():
+        manager.calls += 1
+        value = tokens.pop(0) if tokens else None
+        return value, None
+
+    manager.from_website = from_website
+    return manager
+
+
+def test_token_is_cached_and_persisted(tmp_path):
+    manager = make_manager(['abc'], tmp_path)
+    assert manager.cookie() == 'xq_a_token=abc;' and manager.token() == 'abc' and manager.calls == 1
+    assert make_manager([], tmp_path).token() == 'abc'   # read from the file, the website is not asked
+
+
+def test_lock_is_released_between_attempts():
+    manager = make_manager([None] * 100, max_attempts=None)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(manager.token()), daemon=True)
+    thread.start()
+    time.sleep(0.1)   # the thread is waiting for its next attempt
+    assert manager.lock.acquire(timeout=0.1)
+    manager.value, manager.expires = 'given', None   # e.g. another thread got one
+    manager.lock.release()
+    thread.join(2)
+    assert result == ['given']
+
+
+def test_gives_up_after_max_attempts():
+    assert token_max_attempts is not None
+    manager = make_manager([None, None], max_attempts=2)
+    manager.retry_interval = 0
+    with pytest.raises(Exception, match='2 attempts'):
+        manager.token()
+    assert manager.calls == 2
+
+
+def test_renew_skips_the_rejected_token_once_for_all_threads():
+    manager = make_manager(['old', 'old', 'new'], max_attempts=3)
+    manager.retry_interval = 0
+    assert manager.token() == 'old'
+    cookies = []
+    threads = [threading.Thread(target=lambda: cookies.append(manager.renew('xq_a_token=old;'))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(2)
+    assert cookies == ['xq_a_token=new;'] * 4
+    assert manager.calls == 3   # one renewal: 'old' again is skipped, then 'new'
+
+
+def test_is_token_expired():
+    assert is_token_expired({'error_code': 400016}) and is_token_expired({'error_code': '400016'})
+    assert not is_token_expired({'error_code': 0}) and not is_token_expired(None)
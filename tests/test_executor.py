@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from executor import PricingExecutor, get_shards
+from pricing import cb_lattice_batch, cb_implied_volatility_batch, bs_option_batch
+
+
+# A universe of CBs with a few invalid rows, see pricing.cb_lattice_batch
+def make_inputs(size=40, seed=3):
+    rng = np.random.default_rng(seed)
+    S = rng.uniform(5, 30, size)
+    K = S * rng.uniform(0.7, 1.4, size)
+    T = rng.uniform(0.3, 5.5, size)
+    sigma = rng.uniform(0.15, 0.7, size)
+    bond_value = rng.uniform(80, 100, size)
+    S[3::14] = np.nan
+    return S, K, T, 0.02, 0.01, sigma, bond_value, 0.7 * K, 1.3 * K
+
+
+def test_get_shards_cover_the_universe_with_balanced_costs():
+    costs = np.array([5.0, 1.0, 1.0, 0.0, 3.0, 2.0, 2.0, 1.0])
+    shards = get_shards(costs, 3)
+    assert len(shards) == 3
+    assert sorted(np.concatenate(shards).tolist()) == list(range(costs.size))
+    assert all((np.diff(shard) > 0).all() for shard in shards)
+    assert max(costs[shard].sum() for shard in shards) == 5.0
+    assert len(get_shards(np.ones(2), 8)) == 2 and len(get_shards(np.ones(5), 1)) == 1
+
+
+@pytest.fixture
+def executor():
+    executor = PricingExecutor(workers=2, min_size=0, log=lambda *args: None)
+    yield executor
+    executor.close()
+
+
+def test_pool_matches_in_process(executor):
+    inputs = make_inputs()
+    expected = cb_lattice_batch(*inputs, steps=50)
+    costs = np.isfinite(inputs[0])
+    np.testing.assert_array_equal(executor.map(cb_lattice_batch, *inputs, costs=costs, steps=50), expected)
+    assert executor.pool is not None
+    P = np.where(np.isfinite(expected), expected, 110.0)
+    implied = executor.map(cb_implied_volatility_batch, P, *inputs[:5], *inputs[6:], costs=costs, steps=50)
+    np.testing.assert_array_equal(implied, cb_implied_volatility_batch(P, *inputs[:5], *inputs[6:], steps=50))
+
+
+def test_pool_keeps_shape_and_tuple_outputs(executor):
+    S, K, T, r, q, sigma = (np.asarray(x, dtype=float) for x in make_inputs(12)[:6])
+    d1, d2, p = executor.map(bs_option_batch, S.reshape(3, 4), K.reshape(3, 4), T.reshape(3, 4), r, q, sigma.reshape(3, 4), outputs=3)
+    expected = bs_option_batch(S, K, T, r, q, sigma)
+    assert p.shape == (3, 4)
+    for result, values in zip((d1, d2, p), expected):
+        np.testing.assert_array_equal(result.ravel(), values)
+
+
+def test_small_universes_run_in_process():
+    executor = PricingExecutor(workers=4, log=lambda *args: None)
+    inputs = make_inputs(10)
+    np.testing.assert_array_equal(executor.map(cb_lattice_batch, *inputs, steps=50), cb_lattice_batch(*inputs, steps=50))
+    assert executor.pool is None
@@ -0,0 +1,63 @@
+import io
+import json
+import numpy as np
+import pandas
+import pytest
+from benchmark import make_universe, StubQuoteServer, benchmark_parameters
+from pipeline import rank_strategies
+from headless import merge_underlying_inputs, get_sinks, CsvSink, StdoutSink, run_pipeline, main
+
+
+def test_merge_underlying_inputs():
+    data_stock = pandas.DataFrame({'Quote': ['110003', '123107', '113050'], 'Interest Rate': [3.0, None, None]}, index=[5, 6, 7])
+    inputs = pandas.DataFrame({'Quote': [123107, 110003, 110003], 'Interest Rate': [2.0, 2.5, 9.0], 'Realized Volatility': [40.0, 30.0, 9.0]})
+    merged = merge_underlying_inputs(data_stock, inputs, interest_rate=1.8)
+    assert merged.index.tolist() == [0, 1, 2]
+    assert merged['Realized Volatility'].tolist()[:2] == [30.0, 40.0] and np.isnan(merged['Realized Volatility'][2])
+    assert merged['Interest Rate'].tolist() == [2.5, 2.0, 1.8]   # the first input of a CB wins, the default fills the gaps
+    assert merge_underlying_inputs(data_stock[['Quote']], None, interest_rate=1.8)['Interest Rate'].tolist() == [1.8] * 3
+
+
+def test_sinks(tmp_path):
+    assert [type(sink) for sink in get_sinks({})] == [StdoutSink]
+    csv, stdout = get_sinks({'sinks': [{'type': 'csv', 'path': str(tmp_path / 'output')}, {'type': 'stdout', 'stream': io.StringIO()}]})
+    assert isinstance(csv, CsvSink)
+    tables = {'premium_rate': pandas.DataFrame({'Quote': ['110003'], 'Current': [101.5]})}
+    csv.write(tables)
+    stdout.write(tables)
+    assert pandas.read_csv(tmp_path / 'output' / 'premium_rate.csv', index_col=0)['Current'].tolist() == [101.5]
+    assert '------------ premium_rate ------------' in stdout.stream.getvalue()
+    with pytest.raises(KeyError):
+        get_sinks({'sinks': [{'type': 'email'}]})
+
+
+@pytest.fixture
+def universe(tmp_path):
+    payloads, quotes, inputs = make_universe(30, seed=5)
+    pandas.DataFrame({'Quote': quotes}).to_csv(tmp_path / 'bonds.csv', index=False)
+    inputs.to_csv(tmp_path / 'inputs.csv', index=False)
+    with StubQuoteServer(payloads) as server:
+        yield {'bonds': str(tmp_path / 'bonds.csv'), 'underlying_inputs': str(tmp_path / 'inputs.csv'),
+               'parameters': benchmark_parameters, 'token': 'xq_a_token=test;', 'token_cache': None, 'token_url': None,
+               'quote_url': server.url, 'quote_retries': 0, 'pricing_workers': 1, 'greeks': True}
+
+
+def test_run_pipeline_on_a_stub_server(universe):
+    tables = run_pipeline(universe, log=lambda *args: None)
+    data_fund, data_stock = tables['RealTimeData_ConvertibleBond'], tables['Underlying_Values']
+    assert len(data_fund) == 30 and data_fund['Current'].notna().all()
+    inputs = pandas.read_csv(universe['underlying_inputs'], dtype={'Quote': str}).set_index('Quote')
+    np.testing.assert_allclose(data_stock['Straight Bond Value'].astype(float), data_stock['Quote'].map(inputs['Straight Bond Value']))
+    assert len(tables['Greeks']) == len(data_stock)
+    rankings = rank_strategies(data_fund, data_stock, benchmark_parameters, log=lambda *args: None)
+    for name, table in rankings.items():
+        assert tables[name]['Quote'].tolist() == table['Quote'].tolist(), name
+
+
+def test_main_writes_the_sinks(universe, tmp_path, capsys):
+    config = dict(universe, sinks=[{'type': 'csv', 'path': str(tmp_path / 'output')}])
+    (tmp_path / 'config.json').write_text(json.dumps(config), encoding='utf-8')
+    main([str(tmp_path / 'config.json'), '--quiet'])
+    written = {path.stem for path in (tmp_path / 'output').iterdir()}
+    assert {'RealTimeData_ConvertibleBond', 'Underlying_Values', 'Greeks', 'premium_rate'} <= written
+    assert 'Refresh Time' in capsys.readouterr().out
@@ -0,0 +1,50 @@
+import numpy as np
+from scipy.stats import norm
+from pricing import merton_kmv_batch, bs_option_batch
+from kmv import KMVCalibrator
+
+
+# Issuers per 100 face of their CB: conversion value as the equity, straight bond value as the debt
+quotes = np.array(['110003', '123107', '113050', '127045', '128136'], dtype=object)
+E = np.array([120.0, 95.0, 60.0, 150.0, 80.0])
+sigma_E = np.array([0.3, 0.45, 0.6, 0.25, 0.8])
+D = np.array([95.0, 90.0, 98.0, 85.0, 92.0])
+T = np.array([2.0, 4.5, 1.0, 5.5, 3.0])
+r, q = 0.025, np.array([0.0, 0.01, 0.0, 0.02, 0.005])
+
+
+def test_merton_kmv_batch_solves_both_equations():
+    V, sigma_V, DtD, iterations, converged = merton_kmv_batch(E, sigma_E, D, T, r, q, full_output=True)
+    assert converged.all()
+    # the equity is a call on the assets struck at the debt, with the volatility of the equity given by Ito
+    d1, d2, call = bs_option_batch(V, D, T, r, q, sigma_V)
+    np.testing.assert_allclose(call, E, rtol=1e-8)
+    np.testing.assert_allclose(np.exp(-q * T) * norm.cdf(d1) * sigma_V * V, sigma_E * E, rtol=1e-8)
+    np.testing.assert_allclose(DtD, (np.log(V / D) + (r - q - 0.5 * sigma_V**2) * T) / (sigma_V * np.sqrt(T)), rtol=1e-10)
+
+
+def test_merton_kmv_batch_invalid_inputs():
+    V, sigma_V, DtD = merton_kmv_batch([100.0, 0.0, np.nan], [0.3, 0.3, 0.3], 90.0, [2.0, 2.0, 2.0], r, 0.0)
+    assert np.isfinite(DtD[0]) and np.isnan(DtD[1:]).all() and np.isnan(V[1:]).all()
+
+
+def test_warm_start_takes_fewer_iterations():
+    V, sigma_V, DtD, cold, converged = merton_kmv_batch(E, sigma_E, D, T, r, q, full_output=True)
+    warm = merton_kmv_batch(E * 1.01, sigma_E, D, T, r, q, V0=V, sigma_V0=sigma_V, full_output=True)
+    assert warm[4].all() and warm[3].sum() < cold.sum()
+
+
+def test_calibrator_prune_and_save(tmp_path):
+    path = str(tmp_path / 'history' / 'kmv.json')
+    calibrator = KMVCalibrator(path)
+    V, sigma_V, DtD = calibrator.calibrate(quotes, E, sigma_E, D, T, r, q)
+    np.testing.assert_allclose(DtD, merton_kmv_batch(E, sigma_E, D, T, r, q)[2], rtol=1e-8)
+    assert set(calibrator.solutions) == set(quotes)
+    calibrator.prune(quotes[1:])   # the first CB matured
+    calibrator.save()
+    loaded = KMVCalibrator(path)
+    assert set(loaded.solutions) == set(quotes[1:])
+    np.testing.assert_allclose(loaded.solutions['123107'], calibrator.solutions['123107'])
+    # warm-started from the loaded solutions, the same distances to default
+    np.testing.assert_allclose(loaded.calibrate(quotes, E, sigma_E, D, T, r, q)[2], DtD, rtol=1e-8)
+    assert KMVCalibrator().calibrate(quotes[:1], E[:1], sigma_E[:1], D[:1], T[:1], r, q[:1])[2].shape == (1,)
@@ -0,0 +1,79 @@
+import json
+import urllib.request
+import pytest
+from metrics import Metrics, format_labels
+
+
+def test_disabled_metrics_record_nothing(tmp_path):
+    metrics = Metrics()
+    metrics.inc('requests_total')
+    metrics.observe('request_seconds', 0.1)
+    metrics.observe_many('iterations', [1, 2])
+    metrics.record_request('SH110003', 0.2)
+    with metrics.timer('fetch'):
+        pass
+    metrics.write(str(tmp_path / 'metrics'))
+    assert metrics.counters == {} and metrics.histograms == {} and metrics.stages == {} and metrics.symbols == {}
+    assert not (tmp_path / 'metrics').exists()
+
+
+def test_counters_and_histograms():
+    metrics = Metrics(enabled=True)
+    metrics.inc('requests_total', description='Requests', endpoint='quote')
+    metrics.inc('requests_total', 2, endpoint='quote')
+    metrics.inc('requests_total', endpoint='kline')
+    metrics.observe('request_seconds', 0.02, buckets=(0.01, 0.05, 0.1))
+    metrics.observe('request_seconds', 0.07)
+    metrics.observe_many('iterations', [1, 3, float('nan'), 8], buckets=(2, 5))
+    assert metrics.counters[('requests_total', (('endpoint', 'quote'),))] == 3
+    assert metrics.histograms[('request_seconds', ())] == [[0, 1, 2], pytest.approx(0.09), 2]
+    assert metrics.histograms[('iterations', ())] == [[1, 2], 12.0, 3]   # NaN values are skipped
+
+    text = metrics.render_prometheus()
+    assert '# HELP autoarbitrage_requests_total Requests\n# TYPE autoarbitrage_requests_total counter' in text
+    assert 'autoarbitrage_requests_total{endpoint="quote"} 3.0' in text
+    assert 'autoarbitrage_request_seconds_bucket{le="0.05"} 1' in text
+    assert 'autoarbitrage_request_seconds_bucket{le="+Inf"} 2' in text
+    assert 'autoarbitrage_iterations_count 3' in text
+
+
+def test_stages_symbols_summary_and_files(tmp_path):
+    metrics = Metrics(enabled=True)
+    metrics.start_run('headless')
+    with metrics.timer('fetch'):
+        pass
+    metrics.record_stage('fetch', 1.5)
+    for symbol, seconds in (('SH110003', 0.3), ('SZ123107', 0.9), ('SH113050', 0.1)):
+        metrics.record_request(symbol, seconds)
+    summary = metrics.summary(slowest=2, rows=30)
+    assert summary['run'] == 'headless' and summary['rows'] == 30
+    assert summary['stages']['fetch'] >= 1.5 and list(summary['slowest_symbols']) == ['SZ123107', 'SH110003']
+    assert summary['histograms']['stage_seconds{stage="fetch"}']['count'] == 2
+
+    metrics.write(str(tmp_path / 'metrics'))
+    assert (tmp_path / 'metrics' / 'autoarbitrage.prom').read_text().startswith('# HELP')
+    assert json.loads((tmp_path / 'metrics' / 'last_run.json').read_text())['run'] == 'headless'
+    metrics.start_run()
+    assert metrics.stages == {} and metrics.symbols == {}
+    assert metrics.histograms[('stage_seconds', (('stage', 'fetch'),))][2] == 2   # the histograms keep growing
+
+
+def test_serve_metrics_and_summary():
+    metrics = Metrics(enabled=True)
+    metrics.inc('runs_total')
+    server = metrics.serve(port=0)
+    try:
+        url = 'http://127.0.0.1:' + str(server.server_address[1])
+        with urllib.request.urlopen(url + '/metrics', timeout=5) as response:
+            assert 'autoarbitrage_runs_total 1.0' in response.read().decode()
+        with urllib.request.urlopen(url + '/summary', timeout=5) as response:
+            assert json.loads(response.read())['counters'] == {'runs_total': 1}
+        assert metrics.serve() is server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_format_labels():
+    assert format_labels(()) == ''
+    assert format_labels((('stage', 'fetch'), ('path', 'a"b\\c'))) == '{stage="fetch",path="a\\"b\\\\c"}'
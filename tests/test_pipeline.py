@@ -0,0 +1,89 @@
+import copy
+import time
+import datetime
+import numpy as np
+import pandas
+from benchmark import make_universe, benchmark_parameters
+from pipeline import (convertible_bond_columns, underlying_input_columns, get_bond_symbol, build_convertible_bond_table,
+                      select_underlyings, build_underlying_table, rank_strategies, get_date_text, get_display_table)
+
+
+# Build the CB and stock tables of a small synthetic universe, without Excel
+def build_tables(size=30, edit=None, model=None):
+    payloads, quotes, inputs = make_universe(size, seed=1)
+    payloads = copy.deepcopy(payloads)
+    if edit is not None:
+        edit(payloads, quotes)
+    lines = []
+    data_fund = pandas.DataFrame({'Quote': quotes}).reindex(columns=convertible_bond_columns)
+    data_fund = build_convertible_bond_table(data_fund, [payloads[get_bond_symbol(quote)] for quote in quotes], log=lines.append)
+    data_stock = select_underlyings(data_fund, rows=None).reset_index(drop=True)
+    inputs = inputs.set_index('Quote')
+    for column in underlying_input_columns:
+        data_stock[column] = data_stock['Quote'].map(inputs[column]).to_numpy()
+    stock_details = [payloads.get(symbol, {'data': {'quote': {}}}) for symbol in data_stock['Stock Quote']]
+    data_stock = build_underlying_table(data_stock, stock_details, log=lines.append, model=model)
+    return data_fund, data_stock, lines
+
+
+def test_tables_are_built_and_ranked():
+    data_fund, data_stock, lines = build_tables()
+    assert len(data_fund) == len(data_stock) == 30
+    assert list(data_fund.index) == list(range(1, 31))
+    assert data_fund['Premium Rate'].is_monotonic_increasing
+    assert np.isfinite(data_stock['Option Value'].astype(float)).any()
+    rankings = rank_strategies(data_fund, data_stock, benchmark_parameters, log=lambda *args: None)
+    assert set(rankings) >= {'premium_rate', 'DoubleLow', 'multifactor1'}
+
+
+def test_missing_quote_fields_do_not_abort_the_build():
+    def edit(payloads, quotes):
+        bond = payloads[get_bond_symbol(quotes[0])]['data']['quote']
+        stock = payloads[bond['underlying_symbol']]['data']['quote']
+        del bond['name'], bond['underlying_symbol'], stock['name']
+        del payloads[get_bond_symbol(quotes[1])]['data']['quote']['current']
+
+    data_fund, data_stock, lines = build_tables(edit=edit)
+    assert len(data_fund) == 30 and len(lines) == 60
+    bond = data_fund[data_fund['Quote'] == make_universe(30, seed=1)[1][0]].iloc[0]
+    assert bond['Name'] is None and bond['Stock Quote'] is None
+    assert data_stock['Stock Name'].isna().sum() >= 1
+
+
+def test_partially_missing_quotes_are_suspended():
+    quotes = make_universe(30, seed=1)[1]
+
+    def edit(payloads, quotes):
+        payloads[get_bond_symbol(quotes[0])]['data']['quote'].update(premium_rate=None, benefit_before_tax=None)   # with a daily change
+        payloads[get_bond_symbol(quotes[1])]['data']['quote'].update(high=None)
+        payloads[get_bond_symbol(quotes[2])]['data']['quote'].update(percent=None)
+
+    data_fund = build_tables(edit=edit)[0].set_index('Quote')
+    assert data_fund['Suspended'][quotes[:3]].all() and data_fund['Suspended'].sum() == 3
+    display = get_display_table(data_fund)
+    assert display.loc[quotes[0], ['Premium Rate', 'Benefit Before Tax']].tolist() == ['停牌', '停牌']
+    assert display.loc[quotes[0], 'Change'] == data_fund.loc[quotes[0], 'Change']   # the known values are kept
+    assert display.loc[quotes[1], 'Amplitude'] == '停牌' and display.loc[quotes[2], 'Change'] == '停牌'
+    assert not (display.drop(index=quotes[:3]) == '停牌').any().any()
+
+
+def test_black_scholes_is_the_default_model_and_the_lattice_opt_in():
+    data_stock = build_tables()[1]
+    theoretical_value = data_stock['Theoretical Value'].astype(float)
+    np.testing.assert_allclose(theoretical_value, data_stock['Straight Bond Value'].astype(float) + data_stock['Option Value'].astype(float))
+    np.testing.assert_allclose(theoretical_value, build_tables(model='bs')[1]['Theoretical Value'].astype(float))
+    lattice = build_tables(model='lattice')[1]['Theoretical Value'].astype(float)
+    assert np.isfinite(lattice).any() and not np.allclose(lattice, theoretical_value, equal_nan=True)
+
+
+def test_dates_of_the_data_source_are_in_beijing_time(monkeypatch):
+    midnight = datetime.datetime(2020, 5, 21, tzinfo=datetime.timezone(datetime.timedelta(hours=8))).timestamp() * 1000
+    monkeypatch.setenv('TZ', 'America/New_York')   # the local day is still 2020-05-20 there
+    time.tzset()
+    try:
+        assert get_date_text(midnight) == get_date_text(midnight + 86399999) == '2020-05-21'
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+    assert get_date_text(None) is None and get_date_text(np.nan) is None
+    assert get_date_text(datetime.date(2020, 5, 21)) == get_date_text('2020-05-21') == '2020-05-21'
@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+from pricing import (bs_option, implied_volatility, bs_option_batch, bs_vega_batch, implied_volatility_batch, cb_lattice_batch,
+                     cb_implied_volatility_batch)
+
+
+# A small universe of CBs: spot, conversion price, remain years, rate, dividend yield
+S = np.array([5.0, 12.3, 20.0, 8.8, 31.5, 3.2])
+K = np.array([6.0, 10.0, 20.0, 9.5, 25.0, 4.1])
+T = np.array([0.5, 2.0, 4.5, 1.2, 5.8, 3.0])
+r = 0.025
+q = np.array([0.0, 0.01, 0.02, 0.005, 0.03, 0.0])
+sigma = np.array([0.15, 0.25, 0.35, 0.5, 0.6, 0.8])
+bond_value = np.array([98.0, 95.0, 90.0, 97.0, 85.0, 92.0])   # straight bond values of the CBs, per 100 face
+
+
+@pytest.mark.parametrize('option', ['call', 'put'])
+def test_bs_option_batch_matches_scalar(option):
+    d1, d2, p = bs_option_batch(S, K, T, r, q, sigma, option)
+    for i in range(S.size):
+        expected = bs_option(S[i], K[i], T[i], r, q[i], sigma[i], option)
+        np.testing.assert_allclose([d1[i], d2[i], p[i]], expected, rtol=1e-12, atol=1e-12)
+
+
+def test_bs_option_batch_unknown_option():
+    assert bs_option_batch(S, K, T, r, q, sigma, 'swap') is None
+
+
+def test_bs_vega_batch_matches_finite_difference():
+    step = 1e-6
+    up = bs_option_batch(S, K, T, r, q, sigma + step)[2]
+    down = bs_option_batch(S, K, T, r, q, sigma - step)[2]
+    np.testing.assert_allclose(bs_vega_batch(S, K, T, r, q, sigma), (up - down) / (2 * step), rtol=1e-6)
+
+
+@pytest.mark.parametrize('option', ['call', 'put'])
+def test_implied_volatility_batch_matches_scalar(option):
+    P = bs_option_batch(S, K, T, r, q, sigma, option)[2]
+    batch, iterations, converged = implied_volatility_batch(P, S, K, T, r, q, option, full_output=True)
+    assert converged.all()
+    for i in range(S.size):
+        scalar = implied_volatility(P[i], S[i], K[i], T[i], r, q[i], option)
+        # both solve to a price tolerance of 1e-6, the volatilities agree to that tolerance over the vega
+        assert batch[i] == pytest.approx(scalar, abs=1e-6 / bs_vega_batch(S[i], K[i], T[i], r, q[i], sigma[i]) * 2)
+        assert batch[i] == pytest.approx(sigma[i], abs=1e-4)
+    assert iterations.max() < 100
+
+
+def test_implied_volatility_batch_sentinels_and_missing_inputs():
+    P = np.array([bs_option(10.0, 10.0, 1.0, r, 0.0, 0.3)[2], 20.0, np.nan])   # reachable, above p(sigma_max), missing
+    result = implied_volatility_batch(P, 10.0, 10.0, 1.0, r, 0.0)
+    assert result[0] == pytest.approx(0.3, abs=1e-5)
+    assert result[1] == 0.0   # sentinel of implied_volatility for a call
+    assert np.isnan(result[2])
+    assert implied_volatility_batch(P[:2], 10.0, 10.0, 1.0, r, 0.0, option='put')[1] == 1.0
+
+
+def test_implied_volatility_batch_keeps_shape():
+    P = bs_option_batch(S, K, T, r, q, sigma)[2].reshape(2, 3)
+    assert implied_volatility_batch(P, S.reshape(2, 3), K.reshape(2, 3), T.reshape(2, 3), r, q.reshape(2, 3)).shape == (2, 3)
+
+
+def test_cb_lattice_band_matches_full_lattice():
+    put_trigger, call_trigger = 0.7 * K, 1.3 * K
+    banded = cb_lattice_batch(S, K, T, r, q, sigma, bond_value, put_trigger, call_trigger)
+    full = cb_lattice_batch(S, K, T, r, q, sigma, bond_value, put_trigger, call_trigger, band=None)
+    np.testing.assert_allclose(banded, full, atol=1e-6)
+    np.testing.assert_allclose(cb_lattice_batch(S, K, T, r, q, sigma, bond_value, band=4.0),
+                               cb_lattice_batch(S, K, T, r, q, sigma, bond_value, band=None), atol=1e-3)
+
+
+def test_cb_lattice_binomial_and_trinomial_agree():
+    binomial = cb_lattice_batch(S, K, T, r, q, sigma, bond_value, steps=400)
+    trinomial = cb_lattice_batch(S, K, T, r, q, sigma, bond_value, steps=400, method='trinomial')
+    np.testing.assert_allclose(binomial, trinomial, atol=0.25)
+
+
+def test_cb_lattice_without_call_is_above_conversion_and_bond_floor():
+    value = cb_lattice_batch(S, K, T, r, q, sigma, bond_value)
+    assert (value >= np.maximum(100 / K * S, bond_value) - 1e-9).all()
+    # the soft call caps the CB near the call price or the conversion value
+    called = cb_lattice_batch(S, K, T, r, q, sigma, bond_value, call_trigger=1.3 * K)
+    assert (called <= value + 1e-9).all()
+
+
+def test_cb_lattice_missing_inputs_and_shape():
+    value = cb_lattice_batch(np.array([[10.0, np.nan], [10.0, 10.0]]), 10.0, np.array([[1.0, 1.0], [0.0, 2.0]]), r, 0.0, 0.3)
+    assert value.shape == (2, 2)
+    assert np.isfinite(value[0, 0]) and np.isfinite(value[1, 1])
+    assert np.isnan(value[0, 1]) and np.isnan(value[1, 0])
+
+
+def test_cb_implied_volatility_batch_recovers_sigma():
+    P = cb_lattice_batch(S, K, T, r, q, sigma, bond_value)
+    implied, iterations, converged = cb_implied_volatility_batch(P, S, K, T, r, q, bond_value, full_output=True)
+    assert converged.all()
+    np.testing.assert_allclose(implied, sigma, atol=1e-4)
+    guessed = cb_implied_volatility_batch(P, S, K, T, r, q, bond_value, guess=sigma * 1.05, full_output=True)[1]
+    assert guessed.sum() <= iterations.sum()
@@ -0,0 +1,218 @@
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import pytest
+from quotes import QuoteFetcher, RateLimiter, SnowballTransport, QuoteCache, quote_cache_ttl, get_field_class
+
+
+# Transport answering {'symbol': ...} after a delay, counting the requests in flight
+class SlowTransport:
+    def __init__(self, delay=0.02, fail=()):
+        self.delay = delay
+        self.fail = set(fail)
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.max_inflight = 0
+        self.calls = []
+
+    def __call__(self, symbol, timeout=None):
+        with self.lock:
+            self.calls.append(symbol)
+            self.inflight += 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.inflight -= 1
+        if symbol in self.fail:
+            raise ValueError(symbol)
+        return {'symbol': symbol}
+
+
+# Local stand-in of quote_detail recording the Host headers, the first answers of a symbol can be given
+class StubServer:
+    def __init__(self, answers=None):
+        self.hosts = []
+        self.answers = answers or {}   # symbol -> list of (status, payload), served first
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.hosts.append(self.headers.get('Host'))
+                symbol = parse_qs(urlparse(self.path).query).get('symbol', [''])[0]
+                queued = server.answers.get(symbol)
+                status, payload = queued.pop(0) if queued else (200, {'data': {'quote': {'symbol': symbol}}})
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/v5/stock/quote.json?extend=detail&symbol=' % self.httpd.server_port
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# Token manager stand-in, renewed tokens are numbered
+class Credentials:
+    def __init__(self):
+        self.value = 'first'
+        self.renewals = 0
+
+    def cookie(self):
+        return 'xq_a_token=' + self.value + ';'
+
+    def renew(self, stale=None):
+        self.renewals += 1
+        self.value = 'renewed' + str(self.renewals)
+        return self.cookie()
+
+
+def test_fetch_keeps_input_order_and_concurrency_limit():
+    transport = SlowTransport()
+    symbols = ['SH%06d' % i for i in range(24)]
+    results = QuoteFetcher(transport, max_workers=4).fetch(symbols)
+    assert [result['symbol'] for result in results] == symbols
+    assert 1 < transport.max_inflight <= 4
+
+
+def test_fetch_failures():
+    fetcher = QuoteFetcher(SlowTransport(delay=0, fail=['SZ2']), max_workers=2)
+    results = fetcher.fetch(['SZ1', 'SZ2', 'SZ3'], return_exceptions=True)
+    assert results[0] == {'symbol': 'SZ1'} and isinstance(results[1], ValueError) and results[2] == {'symbol': 'SZ3'}
+    with pytest.raises(ValueError):
+        fetcher.fetch(['SZ1', 'SZ2'])
+    assert fetcher.fetch([]) == []
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(50, burst=1)
+    started = time.monotonic()
+    for _ in range(6):
+        limiter.acquire()
+    assert time.monotonic() - started >= 5 / 50 * 0.9
+
+
+def test_transport_host_follows_base_url():
+    with StubServer() as server:
+        transport = SnowballTransport('xq_a_token=test;', base_url=server.url, retries=0)
+        assert transport('SH113050') == {'data': {'quote': {'symbol': 'SH113050'}}}
+        transport.close()
+        port = server.httpd.server_port
+        assert server.hosts == ['127.0.0.1:%d' % port]
+        transport = SnowballTransport('xq_a_token=test;', base_url=server.url, host='stock.xueqiu.com', retries=0)
+        transport('SH113050')
+        transport.close()
+        assert server.hosts[-1] == 'stock.xueqiu.com'
+
+
+def test_transport_replays_transient_errors_and_renews_token():
+    answers = {'SH1': [(503, {}), (200, {'error_code': 400016})]}
+    credentials = Credentials()
+    with StubServer(answers) as server:
+        transport = SnowballTransport(credentials, base_url=server.url, retries=3, backoff=0)
+        assert transport('SH1') == {'data': {'quote': {'symbol': 'SH1'}}}
+        assert credentials.renewals == 1
+        server.answers['SH2'] = [(503, {})] * 2
+        transport.retries = 1
+        with pytest.raises(Exception):
+            transport('SH2')
+        transport.close()
+
+
+# Fetcher stand-in counting the symbols sent to the network, blocking until released when a gate is given
+class CountingFetcher:
+    def __init__(self, gate=None, fail=()):
+        self.gate = gate
+        self.fail = set(fail)
+        self.fetched = []
+
+    def fetch(self, symbols, return_exceptions=False):
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.fetched += symbols
+        return [ValueError(symbol) if symbol in self.fail else {'symbol': symbol, 'version': self.fetched.count(symbol)}
+                for symbol in symbols]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_hits_and_ttl_per_field_class():
+    clock = Clock()
+    fetcher = CountingFetcher()
+    cache = QuoteCache(fetcher, clock=clock)
+    assert cache.get_many(['SH1', 'SZ2', 'SH1']) == [{'symbol': 'SH1', 'version': 1}, {'symbol': 'SZ2', 'version': 1},
+                                                     {'symbol': 'SH1', 'version': 1}]
+    assert fetcher.fetched == ['SH1', 'SZ2']   # duplicates fetched once
+    clock.now = quote_cache_ttl['realtime'] + 1
+    assert cache.get('SH1', 'static')['version'] == 1   # still fresh for the static fields
+    assert cache.get('SH1', ['issue_date', 'maturity_date'])['version'] == 1
+    assert cache.get('SH1', ['issue_date', 'current'])['version'] == 2   # a realtime field makes it stale
+    assert cache.get('SZ2')['version'] == 2
+    assert cache.stats() == {'entries': 2, 'hits': 2, 'misses': 4, 'coalesced': 0, 'evictions': 0}
+
+
+def test_get_field_class():
+    assert get_field_class(['name', 'issue_date']) == 'static'
+    assert get_field_class(['name', 'dividend_yield']) == 'daily'
+    assert get_field_class(['dividend_yield', 'percent']) == 'realtime'
+
+
+def test_cache_lru_eviction_and_invalidate():
+    fetcher = CountingFetcher()
+    cache = QuoteCache(fetcher, max_entries=2)
+    cache.get_many(['A', 'B'])
+    cache.get('A')   # B is now the least recently used
+    cache.get('C')
+    assert list(cache.entries) == ['A', 'C'] and cache.evictions == 1
+    cache.invalidate(['A'])
+    cache.get('A')
+    assert fetcher.fetched == ['A', 'B', 'C', 'A']
+
+
+def test_cache_coalesces_inflight_symbols():
+    gate = threading.Event()
+    fetcher = CountingFetcher(gate)
+    cache = QuoteCache(fetcher)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get('SH1'))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    gate.set()
+    for thread in threads:
+        thread.join(5)
+    assert fetcher.fetched == ['SH1']
+    assert results == [{'symbol': 'SH1', 'version': 1}] * 4
+    assert cache.stats()['coalesced'] == 3
+
+
+def test_cache_failures_are_not_cached():
+    fetcher = CountingFetcher(fail=['BAD'])
+    cache = QuoteCache(fetcher)
+    with pytest.raises(ValueError):
+        cache.get_many(['OK', 'BAD'])
+    assert 'BAD' not in cache.entries and not cache.inflight
+    assert cache.get('OK')['version'] == 1
@@ -0,0 +1,62 @@
+import numpy as np
+from pricing import bs_option_batch
+from scenarios import ScenarioEngine, load_scenarios
+
+
+# A small universe of CBs: spot, conversion price, remain years, rate, dividend yield, volatility, straight bond value
+S = np.array([5.0, 12.3, 20.0, 8.8, 31.5])
+K = np.array([6.0, 10.0, 20.0, 9.5, 25.0])
+T = np.array([0.5, 2.0, 4.5, 1.2, 5.8])
+r = np.array([0.02, 0.025, 0.03, 0.02, 0.025])
+q = np.array([0.0, 0.01, 0.02, 0.005, 0.03])
+sigma = np.array([0.15, 0.25, 0.35, 0.5, 0.6])
+bond_value = np.array([98.0, 95.0, np.nan, 97.0, 85.0])
+
+
+# Value every CB one by one, the straight bond value discounted over T at the rate shock
+def get_values(spot=S, vol=sigma, rate_shock=0.0):
+    bond = np.where(np.isnan(bond_value), 0.0, bond_value) * np.exp(-rate_shock * T)
+    return bond + 100 / K * bs_option_batch(spot, K, T, r + rate_shock, q, vol)[2]
+
+
+def test_value_is_bond_value_plus_black_scholes_calls():
+    np.testing.assert_allclose(ScenarioEngine(S, K, T, r, q, sigma, bond_value).value(), get_values(), rtol=1e-12)
+
+
+def test_greeks_match_finite_differences():
+    greeks = ScenarioEngine(S, K, T, r, q, sigma, bond_value).greeks()
+    step = 1e-4 * S
+    up, down = get_values(spot=S + step), get_values(spot=S - step)
+    np.testing.assert_allclose(greeks['Delta'], (up - down) / (2 * step), rtol=1e-6)
+    np.testing.assert_allclose(greeks['Gamma'], (up - 2 * get_values() + down) / step**2, rtol=1e-3)
+    np.testing.assert_allclose(greeks['Vega'], (get_values(vol=sigma + 1e-6) - get_values(vol=sigma - 1e-6)) / 2e-6 / 100, rtol=1e-6)
+    np.testing.assert_allclose(greeks['Rho'], (get_values(rate_shock=1e-6) - get_values(rate_shock=-1e-6)) / 2e-6 / 100, rtol=1e-6)
+    # Theta ages the option only, the straight bond value is kept
+    option = lambda T: 100 / K * bs_option_batch(S, K, T, r, q, sigma)[2]
+    np.testing.assert_allclose(greeks['Theta'], -(option(T + 1e-6) - option(T - 1e-6)) / 2e-6 / 365, rtol=1e-6)
+    np.testing.assert_allclose(greeks['Hedge Ratio'], greeks['Delta'] * K / 100)
+
+
+def test_grid_matches_the_shocked_values():
+    engine = ScenarioEngine(S, K, T, r, q, sigma, bond_value)
+    spot_shocks, vol_shocks, rate_shocks = [-0.1, 0.0, 0.2], [-0.2, 0.0, 0.05], [0.0, 0.005]
+    cube = engine.grid(spot_shocks, vol_shocks, rate_shocks)
+    assert cube.shape == (5, 3, 3, 2)
+    for i, spot in enumerate(spot_shocks):
+        for j, vol in enumerate(vol_shocks):
+            for k, rate in enumerate(rate_shocks):
+                expected = get_values(S * (1 + spot), np.maximum(sigma + vol, 0.01), rate)
+                np.testing.assert_allclose(cube[:, i, j, k], expected, rtol=1e-10)
+    np.testing.assert_allclose(cube[:, 1, 1, 0], engine.value(), rtol=1e-12)
+    assert engine.grid(spot_shocks, vol_shocks, rate_shocks) is cube   # the last grid is kept
+
+
+def test_save_and_load(tmp_path):
+    engine = ScenarioEngine(S, K, T, r, q, sigma, bond_value)
+    path = str(tmp_path / 'scenarios.npz')
+    engine.save(path, quotes=['110003', '123107', '113050', '127045', '128136'], spot_shocks=[-0.1, 0.1], vol_shocks=[0.0])
+    grid = load_scenarios(path)
+    assert grid['values'].shape == (5, 2, 1, 1) and grid['values'].dtype == np.float32
+    assert grid['quotes'][2] == '113050'
+    np.testing.assert_allclose(grid['base'], engine.value(), rtol=1e-6)
+    np.testing.assert_allclose(grid['values'], engine.grid([-0.1, 0.1], [0.0]), rtol=1e-6)
@@ -0,0 +1,107 @@
+import json
+import time
+import datetime
+import pytest
+import scheduler
+from scheduler import TradingCalendar, RefreshScheduler, get_exchange_time
+from streaming import in_trading_session
+
+
+# 2024-10-01 to 2024-10-07: National Day, the weekdays are exchange holidays
+national_day = ['2024-10-01', '2024-10-02', '2024-10-03', '2024-10-04', '2024-10-07']
+
+
+@pytest.fixture
+def calendar(tmp_path):
+    path = tmp_path / 'trading_calendar.json'
+    path.write_text(json.dumps({'2024': national_day}), encoding='utf-8')
+    return TradingCalendar(str(path), log=lambda *args: None)
+
+
+# Clock of the tests, moved by hand, with the monotonic time of the scheduler moving along
+class Clock:
+    def __init__(self, now):
+        self.now = now
+        self.start = now
+
+    def __call__(self):
+        return self.now
+
+    def monotonic(self):
+        return (self.now - self.start).total_seconds()
+
+
+def test_exchange_time_ignores_the_local_time_zone(monkeypatch):
+    opening = datetime.datetime(2024, 5, 20, 9, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=8))).timestamp()
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    try:
+        assert get_exchange_time(opening) == datetime.datetime(2024, 5, 20, 9, 30)
+        assert abs((get_exchange_time() - get_exchange_time(time.time())).total_seconds()) < 1
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_trading_days_from_the_cache(calendar):
+    assert calendar.is_trading_day(datetime.date(2024, 9, 30))
+    assert not calendar.is_trading_day(datetime.date(2024, 10, 2))   # holiday
+    assert not calendar.is_trading_day(datetime.date(2024, 10, 5))   # weekend
+    assert calendar.next_trading_day(datetime.date(2024, 9, 30)) == datetime.date(2024, 10, 8)
+
+
+def test_phases_and_next_change(calendar):
+    day = datetime.date(2024, 9, 30)
+    phases = {'06:59': 'closed', '07:00': 'pre-open', '09:30': 'session', '11:45': 'lunch', '13:00': 'session',
+              '15:10': 'after-close', '16:00': 'closed'}
+    for clock, phase in phases.items():
+        assert calendar.get_phase(datetime.datetime.combine(day, datetime.time.fromisoformat(clock))) == phase
+    assert calendar.get_phase(datetime.datetime(2024, 10, 2, 10, 0)) == 'closed'
+    assert calendar.get_next_change(datetime.datetime(2024, 9, 30, 10, 0)) == datetime.datetime(2024, 9, 30, 11, 30)
+    assert calendar.get_next_change(datetime.datetime(2024, 9, 30, 16, 0)) == datetime.datetime(2024, 10, 8, 7, 0)
+    assert calendar.in_session(datetime.datetime(2024, 9, 30, 14, 0))
+    assert in_trading_session(datetime.datetime(2024, 9, 30, 14, 59), calendar)
+    assert not in_trading_session(datetime.datetime(2024, 9, 30, 15, 0), calendar)
+
+
+def test_unknown_years_and_precompute(tmp_path, monkeypatch):
+    def get_holidays(year):
+        if year > 2030:
+            raise NotImplementedError('no data for ' + str(year))
+        return [datetime.date(year, 10, 1)]
+
+    monkeypatch.setattr(scheduler, 'get_exchange_holidays', get_holidays)
+    lines = []
+    calendar = TradingCalendar(str(tmp_path / 'calendar.json'), log=lines.append)
+    calendar.precompute([2030])
+    assert not calendar.is_trading_day(datetime.date(2030, 10, 1))
+    assert calendar.is_trading_day(datetime.date(2031, 10, 1)) and 'unknown' in lines[0]
+    assert TradingCalendar(str(tmp_path / 'calendar.json')).holidays == {2030: {datetime.date(2030, 10, 1)}}   # 2031 not saved
+
+
+def test_run_pending_coalesces_the_late_runs(calendar, monkeypatch):
+    clock = Clock(datetime.datetime(2024, 9, 30, 9, 29, 50))
+    monkeypatch.setattr(scheduler.time, 'monotonic', clock.monotonic)
+    runs, days = [], []
+    refresh = RefreshScheduler({'session': runs.append}, calendar, intervals={'session': 5}, daily=lambda: days.append(clock().date()),
+                               clock=clock, log=lambda *args: None)
+    assert refresh.run_pending() == 10   # pre-open without a job: sleep until the session
+    assert days == [datetime.date(2024, 9, 30)]
+    clock.now += datetime.timedelta(seconds=10)
+    assert refresh.run_pending() == 5 and runs == ['session']
+    clock.now += datetime.timedelta(seconds=2)
+    assert refresh.run_pending() == 3 and len(runs) == 1
+    clock.now += datetime.timedelta(seconds=20)   # a slow refresh: 3 runs missed, one run
+    refresh.run_pending()
+    assert len(runs) == 2 and refresh.missed == 3
+    clock.now = datetime.datetime(2024, 9, 30, 12, 0)
+    assert refresh.run_pending() == 300 and len(runs) == 2   # lunch
+    clock.now = datetime.datetime(2024, 10, 8, 8, 0)
+    refresh.run_pending()
+    assert days == [datetime.date(2024, 9, 30), datetime.date(2024, 10, 8)]   # once per trading day
+    refresh.run_pending()
+    assert len(days) == 2
+
+
+def test_default_clock_is_the_exchange_time(calendar):
+    assert RefreshScheduler({}, calendar).clock is get_exchange_time
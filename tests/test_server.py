@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import stat
+import time
+import threading
+import urllib.error
+import urllib.request
+import pytest
+import client
+from server import ComputeServer, secret_header
+
+
+# Module of the functions run by the test server, standing in for AutoArbitrage
+fake_module = '''
+import pandas
+calls = []
+latest_tables = {'DoubleLow': pandas.DataFrame({'Quote': ['110003', '123107', '113050'], 'Current': [101.5, 99.0, 120.25]})}
+
+
+def refresh_all(names=None):
+    calls.append(names)
+
+
+def fail():
+    raise ValueError('no workbook')
+'''
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    (tmp_path / 'fake_compute.py').write_text(fake_module, encoding='utf-8')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, 'fake_compute', raising=False)   # a new module for every test, imported by the server
+    compute = ComputeServer('fake_compute', ('refresh_all', 'fail'), log=lambda *args: None, secret_path=str(tmp_path / 'secret'))
+    thread = threading.Thread(target=compute.serve, kwargs={'host': '127.0.0.1', 'port': 0}, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while (compute.http is None or compute.module is None) and time.monotonic() < deadline:   # listening and warm
+        time.sleep(0.01)
+    compute.url = 'http://127.0.0.1:' + str(compute.http.server_address[1])
+    yield compute
+    compute.shutdown()
+    thread.join(5)
+
+
+# Send a request to the test server like the client, return the status and the JSON answer
+def send(server, path, body=None, headers=None):
+    data = None if body is None else body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+    headers = {'Content-Type': 'application/json', secret_header: server.secret} if headers is None else headers
+    try:
+        with urllib.request.urlopen(urllib.request.Request(server.url + path, data=data, headers=headers), timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def test_health_stats_and_tables(server):
+    status, health = send(server, '/health')
+    assert status == 200 and health['status'] == 'ok' and health['warm'] and health['running'] is None
+    assert send(server, '/tables') == (200, ['DoubleLow'])
+    status, table = send(server, '/tables/DoubleLow?top=2')
+    assert status == 200 and table['columns'] == ['Quote', 'Current'] and table['data'] == [['110003', 101.5], ['123107', 99.0]]
+    assert len(send(server, '/tables/DoubleLow')[1]['data']) == 3
+    assert send(server, '/tables/DoubleLow?top=abc') == (400, {'error': 'top is not an integer'})
+    assert send(server, '/tables/multifactor1')[0] == 404
+    assert send(server, '/nothing')[0] == 404
+
+
+def test_run_functions(server):
+    import fake_compute
+    status, result = send(server, '/run/refresh_all', {'names': ['DoubleLow']})
+    assert status == 200 and result['ok'] and result['function'] == 'refresh_all'
+    assert fake_compute.calls == [['DoubleLow']]
+    status, result = send(server, '/run/fail', {})
+    assert status == 500 and not result['ok'] and 'no workbook' in result['error'] and 'Traceback' in result['traceback']
+    assert send(server, '/run/main_function', {})[0] == 404   # not one of the functions of the server
+    status, stats = send(server, '/stats')
+    assert stats['runs']['refresh_all']['count'] == 1 and stats['runs']['fail']['errors'] == 1
+    assert stats['tables'] == {'DoubleLow': 3}
+
+
+def test_bad_bodies_are_rejected_before_the_job(server):
+    import fake_compute
+    assert send(server, '/run/refresh_all', b'{names')[0] == 400
+    status, answer = send(server, '/run/refresh_all', ['DoubleLow'])
+    assert status == 400 and 'JSON object' in answer['error']
+    assert fake_compute.calls == [] and 'refresh_all' not in server.runs
+
+
+def test_posts_without_the_secret_are_forbidden(server):
+    import fake_compute
+    json_header = {'Content-Type': 'application/json'}
+    for headers in ({}, json_header, {**json_header, secret_header: 'guess'},
+                    {'Content-Type': 'text/plain', secret_header: server.secret},   # a simple request of a web page
+                    {**json_header, secret_header: server.secret, 'Origin': 'https://example.com'}):
+        assert send(server, '/run/refresh_all', {}, headers) == (403, {'error': 'forbidden'})
+        assert send(server, '/shutdown', {}, headers)[0] == 403
+    assert fake_compute.calls == [] and send(server, '/health')[0] == 200
+    assert stat.S_IMODE(os.stat(server.secret_path).st_mode) == 0o600
+    with open(server.secret_path, encoding='utf-8') as secret_file:
+        assert secret_file.read() == server.secret
+
+
+def test_shutdown(server):
+    assert send(server, '/shutdown', {}) == (200, {'status': 'stopping'})
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(server.url + '/health', timeout=0.2)
+        except OSError:
+            return
+        time.sleep(0.05)
+    pytest.fail('the server is still answering')
+
+
+def test_client_posts_to_the_server(server, monkeypatch):
+    import fake_compute
+    monkeypatch.setattr(client, 'server_url', server.url)
+    monkeypatch.setattr(client, 'server_secret_path', server.secret_path)
+    assert client.is_running()
+    assert client.refresh_all(names=['multifactor1'])['ok']
+    assert fake_compute.calls == [['multifactor1']]
+    assert client.get_table('DoubleLow', 1)['data'] == [['110003', 101.5]]
+
+
+def test_client_falls_back_in_process_once_the_start_failed(monkeypatch):
+    starts, calls = [], []
+    monkeypatch.setattr(client, 'server_failed', False)
+    monkeypatch.setattr(client, 'is_running', lambda: False)
+    monkeypatch.setattr(client, 'start_server', lambda: starts.append(1) and False)
+    monkeypatch.setitem(sys.modules, 'AutoArbitrage', type('AutoArbitrage', (), {'refresh_all': staticmethod(lambda **kwargs: calls.append(kwargs))}))
+    assert client.run('refresh_all', names=['DoubleLow']) == {'ok': True, 'function': 'refresh_all'}
+    assert client.run('refresh_all') == {'ok': True, 'function': 'refresh_all'}
+    assert starts == [1] and calls == [{'names': ['DoubleLow']}, {}]
+    assert client.server_failed
@@ -0,0 +1,67 @@
+import os
+import time
+import datetime
+import numpy as np
+import pandas
+import pytest
+from scheduler import exchange_timezone
+from snapshots import SnapshotStore, get_snapshot_table, get_quote_text
+
+pytest.importorskip('pyarrow')
+
+
+def make_table(current):
+    return pandas.DataFrame({'Quote': [110003.0, '123107'], 'Name': ['A转债', 'B转债'], 'Current': [current, '停牌'],
+                             'Premium Rate': [12.5, np.nan]})
+
+
+# Seconds since the epoch of a time of March 2024, Beijing time
+def day_time(day, hour):
+    return datetime.datetime(2024, 3, day, hour, tzinfo=exchange_timezone).timestamp()
+
+
+def test_snapshot_table_types():
+    snapshot = get_snapshot_table(make_table(120.5), day_time(4, 10))
+    assert snapshot['Quote'].tolist() == ['110003', '123107']
+    assert snapshot['Current'].dtype == float and np.isnan(snapshot['Current'][1])
+    assert snapshot['Suspended'].tolist() == [False, True]
+    assert snapshot['Time'][0] == pandas.Timestamp(2024, 3, 4, 10)
+    assert get_quote_text(np.nan) is None and get_quote_text(110003.0) == '110003'
+
+
+def test_append_read_and_compact(tmp_path):
+    store = SnapshotStore(str(tmp_path))
+    for day, hour, current in ((4, 10, 120.0), (4, 14, 121.0), (5, 10, 122.0), (6, 10, 123.0)):
+        store.append('RealTimeData_ConvertibleBond', make_table(current), day_time(day, hour))
+    assert store.tables() == ['RealTimeData_ConvertibleBond']
+    assert store.partitions('RealTimeData_ConvertibleBond') == [datetime.date(2024, 3, day) for day in (4, 5, 6)]
+    assert not [name for root, dirs, names in os.walk(str(tmp_path)) for name in names if name.endswith('.tmp')]
+
+    data = store.read('RealTimeData_ConvertibleBond')
+    assert len(data) == 8 and data['Time'].is_monotonic_increasing
+    data = store.read('RealTimeData_ConvertibleBond', start='2024-03-04 12:00', end='2024-03-05', symbols=[110003],
+                      columns=['Current'])
+    assert list(data.columns) == ['Time', 'Quote', 'Current'] and data['Current'].tolist() == [121.0, 122.0]
+    assert store.read('RealTimeData_ConvertibleBond', start='2025-01-01').empty
+
+    before = store.read('RealTimeData_ConvertibleBond')
+    assert store.compact('RealTimeData_ConvertibleBond', before=datetime.date(2024, 3, 6)) == 2   # the two files of the 4th
+    assert len(store.get_files('RealTimeData_ConvertibleBond', datetime.date(2024, 3, 4))) == 1
+    pandas.testing.assert_frame_equal(store.read('RealTimeData_ConvertibleBond'), before)
+
+
+def test_partitions_and_times_ignore_the_local_time_zone(tmp_path, monkeypatch):
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    try:
+        store = SnapshotStore(str(tmp_path))
+        store.append('RealTimeData_ConvertibleBond', make_table(120.0), day_time(5, 9))   # 21:00 on the 4th in New York
+        assert store.partitions('RealTimeData_ConvertibleBond') == [datetime.date(2024, 3, 5)]
+        assert store.read('RealTimeData_ConvertibleBond')['Time'][0] == pandas.Timestamp(2024, 3, 5, 9)
+        store.append('RealTimeData_ConvertibleBond', make_table(121.0), day_time(5, 10))
+        # 2024-03-05 08:00 in Beijing, still the 4th in New York: the partition of the 5th is live, not compacted
+        monkeypatch.setattr(time, 'time', lambda: day_time(5, 8))
+        assert store.compact('RealTimeData_ConvertibleBond') == 0
+    finally:
+        monkeypatch.undo()
+        time.tzset()
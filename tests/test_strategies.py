@@ -0,0 +1,144 @@
+import json
+import operator
+import numpy as np
+import pandas
+import pytest
+from strategies import (strategy_specs, get_parameter, get_strategy_cells, evaluate_strategy, rank_strategy_spec,
+                        get_table_arrays, load_strategy_specs, RankingIndex, get_ranking_deltas, offset_cell, get_ranking_blocks)
+
+
+cells = {'D2': 250, 'H2': 50, 'M2': 900, 'D3': 200, 'H3': 30, 'M3': 600, 'D5': '250&5', 'H5': '50&2', 'M5': '900&3'}
+
+
+# CB table of random prices, premium rates and outstanding amounts, a few NaN and suspended ('停牌') cells
+def make_table(size=300, seed=0):
+    rng = np.random.default_rng(seed)
+    data = pandas.DataFrame({'Quote': [str(110000 + i) for i in range(size)], 'Name': ['CB%d' % i for i in range(size)],
+                             'Current': rng.uniform(90, 300, size), 'Premium Rate': rng.uniform(-5, 80, size),
+                             'Outstanding Amount (m)': rng.uniform(50, 1500, size)})
+    data['Double Low'] = data['Current'] + data['Premium Rate']
+    data['Current'] = data['Current'].astype(object)
+    data.loc[3, 'Current'] = '停牌'
+    data.loc[7, 'Premium Rate'] = np.nan
+    data.index += 1
+    return data
+
+
+# Rank a table with pandas, the way the hand-written rankers did
+def rank_with_pandas(spec, data, cells):
+    arrays = pandas.DataFrame(get_table_arrays(data))
+    mask = np.ones(len(data), dtype=bool)
+    for column, op, threshold in spec['filters']:
+        mask &= {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}[op](
+            arrays[column], get_parameter(threshold, cells, 0)).to_numpy()
+    if isinstance(spec['score'], dict):
+        score = sum(sign * get_parameter(weight, cells, 1) * arrays[column] for column, weight, sign in spec['score']['terms'])
+    else:
+        score = arrays[spec['score']]
+    ranked = score[mask].sort_values(ascending=spec['ascending'], kind='stable', na_position='last')
+    return ranked.index[:spec['top']].to_numpy()
+
+
+def test_get_parameter():
+    assert get_parameter('D5', cells) == 250 and get_parameter('D5', cells, 1) == 5
+    assert get_parameter('D2', cells, 1) == 250 and get_parameter(0, cells) == 0.0
+    assert get_strategy_cells(strategy_specs['multifactor1']) == ['D5', 'H5', 'M5']
+
+
+@pytest.mark.parametrize('name', ['premium_rate', 'DoubleLow', 'multifactor1'])
+def test_evaluate_strategy_matches_pandas(name):
+    spec = strategy_specs[name]
+    data = make_table()
+    rows, score = evaluate_strategy(spec, get_table_arrays(data), cells)
+    np.testing.assert_array_equal(rows, rank_with_pandas(spec, data, cells))
+    assert 3 not in rows and 7 not in rows   # suspended and missing values never pass a filter
+
+
+@pytest.mark.parametrize('name', ['premium_rate', 'DoubleLow', 'multifactor1'])
+def test_ties_at_the_cut_go_by_row_position(name):
+    spec = strategy_specs[name]
+    data = make_table()
+    for column in ('Current', 'Premium Rate', 'Outstanding Amount (m)', 'Double Low'):
+        data[column] = pandas.to_numeric(data[column], errors='coerce').round(-1)   # many equal scores
+    data['Current'] = data['Current'].astype(object)
+    data.loc[3, 'Current'] = '停牌'
+    for seed in range(5):
+        shuffled = data.sample(frac=1, random_state=seed)
+        rows, score = evaluate_strategy(spec, get_table_arrays(shuffled), cells)
+        np.testing.assert_array_equal(rows, rank_with_pandas(spec, shuffled, cells))
+
+
+def test_rank_strategy_spec_table():
+    data = make_table()
+    table = rank_strategy_spec(strategy_specs['multifactor1'], data, cells)
+    assert list(table.index) == list(range(1, 21))
+    assert list(table.columns) == strategy_specs['multifactor1']['columns'] + ['multifactor1']
+    assert table['multifactor1'].is_monotonic_increasing
+    expected = 5 * table['Current'] + 2 * table['Premium Rate'] + 3 * table['Outstanding Amount (m)']
+    np.testing.assert_allclose(table['multifactor1'], expected)
+
+
+def test_descending_strategy_and_short_list():
+    spec = {'source': 'Underlying_Values', 'columns': ['Quote', 'DtD'], 'filters': [['DtD', '>', 0]],
+            'score': 'DtD', 'ascending': False, 'top': 5}
+    data = pandas.DataFrame({'Quote': list('abcd'), 'DtD': [1.0, -1.0, 3.0, np.nan]})
+    rows, score = evaluate_strategy(spec, get_table_arrays(data), {})
+    assert rows.tolist() == [2, 0]
+
+
+def test_load_strategy_specs(tmp_path):
+    spec = {'title': 'Cheap', 'source': 'RealTimeData_ConvertibleBond', 'columns': ['Quote', 'Current'],
+            'filters': [['Current', '<', 110]], 'score': 'Current', 'ascending': True, 'top': 3, 'destination': ['Sheet', 'A1']}
+    path = tmp_path / 'strategies.json'
+    path.write_text(json.dumps({'cheap_test': spec}), encoding='utf-8')
+    try:
+        load_strategy_specs(str(path))
+        assert strategy_specs['cheap_test'] == spec
+    finally:
+        strategy_specs.pop('cheap_test', None)
+
+
+# Change a few prices of a table at every tick, with many equal scores, see streaming.StreamingRefresher
+@pytest.mark.parametrize('name', ['premium_rate', 'DoubleLow', 'multifactor1'])
+def test_ranking_index_matches_evaluate_strategy(name):
+    spec = strategy_specs[name]
+    rng = np.random.default_rng(1)
+    arrays = {column: values.round(-1) for column, values in get_table_arrays(make_table()).items()}
+    index = RankingIndex(spec, cells)
+    assert index.build(arrays) == evaluate_strategy(spec, arrays, cells)[0].tolist()
+    for tick in range(50):
+        rows = rng.choice(arrays['Current'].size, size=rng.integers(1, 8), replace=False)
+        arrays['Current'][rows] = rng.uniform(90, 300, rows.size).round(-1)
+        arrays['Premium Rate'][rows] = np.where(rng.random(rows.size) < 0.1, np.nan, rng.uniform(-5, 80, rows.size).round(-1))
+        arrays['Double Low'][rows] = arrays['Current'][rows] + arrays['Premium Rate'][rows]
+        previous = list(index.top_rows)
+        deltas = index.update(arrays, rows)
+        expected, score = evaluate_strategy(spec, arrays, cells)
+        assert index.top_rows == expected.tolist()
+        assert deltas == get_ranking_deltas(previous, index.top_rows, rows.tolist())
+    np.testing.assert_array_equal(index.score, score)
+
+
+def test_get_ranking_deltas():
+    deltas = get_ranking_deltas([10, 11, 12, 13], [11, 10, 12, 14], changed_rows=[12, 99])
+    assert deltas == [{'event': 'move', 'row': 11, 'rank': 1, 'previous': 2},
+                      {'event': 'move', 'row': 10, 'rank': 2, 'previous': 1},
+                      {'event': 'change', 'row': 12, 'rank': 3, 'previous': 3},
+                      {'event': 'enter', 'row': 14, 'rank': 4, 'previous': None},
+                      {'event': 'exit', 'row': 13, 'rank': None, 'previous': 4}]
+    assert get_ranking_deltas([1, 2], [1, 2]) == []
+
+
+def test_offset_cell():
+    assert offset_cell('J2', 3) == 'J5'
+    assert offset_cell('Z7', 0, 1) == 'AA7' and offset_cell('az10', 1, 1) == 'BA11'
+
+
+def test_get_ranking_blocks():
+    spec = {**strategy_specs['premium_rate'], 'destination': ['Sheet', 'B2']}
+    table = pandas.DataFrame({'Quote': ['110003', '123107'], 'Current': [np.float64(101.5), np.nan]}, index=[1, 2])
+    deltas = [{'event': 'move', 'row': 5, 'rank': 2, 'previous': 1}, {'event': 'exit', 'row': 6, 'rank': None, 'previous': 3}]
+    blocks = get_ranking_blocks(spec, table, deltas, previous_size=4)
+    assert blocks == [('Sheet', 'B4', [[2, '123107', None]]), ('Sheet', 'B5', [[None, None, None]]),
+                      ('Sheet', 'B6', [[None, None, None]])]
+    assert type(get_ranking_blocks(spec, table, [{'rank': 1}], 2)[0][2][0][2]) is float
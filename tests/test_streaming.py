@@ -0,0 +1,105 @@
+import numpy as np
+import pytest
+from benchmark import benchmark_parameters
+from kmv import KMVCalibrator
+from quotes import QuoteFetcher
+from pipeline import price_underlying_table, rank_strategies
+from streaming import StreamingRefresher, get_realtime_fetcher, priced_columns, stale_slices
+from test_pipeline import build_tables
+
+
+# Real-time quotes of a market whose prices are set by the tests
+class Market:
+    def __init__(self, prices):
+        self.prices = {symbol: price for symbol, price in prices.items() if np.isfinite(price)}
+        self.polled = []
+
+    def __call__(self, symbols):
+        symbols = list(symbols)
+        self.polled.append(symbols)
+        return {symbol: {'symbol': symbol, 'current': self.prices[symbol], 'percent': 1.0, 'amount': 2000000.0,
+                         'high': self.prices[symbol] * 1.02, 'low': self.prices[symbol] * 0.99}
+                for symbol in symbols if symbol in self.prices}
+
+
+@pytest.fixture
+def streamer():
+    data_fund, data_stock, lines = build_tables(60)
+    streamer = StreamingRefresher(data_fund, data_stock, benchmark_parameters, None, log=lambda *args: None,
+                                  calibrator=KMVCalibrator())
+    streamer.fetch_realtime = Market(streamer.prices)
+    return streamer
+
+
+def test_unchanged_prices_update_nothing(streamer):
+    assert streamer.tick(symbols=streamer.get_symbols()) == {}
+    assert streamer.ticks == 1 and streamer.changed_rows == 0
+
+
+def test_ticks_match_a_full_recompute(streamer):
+    market = streamer.fetch_realtime
+    rng = np.random.default_rng(4)
+    moved = set()
+    for tick in range(3):
+        for symbol in rng.choice(sorted(market.prices), size=12, replace=False):
+            market.prices[symbol] = round(market.prices[symbol] * rng.uniform(0.9, 1.1), 3)
+            moved.add(symbol)
+        updated = streamer.tick(symbols=streamer.get_symbols())
+        assert 'RealTimeData_ConvertibleBond' in updated or 'Underlying_Values' in updated
+
+    data_fund, data_stock = streamer.data_fund, streamer.data_stock
+    for symbol, fund_code in zip(streamer.bond_symbols, data_fund['Quote']):
+        if symbol in market.prices:
+            assert data_fund.loc[data_fund['Quote'] == fund_code, 'Current'].iloc[0] == market.prices[symbol]
+    rows = data_fund['Stock Quote'].isin(moved)   # the other rows keep the conversion values of the quote server
+    assert rows.any()
+    conversion_value = 100 / data_fund['Conversion Price'].astype(float) * data_fund['Stock Quote'].map(market.prices)
+    np.testing.assert_allclose(data_fund['Conversion Value'].astype(float)[rows], conversion_value[rows], rtol=1e-12)
+    np.testing.assert_allclose(data_fund['Premium Rate'].astype(float)[rows],
+                               (data_fund['Current'].astype(float) / conversion_value - 1)[rows] * 100, rtol=1e-12)
+
+    priced = price_underlying_table(data_stock.copy(), calibrator=KMVCalibrator())
+    for column in priced_columns:
+        np.testing.assert_allclose(data_stock[column].astype(float), priced[column].astype(float), rtol=1e-6, atol=1e-9)
+    rankings = rank_strategies(data_fund, data_stock, benchmark_parameters, log=lambda *args: None)
+    for name, table in streamer.rankings.items():
+        assert table['Quote'].tolist() == rankings[name]['Quote'].tolist(), name
+
+
+def test_ranking_deltas_of_a_tick(streamer):
+    name = 'premium_rate'
+    first = streamer.rankings[name]['Quote'].iloc[0]
+    symbol = streamer.bond_symbols[list(streamer.data_fund['Quote']).index(first)]
+    streamer.fetch_realtime.prices[symbol] *= 1.5   # the cheapest CB gets expensive
+    updated = streamer.tick(symbols=[symbol])
+    assert name in updated and streamer.rankings[name]['Quote'].iloc[0] != first
+    assert any(delta.get('previous') == 1 for delta in streamer.ranking_deltas[name])
+
+
+def test_poll_symbols_hot_and_stale_slices(streamer):
+    symbols = streamer.get_symbols()
+    hot = [symbol for symbol in symbols if symbol in streamer.hot_symbols]
+    assert hot and len(hot) < len(symbols)
+    polled = []
+    for tick in range(stale_slices):
+        streamer.ticks = tick
+        polled.append(streamer.get_poll_symbols())
+    assert all(set(hot) <= set(poll) for poll in polled)
+    assert set().union(*polled) == set(symbols)   # every symbol is polled once per cycle of slices
+    assert sum(len(poll) - len(hot) for poll in polled) == len(symbols) - len(hot)
+
+
+def test_realtime_fetcher_batches_the_symbols():
+    requests = []
+
+    class Transport:
+        def quotec(self, symbols, timeout=None):
+            requests.append(list(symbols))
+            if 'SZ000000' in symbols:
+                raise OSError('batch failed')
+            return {'data': [{'symbol': symbol, 'current': 100.0} for symbol in symbols] + [None]}
+
+    fetch_realtime = get_realtime_fetcher(QuoteFetcher(Transport(), max_workers=2), batch_size=3)
+    quotes = fetch_realtime(['SH110001', 'SH110002', 'SH110003', 'SZ123001', 'SZ000000'])
+    assert sorted(map(len, requests)) == [2, 3]
+    assert sorted(quotes) == ['SH110001', 'SH110002', 'SH110003']   # the symbols of the failed batch are missing
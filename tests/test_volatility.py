@@ -0,0 +1,108 @@
+import datetime
+import numpy as np
+import pytest
+from scheduler import exchange_timezone
+from volatility import RollingVolatility, VolatilityEngine, annualization_days, history_bars
+
+
+# Annualized rolling standard deviation (%) of the last `window` returns, NaN until the window is full
+def rolling_std(returns, window):
+    if len(returns) < window:
+        return np.nan
+    return np.std(returns[-window:], ddof=1) * np.sqrt(annualization_days) * 100
+
+
+def test_welford_windows_match_numpy_in_chunks():
+    rng = np.random.default_rng(0)
+    returns = rng.normal(0, 0.02, (3, 140))
+    returns[1, :70] += 0.5   # a regime the window forgets, exercises the removal of the leaving returns
+    rolling = RollingVolatility(windows=(5, 20, 60), ewma_lambdas=(0.94,))
+    rolling.add_symbols(['A', 'B', 'C'])
+    start = 0
+    for size in (1, 7, 30, 2, 60, 40):   # updates of several bars, padded with NaN
+        chunk = returns[:, start:start + size].copy()
+        chunk[2, size // 2:] = np.nan   # fewer bars for C
+        rolling.update([0, 1, 2], chunk)
+        start += size
+        vol = rolling.volatility([0, 1])
+        for row in (0, 1):
+            for window in (5, 20, 60):
+                expected = rolling_std(returns[row, :start], window)
+                if np.isnan(expected):
+                    assert np.isnan(vol['vol_' + str(window)][row])
+                else:
+                    assert vol['vol_' + str(window)][row] == pytest.approx(expected, rel=1e-9)
+
+
+def test_ewma_and_save_load(tmp_path):
+    returns = np.array([0.01, -0.02, 0.015])
+    rolling = RollingVolatility(windows=(2,), ewma_lambdas=(0.9,))
+    rolling.add_symbols(['A'])
+    rolling.update([0], returns[None, :])
+    variance = returns[0]**2
+    for x in returns[1:]:
+        variance = 0.9 * variance + 0.1 * x**2
+    assert rolling.volatility()['ewma_0.9'][0] == pytest.approx(np.sqrt(variance * annualization_days) * 100)
+    rolling.save(str(tmp_path / 'rolling.npz'))
+    loaded = RollingVolatility.load(str(tmp_path / 'rolling.npz'))
+    assert loaded.symbols == ['A'] and loaded.volatility()['vol_2'][0] == rolling.volatility()['vol_2'][0]
+
+
+# k-line payload of daily bars at midnight Beijing time
+def kline_payload(dates, closes):
+    stamps = [int(datetime.datetime.combine(date, datetime.time(), exchange_timezone).timestamp() * 1000) for date in dates]
+    return {'data': {'column': ['timestamp', 'close'], 'item': [[stamp, close] for stamp, close in zip(stamps, closes)]}}
+
+
+@pytest.mark.parametrize('hour, kept', [(14, 3), (15, 4)])
+def test_today_bar_kept_after_the_exchange_close(tmp_path, hour, kept):
+    today = datetime.date(2024, 3, 8)
+    dates = [today - datetime.timedelta(days=days) for days in (3, 2, 1, 0)]
+    payload = kline_payload(dates, [10.0, 10.2, 10.1, 10.4])
+    # the same instant wherever the computer is: the cutoff is the close of the exchange
+    now = datetime.datetime.combine(today, datetime.time(hour, 30), exchange_timezone).timestamp()
+    engine = VolatilityEngine(str(tmp_path), windows=(2,))
+    engine.refresh(['SH600000'], lambda items: [payload for item in items], now=now)
+    assert engine.get_history('SH600000')[0].size == kept
+    assert engine.rolling.filled[0] == kept - 1
+
+
+def test_refresh_appends_new_bars_only(tmp_path):
+    dates = [datetime.date(2024, 3, day) for day in (4, 5, 6, 7)]
+    closes = [10.0, 10.2, 10.1, 10.4]
+    now = datetime.datetime.combine(datetime.date(2024, 3, 7), datetime.time(16), exchange_timezone).timestamp()
+    engine = VolatilityEngine(str(tmp_path), windows=(2,))
+    engine.refresh(['SZ000001'], lambda items: [kline_payload(dates[:3], closes[:3])], now=now)
+    engine = VolatilityEngine(str(tmp_path), windows=(2,))   # state from the cache
+    engine.refresh(['SZ000001'], lambda items: [kline_payload(dates, closes)], now=now)
+    assert engine.rolling.filled[0] == 3
+    assert engine.realized_volatility(['SZ000001', 'unknown'], 2)[0] == pytest.approx(rolling_std(np.diff(np.log(closes)), 2))
+    assert np.isnan(engine.realized_volatility(['unknown'], 2)[0])
+
+
+def test_refresh_rebuilds_the_history_when_the_adjustment_changes(tmp_path):
+    dates = [datetime.date(2024, 3, day) for day in (4, 5, 6, 7)]
+    now = datetime.datetime.combine(datetime.date(2024, 3, 7), datetime.time(16), exchange_timezone).timestamp()
+    engine = VolatilityEngine(str(tmp_path), windows=(3,))
+    engine.refresh(['SZ000001'], lambda items: [kline_payload(dates[:3], [10.0, 10.2, 10.1])], now=now)
+    # a dividend on the 7th: the provider scales the past closes, the cached ones no longer match
+    closes = [9.0, 9.18, 9.09, 9.4]
+    counts = []
+
+    def fetch_klines(items):
+        counts.extend(count for symbol, count in items)
+        return [kline_payload(dates[-2:], closes[-2:]) if count < history_bars else kline_payload(dates, closes) for symbol, count in items]
+
+    engine = VolatilityEngine(str(tmp_path), windows=(3,))
+    engine.refresh(['SZ000001'], fetch_klines, now=now)
+    assert counts == [2, history_bars]   # the last cached bar and today's, then the whole history
+    np.testing.assert_allclose(engine.get_history('SZ000001')[1], closes)
+    assert engine.rolling.filled[0] == 3
+    assert engine.realized_volatility(['SZ000001'], 3)[0] == pytest.approx(rolling_std(np.diff(np.log(closes)), 3))
+    np.testing.assert_allclose(np.load(str(tmp_path / 'SZ000001.npz'))['close'], closes)
+
+    # a failed refetch keeps the old history
+    engine.refresh(['SZ000001'], lambda items: [kline_payload(dates[-1:], [9.5]) if count < history_bars else OSError('down')
+                                                for symbol, count in items], now=now)
+    np.testing.assert_allclose(engine.get_history('SZ000001')[1], closes)
+    assert engine.rolling.filled[0] == 3
@@ -0,0 +1,26 @@
+import xlwings  # xlwings - Make Excel Fly! https://docs.xlwings.org/en/stable/index.html
+import client  # thin client of the compute server, see server.py
+
+
+# Worksheet functions reading the warm tables of the compute server: set "UDF Modules" to udfs in the xlwings ribbon.
+# They never start the server nor import AutoArbitrage, a formula recalculates in milliseconds
+
+
+@xlwings.func
+# =LATEST_TABLE("DoubleLow", 10): the top rows of a latest table with its header, e.g. a ranking or 'Underlying_Values'
+def latest_table(name, top=None):
+    table = client.get_table(name, None if top is None else int(top))
+    if not table:
+        return 'No table ' + name + ', start the compute server or refresh'
+    return [['Index'] + table['columns']] + [[index] + row for index, row in zip(table['index'], table['data'])]
+
+
+@xlwings.func
+# =SERVER_STATUS(): uptime and busy function of the compute server
+def server_status():
+    try:
+        health = client.request('/health', timeout=1)
+    except OSError:
+        return 'stopped'
+    return 'up ' + str(int(health['uptime'])) + ' s' + ('' if health['warm'] else ', warming up') + \
+           ('' if health['running'] is None else ', running ' + health['running'])
@@ -0,0 +1,286 @@
+import os
+import time
+import datetime
+import numpy as np
+import pandas
+from quotes import QuoteFetcher
+from scheduler import exchange_timezone, get_exchange_time
+
+
+annualization_days = 250   # trading days per year, to annualize the daily volatility
+history_bars = 284   # bars fetched for a symbol without history, same as pysnowball.kline, >= 250 daily returns
+close_tolerance = 1e-6   # relative difference between a fetched and a cached close of the same bar, beyond it the history is refetched
+
+
+# Get the bar timestamps (ms) and close prices of a k-line payload, see pysnowball.kline
+def get_kline_closes(payload):
+    data = payload['data']
+    columns = data['column']
+    items = np.array([[row[columns.index('timestamp')], row[columns.index('close')]] for row in data.get('item') or []],
+                     dtype=float).reshape(-1, 2)
+    return items[:, 0].astype(np.int64), items[:, 1]
+
+
+# Rolling volatilities of many underlyings, updated bar by bar without recomputing the windows
+class RollingVolatility:
+    """
+    windows: rolling window lengths in daily returns, e.g. (20, 60, 250)
+    ewma_lambdas: decay factors of the EWMA volatilities, e.g. (0.94,) for RiskMetrics
+    Every window keeps a running count, mean and sum of squared deviations (Welford) per underlying:
+    a new return is added and the return leaving the window is removed, both in O(1), for all
+    underlyings at once. The last max(windows) returns are kept in a ring buffer to know what leaves.
+    """
+    def __init__(self, windows=(20, 60, 250), ewma_lambdas=(0.94,)):
+        self.windows = tuple(int(w) for w in windows)
+        self.ewma_lambdas = tuple(float(l) for l in ewma_lambdas)
+        self.symbols = []
+        self.index = {}
+        size = max(self.windows)
+        self.count = np.zeros((0, len(self.windows)), dtype=np.int64)
+        self.mean = np.zeros((0, len(self.windows)))
+        self.m2 = np.zeros((0, len(self.windows)))
+        self.buffer = np.zeros((0, size))
+        self.position = np.zeros(0, dtype=np.int64)   # next slot of the ring buffer
+        self.filled = np.zeros(0, dtype=np.int64)   # returns seen so far
+        self.ewma_var = np.zeros((0, len(self.ewma_lambdas)))
+
+    def add_symbols(self, symbols):
+        new = [symbol for symbol in dict.fromkeys(symbols) if symbol not in self.index]
+        if not new:
+            return
+        for symbol in new:
+            self.index[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        n = len(new)
+        self.count = np.vstack([self.count, np.zeros((n, len(self.windows)), dtype=np.int64)])
+        self.mean = np.vstack([self.mean, np.zeros((n, len(self.windows)))])
+        self.m2 = np.vstack([self.m2, np.zeros((n, len(self.windows)))])
+        self.buffer = np.vstack([self.buffer, np.zeros((n, self.buffer.shape[1]))])
+        self.position = np.concatenate([self.position, np.zeros(n, dtype=np.int64)])
+        self.filled = np.concatenate([self.filled, np.zeros(n, dtype=np.int64)])
+        self.ewma_var = np.vstack([self.ewma_var, np.zeros((n, len(self.ewma_lambdas)))])
+
+    # Forget the returns of some underlyings, e.g. before feeding a rebuilt history
+    def reset(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        for name in ('count', 'mean', 'm2', 'buffer', 'position', 'filled', 'ewma_var'):
+            getattr(self, name)[rows] = 0
+
+    def update(self, rows, returns):
+        """
+        rows: row of every underlying in self.symbols, shape (n,)
+        returns: new daily log returns, shape (n, k), oldest first, padded with NaN at the end
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        returns = np.atleast_2d(np.asarray(returns, dtype=float))
+        size = self.buffer.shape[1]
+        for j in range(returns.shape[1]):
+            valid = ~np.isnan(returns[:, j])
+            r = rows[valid]
+            x = returns[valid, j]
+            if r.size == 0:
+                continue
+            for w, window in enumerate(self.windows):
+                count, mean, m2 = self.count[r, w], self.mean[r, w], self.m2[r, w]
+                # remove the return leaving the window
+                full = self.filled[r] >= window
+                leaving = self.buffer[r, (self.position[r] - window) % size]
+                count = count - full
+                delta = np.where(full, leaving - mean, 0.0)
+                mean = np.where(full & (count > 0), mean - delta / np.maximum(count, 1), np.where(full, 0.0, mean))
+                m2 = np.where(full, m2 - delta * (leaving - mean), m2)
+                # add the new return
+                count = count + 1
+                delta = x - mean
+                mean = mean + delta / count
+                m2 = np.maximum(m2 + delta * (x - mean), 0.0)
+                self.count[r, w], self.mean[r, w], self.m2[r, w] = count, mean, m2
+            for l, lam in enumerate(self.ewma_lambdas):
+                self.ewma_var[r, l] = np.where(self.filled[r] == 0, x**2, lam * self.ewma_var[r, l] + (1 - lam) * x**2)
+            self.buffer[r, self.position[r]] = x
+            self.position[r] = (self.position[r] + 1) % size
+            self.filled[r] += 1
+
+    def volatility(self, rows=None):
+        """
+        return: dict of 'vol_<window>' / 'ewma_<lambda>' -> annualized volatility in %, NaN until a window is full
+        """
+        rows = np.arange(len(self.symbols)) if rows is None else np.asarray(rows, dtype=np.int64)
+        result = {}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for w, window in enumerate(self.windows):
+                count = self.count[rows, w]
+                vol = np.sqrt(self.m2[rows, w] / (count - 1)) * np.sqrt(annualization_days) * 100
+                result['vol_' + str(window)] = np.where(count >= window, vol, np.nan)
+            for l, lam in enumerate(self.ewma_lambdas):
+                vol = np.sqrt(self.ewma_var[rows, l]) * np.sqrt(annualization_days) * 100
+                result['ewma_' + str(lam)] = np.where(self.filled[rows] > 0, vol, np.nan)
+        return result
+
+    def save(self, path):
+        np.savez(path, windows=np.array(self.windows), ewma_lambdas=np.array(self.ewma_lambdas),
+                 symbols=np.array(self.symbols, dtype=str), count=self.count, mean=self.mean, m2=self.m2,
+                 buffer=self.buffer, position=self.position, filled=self.filled, ewma_var=self.ewma_var)
+
+    @classmethod
+    def load(cls, path):
+        state = np.load(path)
+        rolling = cls(tuple(state['windows']), tuple(state['ewma_lambdas']))
+        rolling.symbols = [str(symbol) for symbol in state['symbols']]
+        rolling.index = {symbol: i for i, symbol in enumerate(rolling.symbols)}
+        for name in ('count', 'mean', 'm2', 'buffer', 'position', 'filled', 'ewma_var'):
+            setattr(rolling, name, state[name])
+        return rolling
+
+
+# Realized volatility engine: daily k-line history in a local cache, rolling volatilities updated with the new bars only
+class VolatilityEngine:
+    """
+    cache_dir: directory of the history cache, one <symbol>.npz (timestamps, closes) per underlying,
+               plus rolling.npz with the state of the rolling windows
+    windows, ewma_lambdas: see RollingVolatility
+    """
+    def __init__(self, cache_dir='history', windows=(20, 60, 250), ewma_lambdas=(0.94,)):
+        self.cache_dir = cache_dir
+        self.history = {}   # symbol -> (timestamps, closes)
+        state_path = os.path.join(cache_dir, 'rolling.npz')
+        self.rolling = None
+        if os.path.isfile(state_path):
+            rolling = RollingVolatility.load(state_path)
+            if rolling.windows == tuple(windows) and rolling.ewma_lambdas == tuple(float(l) for l in ewma_lambdas):
+                self.rolling = rolling
+        if self.rolling is None:
+            self.rolling = RollingVolatility(windows, ewma_lambdas)   # rebuilt from the history files when needed
+
+    def get_history(self, symbol):
+        if symbol not in self.history:
+            path = os.path.join(self.cache_dir, symbol + '.npz')
+            if os.path.isfile(path):
+                data = np.load(path)
+                self.history[symbol] = (data['timestamp'], data['close'])
+            else:
+                self.history[symbol] = (np.zeros(0, dtype=np.int64), np.zeros(0))
+        return self.history[symbol]
+
+    # Number of bars to ask for: everything since the last cached bar, or a full year without history
+    def get_bar_count(self, symbol, now=None):
+        timestamps = self.get_history(symbol)[0]
+        if timestamps.size == 0:
+            return history_bars
+        days = int(((time.time() if now is None else now) * 1000 - timestamps[-1]) // 86400000) + 1
+        return max(1, min(history_bars, days))
+
+    def refresh(self, symbols, fetch_klines, now=None):
+        """
+        symbols: underlyings, e.g. data_stock['Stock Quote']
+        fetch_klines: callable([(symbol, count), ...]) -> k-line payloads in the same order, e.g. QuoteFetcher.fetch
+        Only the bars after the last cached one are appended. Today's bar is kept only after the close (15:00 Beijing time).
+        The last cached bar is fetched again: when its close changed (the adjustment of the bars changed, e.g. a cache of
+        forward adjusted bars), the whole history of the symbol is fetched again and its rolling windows rebuilt.
+        """
+        symbols = [symbol for symbol in dict.fromkeys(symbols) if isinstance(symbol, str) and symbol]
+        now = time.time() if now is None else now
+        exchange_time = get_exchange_time(now)
+        today = int(datetime.datetime.combine(exchange_time.date(), datetime.time(), exchange_timezone).timestamp() * 1000)
+        closed_before = today + 86400000 if exchange_time.hour >= 15 else today
+
+        self.rolling.add_symbols(symbols)
+        rebuild = [symbol for symbol in symbols if self.rolling.filled[self.rolling.index[symbol]] == 0]
+        payloads = fetch_klines([(symbol, self.get_bar_count(symbol, now)) for symbol in symbols])
+        bars = {symbol: get_kline_closes(payload) for symbol, payload in zip(symbols, payloads)
+                if not isinstance(payload, Exception)}   # failed request, see QuoteFetcher.fetch(return_exceptions=True)
+        revised = [symbol for symbol, (new_timestamps, new_closes) in bars.items()
+                   if not self.is_consistent(symbol, new_timestamps, new_closes)]
+        if revised:
+            for symbol, payload in zip(revised, fetch_klines([(symbol, history_bars) for symbol in revised])):
+                if isinstance(payload, Exception) or get_kline_closes(payload)[0].size == 0:
+                    del bars[symbol]   # keep the old history until a refetch succeeds
+                    continue
+                bars[symbol] = get_kline_closes(payload)
+                self.history[symbol] = (np.zeros(0, dtype=np.int64), np.zeros(0))
+                self.rolling.reset([self.rolling.index[symbol]])
+                rebuild.append(symbol)
+
+        new_returns = []
+        for symbol in symbols:
+            timestamps, closes = self.get_history(symbol)
+            if symbol not in bars:
+                new_returns.append(np.zeros(0))
+                continue
+            new_timestamps, new_closes = bars[symbol]
+            last = timestamps[-1] if timestamps.size else -1
+            keep = (new_timestamps > last) & (new_timestamps < closed_before) & (new_closes > 0)
+            new_timestamps, new_closes = new_timestamps[keep], new_closes[keep]
+            if symbol in rebuild:
+                all_closes = np.concatenate([closes, new_closes])   # no rolling state yet, feed the whole history once
+                new_returns.append(np.diff(np.log(all_closes)))
+            else:
+                new_returns.append(np.diff(np.log(np.concatenate([closes[-1:], new_closes]))))
+            if new_timestamps.size:
+                self.history[symbol] = (np.concatenate([timestamps, new_timestamps]), np.concatenate([closes, new_closes]))
+                self.save_history(symbol)
+
+        # one vectorized pass over all underlyings, returns padded with NaN to the longest update
+        length = max([r.size for r in new_returns] + [0])
+        if length:
+            padded = np.full((len(symbols), length), np.nan)
+            for i, returns in enumerate(new_returns):
+                padded[i, :returns.size] = returns
+            self.rolling.update([self.rolling.index[symbol] for symbol in symbols], padded)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.rolling.save(os.path.join(self.cache_dir, 'rolling.npz'))
+
+    # Whether fetched bars continue the cached history: same close for the last cached bar, when the bars reach it
+    def is_consistent(self, symbol, new_timestamps, new_closes):
+        timestamps, closes = self.get_history(symbol)
+        if timestamps.size == 0 or new_timestamps.size == 0 or new_timestamps[0] > timestamps[-1]:
+            return True
+        same = new_timestamps == timestamps[-1]
+        return bool(same.any()) and abs(new_closes[same][0] / closes[-1] - 1) <= close_tolerance
+
+    def save_history(self, symbol):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        timestamps, closes = self.history[symbol]
+        np.savez(os.path.join(self.cache_dir, symbol + '.npz'), timestamp=timestamps, close=closes)
+
+    def volatility_table(self, symbols):
+        """
+        return: dict of 'vol_<window>' / 'ewma_<lambda>' -> annualized volatility in %, one value per symbol
+        """
+        rows = np.array([self.rolling.index.get(symbol, -1) for symbol in symbols], dtype=np.int64)
+        known = rows >= 0
+        result = {}
+        for name, vol in self.rolling.volatility(np.where(known, rows, 0)).items():
+            result[name] = np.where(known, vol, np.nan)
+        return result
+
+    # Realized volatility (%) of the underlyings over one window, e.g. 250 days ~ the last 12 months
+    def realized_volatility(self, symbols, window=250):
+        return self.volatility_table(symbols)['vol_' + str(window)]
+
+
+# Build the k-line fetcher of the volatility engine on top of a quote fetcher: same pool, workers, rate limit and timeout
+def get_kline_fetcher(quote_fetcher):
+    transport = quote_fetcher.transport   # needs a kline method, e.g. quotes.SnowballTransport
+    kline_fetcher = QuoteFetcher(lambda item, timeout=None: transport.kline(item[0], item[1], timeout),
+                                 max_workers=quote_fetcher.max_workers, timeout=quote_fetcher.timeout, endpoint='kline')
+    kline_fetcher.rate_limiter = quote_fetcher.rate_limiter
+    return lambda items: kline_fetcher.fetch(items, return_exceptions=True)
+
+
+# Fill 'Realized Volatility' of the stock table from the engine, the sheet value is kept where the history is too short
+def fill_realized_volatility(data_stock, engine, fetch_klines, window=250, log=print):
+    """
+    data_stock: the 'Underlying_Values' table
+    engine: VolatilityEngine
+    fetch_klines: see VolatilityEngine.refresh and get_kline_fetcher
+    window: rolling window in trading days, 250 ~ the last 12 months, see pricing.bs_option
+    """
+    symbols = list(data_stock['Stock Quote'])
+    engine.refresh(symbols, fetch_klines)
+    realized_vol = engine.realized_volatility(symbols, window)
+    sheet_vol = pandas.to_numeric(data_stock['Realized Volatility'], errors='coerce').to_numpy(dtype=float)
+    log('Realized Volatility：' + str(int(np.count_nonzero(~np.isnan(realized_vol)))) + '/' + str(len(symbols)) + ' from history')
+    data_stock = data_stock.copy()
+    data_stock['Realized Volatility'] = np.where(np.isnan(realized_vol), sheet_vol, realized_vol)
+    return data_stock